@@ -0,0 +1,392 @@
+import os
+import json
+from datetime import datetime
+
+import numpy as np
+
+from Athena.settings import AthenaConfig
+from Athena.utils import filetime_to_dt64, dt64_to_filetime
+from Athena.data_handler.replay import merge_hermes_channels, PrefetchReader
+from Athena.data_handler.hermes_decoder import HermesTickDecoder, \
+    HermesKLineDecoder
+HTf, HKf = AthenaConfig.HermesTickFields, AthenaConfig.HermesKLineFields
+
+__author__ = 'zed'
+
+INDEX_FILE = 'index.json'
+COLUMN_SUFFIX = '.bin'
+
+
+def _tick_schema():
+    """
+    :return: list of (field, dtype) of archived ticks.
+    """
+    schema = [(HTf.ex_time, 'int64'), (HTf.local_time, 'int64')]
+    schema += [(field, 'float64') for field in HTf.floats]
+    schema += [(field, 'int32') for field in HTf.bid_vols + HTf.ask_vols]
+    schema += [(field, 'int64') for field in HTf.integers
+               if field not in HTf.bid_vols + HTf.ask_vols]
+    return schema
+
+
+def _kline_schema():
+    """
+    :return: list of (field, dtype) of archived bars.
+    """
+    schema = [(HKf.ex_time, 'int64'), (HKf.local_time, 'int64')]
+    schema += [(field, 'int64') for field in HKf.ohlc_time]
+    schema += [(field, 'float64') for field in HKf.floats]
+    schema += [(field, 'int64') for field in HKf.integers]
+    return schema
+
+
+# kind ('md', or 'kl' for any duration) -> list of (field, dtype)
+schemas = {
+    AthenaConfig.AthenaMessageTypes.md: _tick_schema(),
+    AthenaConfig.AthenaMessageTypes.kl: _kline_schema()
+}
+
+# time fields, stored as int64 filetime
+time_fields = {HTf.ex_time, HTf.local_time, HKf.ex_time, HKf.local_time} | \
+    set(HKf.ohlc_time)
+
+
+def kind_of(record):
+    """
+    kind of a cleaned record: 'md', or 'kl.' + duration specifier.
+    :param record: dict
+    :return: string
+    """
+    if record['tag'] == AthenaConfig.AthenaMessageTypes.kl:
+        return 'kl.' + record[HKf.duration_specifier]
+    return record['tag']
+
+
+def schema_of(kind):
+    """
+    :param kind: string, 'md' or 'kl.1m'...
+    :return: list of (field, dtype)
+    """
+    return schemas[kind.split('.')[0]]
+
+
+def _to_filetime(t):
+    """
+    :param t: datetime, datetime64 or filetime, None for no bound.
+    :return: int or None
+    """
+    if t is None or isinstance(t, (int, np.integer)):
+        return t
+    return int(dt64_to_filetime(np.datetime64(t, 'us')))
+
+
+class ColumnArchive(object):
+    """
+    On-disk archive of cleaned ticks and bars.
+
+    Records are stored by instrument, trading day and kind ('md' or
+    'kl.<duration specifier>'), one raw binary file per field:
+        root/Au(T+D)/20160930/md/systime.bin
+        root/Au(T+D)/20160930/kl.1m/closeprx.bin
+        ...
+    columns are of fixed dtype (see schemas): int64 filetime for times,
+    float64 for prices, int32 for volumes of the book, int64 for other
+    integers. Records of one partition are kept in order of exchange time:
+    appended records at or before the end of their partition (archived
+    again), or earlier than a record before them, are skipped.
+
+    Columns are appended first, then the index is written to a temporary
+    file and renamed over index.json. Bytes past the indexed count of a
+    column (left by an append that did not finish) are truncated by the
+    next append, so the index always describes whole records.
+
+    root/index.json keeps the schemas and, for each partition, the number
+    of records and the first/last exchange time (filetime):
+    {
+        "schemas": {"md": [["systime", "int64"], ...], "kl": [...]},
+        "partitions": {
+            "Au(T+D)": {
+                "md": {"20160930": {"count": 1000, "begin": ..., "end": ...}},
+                ...
+            }
+        }
+    }
+    """
+    def __init__(self, root=None):
+        """
+        constructor.
+        :param root: string, default is AthenaConfig.archive_root.
+        """
+        self.root = root or AthenaConfig.archive_root
+        self.index_path = os.path.join(self.root, INDEX_FILE)
+
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        else:
+            self.index = {'schemas': dict(), 'partitions': dict()}
+
+    def partition_dir(self, instrument, kind, day):
+        """
+        :return: string, directory of the partition.
+        """
+        return os.path.join(self.root, instrument, day, kind)
+
+    def partitions(self, instrument, kind):
+        """
+        :return: dict, day -> {'count', 'begin', 'end'}.
+        """
+        return self.index['partitions'].get(instrument, dict()).get(
+            kind, dict())
+
+    # ---------------------------------------------------------------------
+    def append(self, instrument, kind, day, columns):
+        """
+        append records to a partition.
+        :param instrument: string
+        :param kind: string, 'md' or 'kl.1m'...
+        :param day: string, trading day 'YYYYMMDD'.
+        :param columns: dict, field -> array-like of the same length. Time
+            fields are datetime/datetime64 or filetime. Fields that are
+            missing are filled with 0.
+        :return: int, number of records appended.
+        """
+        schema = schema_of(kind)
+        ex_time = schema[0][0]
+        times = np.asarray(columns[ex_time])
+        if times.dtype.kind in 'MO':
+            times = dt64_to_filetime(times)
+        times = times.astype(np.int64, copy=False)
+        count = len(times)
+        if not count:
+            return 0
+
+        # keep records after the end of partition, in order of time
+        partitions = self.index['partitions'].setdefault(
+            instrument, dict()).setdefault(kind, dict())
+        entry = partitions.get(day, {'count': 0, 'begin': None, 'end': None})
+        keep = times >= np.maximum.accumulate(times)
+        if entry['end'] is not None:
+            keep &= times > entry['end']
+        kept = int(keep.sum())
+        if kept < count:
+            print('[Archive]: Skipped {} records of {} {} {} out of time '
+                  'order.'.format(count - kept, instrument, kind, day))
+        if not kept:
+            return 0
+
+        directory = self.partition_dir(instrument, kind, day)
+        os.makedirs(directory, exist_ok=True)
+
+        for field, dtype in schema:
+            if field in columns:
+                values = np.asarray(columns[field])
+                if field in time_fields and values.dtype.kind in 'MO':
+                    values = dt64_to_filetime(values)
+                values = values.astype(dtype, copy=False)
+                if len(values) != count:
+                    raise ValueError('Column {} has {} values, expected {}.'
+                                     .format(field, len(values), count))
+                if kept < count:
+                    values = values[keep]
+            else:
+                values = np.zeros(kept, dtype=dtype)
+
+            with open(os.path.join(directory, field + COLUMN_SUFFIX),
+                      'ab') as f:
+                # drop what an unfinished append left past the index
+                f.truncate(entry['count'] * np.dtype(dtype).itemsize)
+                f.write(values.tobytes())
+
+        # update index, once columns are written
+        times = times[keep]
+        self.index['schemas'][kind.split('.')[0]] = schema
+        entry['count'] += kept
+        entry['begin'] = int(times[0]) if entry['begin'] is None else \
+            min(entry['begin'], int(times[0]))
+        entry['end'] = int(times[-1]) if entry['end'] is None else \
+            max(entry['end'], int(times[-1]))
+        partitions[day] = entry
+        self.flush()
+        return kept
+
+    def append_records(self, records):
+        """
+        append cleaned records (see HermesDecoder), grouped by partition.
+        The trading day is taken from 'day' field if it is 'YYYYMMDD', or
+        the date of exchange time.
+        :param records: iterable of dicts, in order of exchange time.
+        :return: int, number of records appended.
+        """
+        groups = dict()
+        for record in records:
+            kind = kind_of(record)
+            groups.setdefault(
+                (record[HTf.contract], kind, self.trading_day(record, kind)),
+                []).append(record)
+
+        count = 0
+        for (instrument, kind, day), rows in groups.items():
+            columns = dict()
+            for field, dtype in schema_of(kind):
+                if field in rows[0]:
+                    columns[field] = [row[field] for row in rows]
+            count += self.append(instrument, kind, day, columns)
+        return count
+
+    @staticmethod
+    def trading_day(record, kind):
+        """
+        :param record: dict
+        :param kind: string
+        :return: string, 'YYYYMMDD'
+        """
+        day = str(record.get(HTf.day, ''))
+        if len(day) == 8 and day.isdigit():
+            return day
+
+        t = record[schema_of(kind)[0][0]]
+        if not isinstance(t, datetime):
+            t = filetime_to_dt64(t).item()
+        return t.strftime('%Y%m%d')
+
+    def flush(self):
+        """
+        write index to disk (temporary file renamed over index.json), also
+        done by every append.
+        :return:
+        """
+        os.makedirs(self.root, exist_ok=True)
+        temp_path = self.index_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(temp_path, self.index_path)
+
+    # ---------------------------------------------------------------------
+    def days(self, instrument, kind, begin=None, end=None):
+        """
+        trading days of partitions that overlap time range.
+        :param instrument: string
+        :param kind: string
+        :param begin: datetime/datetime64/filetime, None for no bound.
+        :param end: datetime/datetime64/filetime, None for no bound.
+        :return: list of strings, sorted.
+        """
+        begin, end = _to_filetime(begin), _to_filetime(end)
+        partitions = self.partitions(instrument, kind)
+        return sorted(
+            day for day, entry in partitions.items()
+            if (begin is None or entry['end'] >= begin) and
+            (end is None or entry['begin'] <= end)
+        )
+
+    def read_day(self, instrument, kind, day, begin=None, end=None,
+                 fields=None):
+        """
+        memory-mapped columns of a partition, in time range (both ends
+        inclusive). Nothing is read from disk until values are accessed.
+        :param instrument: string
+        :param kind: string
+        :param day: string, 'YYYYMMDD'
+        :param begin: datetime/datetime64/filetime, None for no bound.
+        :param end: datetime/datetime64/filetime, None for no bound.
+        :param fields: list of fields, None for all.
+        :return: dict, field -> read-only np.memmap
+        """
+        schema = schema_of(kind)
+        ex_time = schema[0][0]
+        count = self.partitions(instrument, kind)[day]['count']
+        directory = self.partition_dir(instrument, kind, day)
+
+        def column(field, dtype):
+            if not count:
+                return np.empty(0, dtype=dtype)
+            return np.memmap(os.path.join(directory, field + COLUMN_SUFFIX),
+                             dtype=dtype, mode='r', shape=(count,))
+
+        dtypes = dict(schema)
+        times = column(ex_time, dtypes[ex_time])
+        begin, end = _to_filetime(begin), _to_filetime(end)
+        first = 0 if begin is None else \
+            int(np.searchsorted(times, begin, side='left'))
+        last = count if end is None else \
+            int(np.searchsorted(times, end, side='right'))
+
+        if fields is None:
+            fields = [field for field, dtype in schema]
+        return dict((field, column(field, dtypes[field])[first:last])
+                    for field in fields)
+
+    def iter_days(self, instrument, kind, begin=None, end=None, fields=None):
+        """
+        iterate through partitions of time range, see read_day.
+        :return: generator of (day, columns) tuples.
+        """
+        for day in self.days(instrument, kind, begin, end):
+            yield day, self.read_day(
+                instrument, kind, day, begin, end, fields)
+
+    def read(self, instrument, kind, begin=None, end=None, fields=None):
+        """
+        columns of time range. Columns of a single partition are memory-
+        mapped views, several partitions are concatenated.
+        :return: dict, field -> numpy array.
+        """
+        parts = [columns for day, columns in
+                 self.iter_days(instrument, kind, begin, end, fields)]
+        if len(parts) == 1:
+            return parts[0]
+
+        dtypes = dict(schema_of(kind))
+        if fields is None:
+            fields = list(dtypes)
+        return dict(
+            (field, np.concatenate([p[field] for p in parts])
+             if parts else np.empty(0, dtype=dtypes[field]))
+            for field in fields)
+
+
+def archive_hermes_directories(wrapper, directories, archive=None,
+                               batch_size=10000):
+    """
+    archive the hash sets of Hermes directories (in Hermes db), cleaned and
+    in time order.
+    :param wrapper: RedisWrapper, connected to Hermes db.
+    :param directories: list of strings, like 'md.uftreal.au1612' or
+        'kl.uftreal.au1612.1m'.
+    :param archive: ColumnArchive, default is archive at
+        AthenaConfig.archive_root.
+    :param batch_size: int, number of records appended at a time.
+    :return: int, number of records archived.
+    """
+    if archive is None:
+        archive = ColumnArchive()
+    md_decoder = HermesTickDecoder(raw_times=True)
+    kl_decoder = HermesKLineDecoder(raw_times=True)
+
+    count = 0
+    batch = []
+    keys = merge_hermes_channels(wrapper, directories)
+    reader = PrefetchReader(wrapper, keys, batch_size=batch_size)
+    try:
+        for k, row in reader:
+            if row is None:
+                continue
+            decoder = kl_decoder if k[:2] == b'kl' else md_decoder
+            try:
+                batch.append(decoder.decode_hash(
+                    row, k.decode('utf-8')).materialize())
+            except ValueError:
+                print('[Archive]: Illegal value at key {}.'.format(k))
+
+            if len(batch) >= batch_size:
+                count += archive.append_records(batch)
+                batch = []
+    finally:
+        reader.close()
+
+    count += archive.append_records(batch)
+    archive.flush()
+    print('[Archive]: Archived {} records of {} directories.'.format(
+        count, len(directories)))
+    return count
@@ -0,0 +1,113 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from Athena.settings import AthenaConfig
+from Athena.utils import dt_to_filetime
+from Athena.data_handler.archive import ColumnArchive
+HTf, HKf = AthenaConfig.HermesTickFields, AthenaConfig.HermesKLineFields
+
+__author__ = 'zed'
+
+
+class TestColumnArchive(unittest.TestCase):
+    """
+    Test columnar archive.
+    """
+    def setUp(self):
+        """
+        :return:
+        """
+        self.root = tempfile.mkdtemp()
+        self.t0 = datetime(2016, 9, 29, 14, 59)
+
+        self.records = []
+        for i in range(6):
+            t = self.t0 + timedelta(hours=12 * i)
+            self.records.append({
+                'tag': 'md',
+                HTf.contract: 'au1612',
+                HTf.ex_time: t,
+                HTf.local_time: dt_to_filetime(t),
+                HTf.last_price: 300. + i,
+                HTf.bid_vol_1: i,
+            })
+        self.records.append({
+            'tag': 'kl',
+            HKf.contract: 'au1612',
+            HKf.duration_specifier: '1m',
+            HKf.ex_time: self.t0,
+            HKf.close_price: 300.
+        })
+
+    def tearDown(self):
+        """
+        :return:
+        """
+        shutil.rmtree(self.root)
+
+    def test_write_read(self):
+        archive = ColumnArchive(self.root)
+        self.assertEqual(archive.append_records(self.records), 7)
+        archive.flush()
+
+        # >>> partitioned by trading day and kind, index is persisted
+        archive = ColumnArchive(self.root)
+        self.assertEqual(archive.days('au1612', 'md'),
+                         ['20160929', '20160930', '20161001', '20161002'])
+        self.assertEqual(archive.days('au1612', 'kl.1m'), ['20160929'])
+
+        # >>> a single day is a memory-mapped view
+        columns = archive.read('au1612', 'md', begin=self.t0,
+                               end=self.t0 + timedelta(hours=1))
+        self.assertIsInstance(columns[HTf.last_price], np.memmap)
+        self.assertEqual(columns[HTf.last_price].tolist(), [300.])
+        self.assertEqual(columns[HTf.ex_time][0], dt_to_filetime(self.t0))
+
+        # >>> ranges over days are concatenated, missing fields are 0
+        columns = archive.read(
+            'au1612', 'md', begin=self.t0 + timedelta(hours=12),
+            end=self.t0 + timedelta(hours=48),
+            fields=[HTf.last_price, HTf.bid_vol_1, HTf.ask_vol_1])
+        self.assertEqual(columns[HTf.last_price].tolist(),
+                         [301., 302., 303., 304.])
+        self.assertEqual(columns[HTf.bid_vol_1].dtype, np.int32)
+        self.assertEqual(columns[HTf.ask_vol_1].tolist(), [0, 0, 0, 0])
+
+    def test_append(self):
+        archive = ColumnArchive(self.root)
+        archive.append_records(self.records[:1])
+        t1 = self.t0 + timedelta(seconds=30)
+
+        # >>> records archived again, or out of time order, are skipped
+        later = dict(self.records[0], **{HTf.ex_time: t1})
+        earlier = dict(self.records[0], **{
+            HTf.ex_time: self.t0 + timedelta(seconds=10)})
+        self.assertEqual(archive.append_records(
+            [self.records[0], later, earlier]), 1)
+        self.assertEqual(archive.append_records([earlier]), 0)
+        entry = archive.partitions('au1612', 'md')['20160929']
+        self.assertEqual((entry['count'], entry['begin'], entry['end']),
+                         (2, dt_to_filetime(self.t0), dt_to_filetime(t1)))
+
+        # >>> index is written with the columns
+        self.assertEqual(ColumnArchive(self.root).partitions(
+            'au1612', 'md'), archive.partitions('au1612', 'md'))
+
+        # >>> bytes of an unfinished append are dropped by the next one
+        path = os.path.join(archive.partition_dir(
+            'au1612', 'md', '20160929'), HTf.last_price + '.bin')
+        with open(path, 'ab') as f:
+            f.write(b'\0' * 4)
+        archive.append_records([dict(later, **{
+            HTf.ex_time: t1 + timedelta(seconds=1), HTf.last_price: 310.})])
+        self.assertEqual(archive.read_day('au1612', 'md', '20160929')[
+            HTf.last_price].tolist(), [300., 300., 310.])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,202 @@
+import asyncio
+from datetime import datetime
+
+import redis.asyncio as aioredis
+
+from Athena.trade_time import is_in_trade_time
+from Athena.data_handler.data_handler import HermesDataHandler
+from Athena.data_handler.redis_wrapper import connection_kwargs
+
+__author__ = 'zed'
+
+
+class AsyncHermesDataHandler(HermesDataHandler):
+    """
+    Hermes data handler running on asyncio (redis.asyncio), for
+    distributing many instruments from one process.
+
+    distribute_data() runs three kinds of tasks:
+    * reader: receives Hermes messages of all subscribed channels, and
+        puts each into the queue of the worker of its instrument.
+    * workers: decode and filter messages, and put cleaned records into
+        the queue of writer. Instruments are assigned to _worker_count
+        workers round robin, so messages of one instrument are handled in
+        order by one worker. Workers are coroutines on the thread of the
+        event loop: they interleave with the I/O of reader and writer, but
+        decoding gets no CPU parallelism. Split instruments over several
+        processes when decoding is the bottleneck.
+    * writer: stages all records available (up to _write_batch_size) in
+        one pipeline and sends it in one round trip. When no record comes
+        for _listen_timeout seconds, it publishes the bars of sessions
+        ended by local clock. Partial chunks of packed storage are
+        appended every _storage_flush_interval seconds, and when stopped.
+
+    Queues hold at most _queue_size items, a slow writer holds workers
+    back and then the reader, instead of piling messages up in memory; a
+    slow instrument does not stall intake of the others until its queue is
+    full.
+
+    Instruments are added by add_instrument() as for HermesDataHandler,
+    history is replayed (synchronously) once channels are subscribed and
+    before live messages are distributed.
+    """
+    # number of decode workers
+    _worker_count = 4
+
+    # bound of worker and writer queues
+    _queue_size = 10000
+
+    # most records sent per round trip by writer
+    _write_batch_size = 500
+
+    def __init__(self):
+        """
+        constructor.
+        """
+        super(AsyncHermesDataHandler, self).__init__()
+
+        # channels are subscribed by the reader task
+        self.sub = None
+
+    def __connect(self, wrapper):
+        """
+        open asyncio connection to the db of wrapper.
+        :param wrapper: RedisWrapper
+        :return: redis.asyncio.Redis
+        """
+        return aioredis.Redis(**connection_kwargs(
+            wrapper.host_name, wrapper.port, wrapper.db_name))
+
+    def __shards(self):
+        """
+        assign the Hermes channels of subscribed instruments to workers.
+        :return: dict, channel (bytes) -> index of worker.
+        """
+        shards = dict()
+        for i in range(len(self.subscribed_instruments)):
+            instrument = self.subscribed_instruments[i]
+            worker = i % self._worker_count
+            shards[self._md_map[instrument].encode('utf-8')] = worker
+            if instrument in self.bar_builders:
+                continue
+            for dur in self.pub_channels['kl'][instrument]:
+                shards[self._kl_map[dur][instrument].encode('utf-8')] = \
+                    worker
+        return shards
+
+    async def __read(self, sub, shards, queues):
+        """
+        reader task.
+        :param sub: redis.asyncio PubSub, subscribed.
+        :param shards: dict, channel -> index of worker.
+        :param queues: list of asyncio.Queue, one for each worker.
+        """
+        async for message in sub.listen():
+            if message['type'] == 'message':
+                await queues[shards[message['channel']]].put(message)
+
+    async def __decode(self, queue, records):
+        """
+        decode worker task.
+        :param queue: asyncio.Queue of Hermes messages.
+        :param records: asyncio.Queue of cleaned records, to writer.
+        """
+        while True:
+            message = await queue.get()
+
+            # decode message, only trading time fields are converted
+            # before filtering.
+            try:
+                if message['channel'][:2] == b'kl':
+                    record = self.kl_decoder.decode(message['data'])
+                else:
+                    record = self.md_decoder.decode(message['data'])
+
+                update_time = record.ex_time
+                contract = record.contract
+
+            except UnicodeError:
+                # catch the unicode error.
+                print('[Data Handler]: Broken unicode sequence in '
+                      'message: {}.'.format(message))
+                continue
+
+            if is_in_trade_time(update_time, contract):
+                await records.put(record.materialize())
+
+    async def __write(self, connection, records):
+        """
+        writer task.
+        :param connection: redis.asyncio.Redis, to Athena db.
+        :param records: asyncio.Queue of cleaned records.
+        """
+        while True:
+            try:
+                batch = [await asyncio.wait_for(
+                    records.get(), self._listen_timeout)]
+            except asyncio.TimeoutError:
+                batch = []
+            while batch and len(batch) < self._write_batch_size and \
+                    not records.empty():
+                batch.append(records.get_nowait())
+
+            pipe = connection.pipeline(transaction=False)
+            staged = 0
+            for data in batch:
+                staged += self._stage(pipe, data)
+            if not batch:
+                # no record for a while, bars of ended sessions are due
+                staged += self._stage_closed_bars(pipe, datetime.now())
+            staged += self._stage_storage(pipe)
+            if staged:
+                await pipe.execute()
+
+    async def async_distribute_data(self):
+        """
+        coroutine of distribute_data.
+        :return:
+        """
+        sub_connection = self.__connect(self.sub_wrapper)
+        pub_connection = self.__connect(self.pub_wrapper)
+
+        shards = self.__shards()
+        queues = [asyncio.Queue(maxsize=self._queue_size)
+                  for i in range(self._worker_count)]
+        records = asyncio.Queue(maxsize=self._queue_size)
+
+        sub = sub_connection.pubsub()
+        await sub.subscribe(*shards.keys())
+        print('[Data Handler]: Listening to {} channels with {} '
+              'workers.'.format(len(shards), self._worker_count))
+
+        tasks = [asyncio.ensure_future(self.__read(sub, shards, queues))]
+        try:
+            # fix history, live messages are queued meanwhile.
+            await asyncio.get_running_loop().run_in_executor(
+                None, self.replay_data)
+
+            tasks.append(asyncio.ensure_future(
+                self.__write(pub_connection, records)))
+            for queue in queues:
+                tasks.append(asyncio.ensure_future(
+                    self.__decode(queue, records)))
+
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+            # partial chunks are sent when stopped
+            pipe = pub_connection.pipeline(transaction=False)
+            if self._stage_storage(pipe, force=True):
+                await pipe.execute()
+            await sub.aclose()
+            await sub_connection.aclose()
+            await pub_connection.aclose()
+
+    def distribute_data(self):
+        """
+        distribute live data of subscribed instruments, see class doc.
+        :return:
+        """
+        asyncio.run(self.async_distribute_data())
@@ -0,0 +1,135 @@
+import asyncio
+import unittest
+from datetime import datetime, timedelta
+
+from Athena.settings import AthenaConfig
+from Athena.utils import dt_to_filetime
+from Athena.data_handler.codec import decode_message
+from Athena.data_handler.async_data_handler import AsyncHermesDataHandler
+HTf = AthenaConfig.HermesTickFields
+
+__author__ = 'zed'
+
+
+def make_message(instrument, t, price):
+    """
+    make Hermes md message of instrument, as received from pubsub.
+    :return: dict
+    """
+    directory = AthenaConfig.hermes_md_mapping[instrument]
+    fields = dict([(h, '0') for h in HTf.hermes_tick_headers])
+    fields[HTf.ex_time] = fields[HTf.local_time] = str(dt_to_filetime(t))
+    fields[HTf.last_price] = str(price * 10000)
+    fields[HTf.key] = '{}:{}'.format(directory, fields[HTf.ex_time])
+    data = AthenaConfig.hermes_md_sep_char.join(
+        x for h in HTf.hermes_tick_headers for x in (h, fields[h]))
+    return {'type': 'message', 'channel': directory.encode('utf-8'),
+            'data': data.encode('utf-8')}
+
+
+class Sub(object):
+    """
+    pubsub stand-in, yields messages and counts those taken.
+    """
+    def __init__(self, messages):
+        self.messages = messages
+        self.taken = 0
+
+    async def listen(self):
+        for message in self.messages:
+            self.taken += 1
+            yield message
+
+
+class Pipeline(object):
+    """
+    asyncio pipeline stand-in, records commands, execute waits for gate.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.commands = []
+
+    async def execute(self):
+        await self.connection.gate.wait()
+        self.connection.commands += self.commands
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+        return command
+
+
+class Connection(object):
+    """
+    redis.asyncio connection stand-in.
+    """
+    def __init__(self):
+        self.gate = asyncio.Event()
+        self.commands = []
+
+    def pipeline(self, transaction=False):
+        return Pipeline(self)
+
+
+class TestAsyncDataHandler(unittest.TestCase):
+    """
+    Test tasks of asyncio data handler.
+    """
+    def test_distribute(self):
+        handler = AsyncHermesDataHandler()
+        handler._worker_count = 2
+        handler._queue_size = 1
+        handler.add_instrument('au1612', ['1m'])
+        handler.add_instrument('ag1612', ['1m'])
+
+        t0 = datetime(2016, 9, 29, 10)
+        messages = []
+        for i in range(20):
+            instrument = 'au1612' if i % 2 else 'ag1612'
+            messages.append(make_message(
+                instrument, t0 + timedelta(seconds=i), 300 + i))
+        sub = Sub(messages)
+
+        async def run():
+            connection = Connection()
+            shards = handler._AsyncHermesDataHandler__shards()
+            queues = [asyncio.Queue(maxsize=handler._queue_size)
+                      for i in range(handler._worker_count)]
+            records = asyncio.Queue(maxsize=handler._queue_size)
+
+            tasks = [
+                asyncio.ensure_future(handler._AsyncHermesDataHandler__read(
+                    sub, shards, queues)),
+                asyncio.ensure_future(handler._AsyncHermesDataHandler__write(
+                    connection, records))
+            ]
+            for queue in queues:
+                tasks.append(asyncio.ensure_future(
+                    handler._AsyncHermesDataHandler__decode(queue, records)))
+
+            # >>> a blocked writer holds workers and then reader back
+            await asyncio.sleep(0.1)
+            self.assertLess(sub.taken, 10)
+
+            connection.gate.set()
+            while records.qsize() or any(q.qsize() for q in queues) or \
+                    sub.taken < len(messages):
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.01)
+            for task in tasks:
+                task.cancel()
+            return connection.commands
+
+        commands = asyncio.run(run())
+
+        # >>> messages of each instrument are published in order
+        for instrument, first in [('ag1612', 300), ('au1612', 301)]:
+            prices = [float(decode_message(kwargs['message'])[1][
+                HTf.last_price]) for name, args, kwargs in commands
+                if name == 'publish' and kwargs['channel'] == 'md:' +
+                instrument]
+            self.assertEqual(prices, [first + 2. * i for i in range(10)])
+
+
+if __name__ == '__main__':
+    unittest.main()
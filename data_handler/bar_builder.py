@@ -0,0 +1,193 @@
+from datetime import datetime, timedelta
+
+from Athena.settings import AthenaConfig
+from Athena.trade_time import trade_calendar
+from Athena.utils import dt_to_filetime
+HTf, HKf = AthenaConfig.HermesTickFields, AthenaConfig.HermesKLineFields
+
+__author__ = 'zed'
+
+# seconds of 'clock' bars
+CLOCK_SECONDS = 3
+
+# prefix of keys of built bars, in place of Hermes directories
+BUILT_KL_PREFIX = 'kl.built.'
+
+
+class BarBuilder(object):
+    """
+    Incremental builder of bars of several durations from the ticks of one
+    instrument, in one pass.
+
+    Bars are aligned to the clock (a 5m bar spans 10:05:00 - 10:09:59.999)
+    and never span two trading sessions of trade_time: a bar is completed
+    when a tick of a later bucket or of another session arrives, by
+    close(now) once its session has ended, or by flush(). Ticks out of
+    trading sessions are ignored.
+
+    Built bars have the fields of HermesKLineFields (except count, which is
+    set on publishing): volume and turnover of a bar are differences of the
+    cumulative volume and turnover of ticks, prices and times of OHLC are
+    last prices and exchange times of ticks.
+    """
+    # fields of ticks read by update(), to be kept by decoders that keep
+    # declared fields only
+    tick_fields = (HTf.ex_time, HTf.local_time, HTf.day, HTf.exchange,
+                   HTf.last_price, HTf.volume, HTf.turnover,
+                   HTf.open_interest, HTf.average_price,
+                   HTf.pre_close_price)
+
+    def __init__(self, instrument, kline_dur_specifiers, calendar=None):
+        """
+        constructor.
+        :param instrument: string
+        :param kline_dur_specifiers: iterable of strings, like ('3s', '1m').
+        :param calendar: SessionCalendar, default is trade_calendar.
+        """
+        self.instrument = instrument
+        self.calendar = calendar or trade_calendar
+        self.durations = [(dur, self.seconds_of(dur))
+                          for dur in kline_dur_specifiers]
+
+        # dur -> bar being built, its bucket and cumulative (volume,
+        # turnover) before its first tick.
+        self.bars = dict()
+        self.buckets = dict()
+        self.bases = dict()
+
+        # cumulative (volume, turnover) of last tick
+        self.last_totals = None
+
+        # (date, index) of session of last tick, and its end
+        self.session = None
+        self.session_end = None
+
+    @staticmethod
+    def seconds_of(dur_specifier):
+        """
+        :param dur_specifier: string, like 'clock', '3s', '1m'...
+        :return: int, seconds.
+        """
+        if dur_specifier == 'clock':
+            return CLOCK_SECONDS
+        try:
+            return AthenaConfig.hermes_kl_dur_to_seconds[dur_specifier]
+        except KeyError:
+            raise ValueError('Unknown duration {}.'.format(dur_specifier))
+
+    def update(self, tick):
+        """
+        add a cleaned tick.
+        :param tick: dict, with datetime exchange time.
+        :return: list of bars completed by the tick.
+        """
+        t = tick[HTf.ex_time]
+        session = self.calendar.session_index(t, self.instrument)
+        if session < 0:
+            return []
+
+        if self.session != (t.date(), session):
+            self.session = (t.date(), session)
+            self.session_end = self.calendar.session_end(t, self.instrument)
+
+        totals = (tick.get(HTf.volume, 0), tick.get(HTf.turnover, 0))
+        if self.last_totals is None:
+            previous = totals
+        elif totals[0] < self.last_totals[0]:
+            # cumulative volume is reset on a new trading day
+            previous = (0, 0)
+        else:
+            previous = self.last_totals
+        self.last_totals = totals
+
+        seconds_of_day = t.hour * 3600 + t.minute * 60 + t.second
+        completed = []
+        for dur, seconds in self.durations:
+            bucket = (t.date(), session, seconds_of_day // seconds)
+            bar = self.bars.get(dur)
+            if bar is not None and self.buckets[dur] != bucket:
+                completed.append(bar)
+                bar = None
+
+            if bar is None:
+                bar = self.__open_bar(dur, seconds, tick, bucket)
+                self.bars[dur] = bar
+                self.buckets[dur] = bucket
+                self.bases[dur] = previous
+
+            self.__update_bar(bar, tick, totals, self.bases[dur])
+        return completed
+
+    def __open_bar(self, dur, seconds, tick, bucket):
+        """
+        :return: dict, new bar opened by tick.
+        """
+        t = tick[HTf.ex_time]
+        price = tick[HTf.last_price]
+        start = datetime(t.year, t.month, t.day) + \
+            timedelta(seconds=bucket[2] * seconds)
+
+        bar = {
+            'tag': AthenaConfig.AthenaMessageTypes.kl,
+            HKf.day: tick.get(HTf.day),
+            HKf.exchange: tick.get(HTf.exchange),
+            HKf.contract: self.instrument,
+            HKf.duration: seconds,
+            HKf.duration_specifier: dur,
+            HKf.key: '{}{}.{}:{}'.format(
+                BUILT_KL_PREFIX, self.instrument, dur, dt_to_filetime(start))
+        }
+        for field in HKf.ohlc:
+            bar[field] = price
+        for field in HKf.ohlc_time:
+            bar[field] = t
+        return bar
+
+    @staticmethod
+    def __update_bar(bar, tick, totals, base):
+        """
+        update bar by tick.
+        """
+        t = tick[HTf.ex_time]
+        price = tick[HTf.last_price]
+
+        if price > bar[HKf.high_price]:
+            bar[HKf.high_price] = price
+            bar[HKf.high_time] = t
+        if price < bar[HKf.low_price]:
+            bar[HKf.low_price] = price
+            bar[HKf.low_time] = t
+        bar[HKf.close_price] = price
+        bar[HKf.close_time] = t
+
+        bar[HKf.ex_time] = t
+        bar[HKf.local_time] = tick.get(HTf.local_time, t)
+
+        bar[HKf.total_volume], bar[HKf.total_turnover] = totals
+        bar[HKf.volume] = totals[0] - base[0]
+        bar[HKf.turnover] = totals[1] - base[1]
+        bar[HKf.open_interest] = tick.get(HTf.open_interest, 0)
+        bar[HKf.average_price] = tick.get(HTf.average_price, 0)
+        bar[HKf.pre_close_price] = tick.get(HTf.pre_close_price, 0)
+
+    def close(self, now):
+        """
+        complete the bars being built if their session has ended by now.
+        :param now: datetime, exchange time (of a later tick of any
+            instrument, or the clock).
+        :return: list of bars.
+        """
+        if not self.bars or self.session_end is None or \
+                now <= self.session_end:
+            return []
+        return self.flush()
+
+    def flush(self):
+        """
+        complete all bars being built.
+        :return: list of bars.
+        """
+        completed = [self.bars[dur] for dur, seconds in self.durations
+                     if dur in self.bars]
+        self.bars, self.buckets = dict(), dict()
+        return completed
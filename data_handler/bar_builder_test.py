@@ -0,0 +1,78 @@
+import unittest
+from datetime import datetime, timedelta
+
+from Athena.settings import AthenaConfig
+from Athena.data_handler.bar_builder import BarBuilder
+HTf, HKf = AthenaConfig.HermesTickFields, AthenaConfig.HermesKLineFields
+
+__author__ = 'zed'
+
+
+def make_tick(t, price, volume):
+    """
+    :return: dict, cleaned tick.
+    """
+    return {
+        'tag': 'md',
+        HTf.contract: 'au1612',
+        HTf.ex_time: t,
+        HTf.last_price: price,
+        HTf.volume: volume,
+        HTf.turnover: volume * 1000
+    }
+
+
+class TestBarBuilder(unittest.TestCase):
+    """
+    Test building bars from ticks.
+    """
+    def test_bars(self):
+        builder = BarBuilder('au1612', ['1m', '5m'])
+        t0 = datetime(2016, 9, 29, 10, 13)
+
+        # >>> ticks of one minute make one bar
+        bars = []
+        for i, price in enumerate([300., 302., 299., 301.]):
+            bars += builder.update(make_tick(
+                t0 + timedelta(seconds=10 * i), price, 100 + i))
+        self.assertEqual(bars, [])
+
+        bars = builder.update(make_tick(t0 + timedelta(minutes=1), 303., 110))
+        self.assertEqual(len(bars), 1)
+        bar = bars[0]
+        self.assertEqual(bar[HKf.duration_specifier], '1m')
+        self.assertEqual(
+            [bar[field] for field in HKf.ohlc], [300., 302., 299., 301.])
+        self.assertEqual(bar[HKf.low_time], t0 + timedelta(seconds=20))
+        self.assertEqual(bar[HKf.volume], 3)
+
+        # >>> bars do not span sessions, 10:15 - 10:30 break of SHFE
+        self.assertEqual(
+            builder.update(make_tick(datetime(2016, 9, 29, 10, 20), 0., 0)),
+            [])
+        bars = builder.update(
+            make_tick(datetime(2016, 9, 29, 10, 30, 5), 304., 120))
+        self.assertEqual(
+            [b[HKf.duration_specifier] for b in bars], ['1m', '5m'])
+        self.assertEqual(bars[0][HKf.volume], 7)
+        self.assertEqual(bars[1][HKf.close_price], 303.)
+        self.assertEqual(bars[1][HKf.volume], 10)
+
+        # >>> bars are completed once their session has ended
+        self.assertEqual(builder.close(datetime(2016, 9, 29, 11, 30)), [])
+        bars = builder.close(datetime(2016, 9, 29, 11, 30, 0, 1))
+        self.assertEqual(len(bars), 2)
+        self.assertEqual(bars[1][HKf.close_price], 304.)
+        self.assertEqual(builder.close(datetime(2016, 9, 29, 13, 30)), [])
+        builder.update(make_tick(datetime(2016, 9, 29, 13, 30), 305., 130))
+
+        # >>> open bars are completed on flush
+        bars = builder.flush()
+        self.assertEqual(len(bars), 2)
+        self.assertEqual(bars[0][HKf.volume], 10)
+        self.assertEqual(bars[0][HKf.turnover], 10000)
+        self.assertEqual(bars[0][HKf.close_price], 305.)
+
+
+if __name__ == '__main__':
+    unittest.main()
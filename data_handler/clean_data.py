@@ -1,12 +1,18 @@
-from datetime import datetime
-from Athena.utils import filetime_to_dt
 from Athena.settings import AthenaConfig
+from Athena.data_handler.hermes_decoder import HermesTickDecoder, \
+    HermesKLineDecoder
 
 HTf, HKf = AthenaConfig.HermesTickFields, AthenaConfig.HermesKLineFields
 
 __author__ = 'zed'
 
 
+# -------------------------------------------------------------------------
+# decoders shared by the cleaning functions.
+tick_decoder = HermesTickDecoder()
+kline_decoder = HermesKLineDecoder()
+
+
 # -------------------------------------------------------------------------
 def clean_hermes_md_data(raw, is_hash_set=False):
     """
@@ -21,42 +27,11 @@ def clean_hermes_md_data(raw, is_hash_set=False):
 
     :return:
     """
-    # convert types
     if not is_hash_set:
-        str_message = raw['data'].decode('utf-8')
-        l = str_message.split(AthenaConfig.hermes_md_sep_char)
-        d = dict(zip(l[0::2], l[1::2]))
+        record = tick_decoder.decode(raw['data'])
     else:
-        d = raw
-
-    # convert time fields to dt.
-    d[HTf.ex_time] = filetime_to_dt(
-        int(d[HTf.ex_time]))
-    d[HTf.local_time] = filetime_to_dt(
-        int(d[HTf.local_time]))
-
-    # rescale float fields
-    for field in HTf.floats:
-        d[field] = float(d[field]) / 10000
-
-    # convert integer fields
-    for field in HTf.integers:
-        d[field] = int(d[field])
-
-    # modify other fields
-    # get instrument name from key.
-    parsed_key = d[HTf.key].split(':')[0].split('.')
-    if len(parsed_key) == 3:
-        contract = parsed_key[-1]
-    elif len(parsed_key) == 4:  # Au99.99, an extra '.'
-        contract = '.'.join([parsed_key[-2], parsed_key[-1]])
-    else:
-        contract = parsed_key[-1]
-
-    d[HTf.contract] = contract
-    d['tag'] = AthenaConfig.AthenaMessageTypes.md
-
-    return d
+        record = tick_decoder.decode_hash(raw)
+    return record.materialize()
 
 
 # -------------------------------------------------------------------------
@@ -73,45 +48,11 @@ def clean_hermes_kl_data(raw, is_hash_set=False):
 
     :return:
     """
-    # convert types
     if not is_hash_set:
-        str_message = raw['data'].decode('utf-8')
-        l = str_message.split(AthenaConfig.hermes_md_sep_char)
-        d = dict(zip(l[0::2], l[1::2]))
-    else:
-        d = raw
-
-    # convert time fields to dt.
-    for field in HKf.times:
-        try:
-            d[field] = filetime_to_dt(int(d[field]))
-        except OSError:
-            d[field] = filetime_to_dt(116444736000000000)
-
-    # rescale float fields
-    for field in HKf.floats:
-        d[field] = float(d[field]) / 10000
-
-    # convert integer fields
-    for field in HKf.integers:
-        d[field] = int(d[field])
-
-    # modify other fields
-    # get instrument name from key.
-    parsed_key = d[HKf.key].split(':')[0].split('.')
-    if len(parsed_key) == 4:
-        contract = parsed_key[-2]
-    elif len(parsed_key) == 5:  # Au99.99, an extra '.'
-        contract = '.'.join([parsed_key[-3], parsed_key[-2]])
+        record = kline_decoder.decode(raw['data'])
     else:
-        contract = parsed_key[-1]
-
-    d[HKf.contract] = contract
-    d[HKf.duration_specifier] = \
-        AthenaConfig.hermes_kl_seconds_to_dur[d[HKf.duration]]
-    d['tag'] = AthenaConfig.AthenaMessageTypes.kl
-
-    return d
+        record = kline_decoder.decode_hash(raw)
+    return record.materialize()
 
 
 # -------------------------------------------------------------------------
@@ -0,0 +1,333 @@
+import json
+import struct
+import numbers
+from fnmatch import fnmatchcase
+from datetime import datetime, timedelta
+
+from Athena.settings import AthenaConfig
+
+__author__ = 'zed'
+
+EPOCH = datetime(1970, 1, 1)
+ONE_MICROSECOND = timedelta(microseconds=1)
+
+# first byte of binary frames, json messages always start with '{'
+BINARY_MAGIC = b'\xa7'
+
+# first byte of json frames of the binary codec, for records it can not
+# pack. datetime values are tagged as {DATETIME_TAG: iso format}.
+TAGGED_JSON_MAGIC = b'\xa8'
+DATETIME_TAG = '$datetime'
+
+# struct format of each type code of binary layouts
+_code_formats = {
+    'n': '',    # None, no payload
+    '?': '?',   # bool
+    'q': 'q',   # int, int64
+    'd': 'd',   # float, float64
+    't': 'q',   # datetime, int64 microseconds since epoch
+    's': 'I',   # str, byte length (bytes follow the fixed part)
+}
+
+
+class JsonCodec(object):
+    """
+    Default codec. A message is the json string of {key: data}, datetime
+    values are formatted as AthenaConfig.dt_format.
+    """
+    name = 'json'
+
+    # whether datetime values are carried as they are
+    native_datetime = False
+
+    @staticmethod
+    def __default(value):
+        """
+        serialize values that json does not support.
+        """
+        if isinstance(value, datetime):
+            return value.strftime(AthenaConfig.dt_format)
+        if isinstance(value, numbers.Integral):
+            return int(value)
+        if isinstance(value, numbers.Real):
+            return float(value)
+        raise TypeError('{} is not serializable.'.format(repr(value)))
+
+    def encode(self, key, data):
+        """
+        :param key: string, redis key of the record.
+        :param data: dict
+        :return: string
+        """
+        return json.dumps({key: data}, default=self.__default)
+
+    def decode(self, payload):
+        """
+        :param payload: bytes or string
+        :return: (key, data) tuple
+        """
+        if type(payload) == bytes:
+            payload = payload.decode('utf-8')
+        return next(iter(json.loads(payload).items()))
+
+
+class BinaryCodec(object):
+    """
+    Compact binary codec for flat dicts of None, bool, int, float, str and
+    datetime values.
+
+    A frame is:
+        magic | layout length (uint16) | layout | fixed part | strings
+    * layout: one type code per field, b'\\0', then field names joined
+        by b'\\0'. Records published on one channel share few layouts,
+        so compiled layouts are cached on both ends.
+    * fixed part: all numbers packed by one struct call, datetime values
+        are int64 microseconds since epoch (naive datetime), strings are
+        given by byte length.
+    * strings: utf-8 bytes of the key and of str values.
+
+    Records that can not be packed (nested values, huge integers, tz-aware
+    datetime...) are encoded by json instead, with datetime values tagged
+    so that they are decoded as datetime (also nested ones), consumers get
+    the same types from both. Decoders tell them apart by the first byte:
+        TAGGED_JSON_MAGIC | json of {key: data}
+    """
+    name = 'binary'
+    native_datetime = True
+
+    _layout_length = struct.Struct('<H')
+
+    def __init__(self):
+        """
+        constructor.
+        """
+        # (names, codes) -> (header, struct), for encoding
+        self.__packers = dict()
+        # layout bytes -> (names, codes, struct), for decoding
+        self.__unpackers = dict()
+
+    @staticmethod
+    def __struct_of(codes):
+        """
+        :param codes: string of type codes.
+        :return: struct.Struct, first item is byte length of key.
+        """
+        return struct.Struct(
+            '<I' + ''.join(_code_formats[c] for c in codes))
+
+    def __packer(self, names, codes):
+        """
+        compile (and cache) the header and struct of a layout.
+        """
+        layout = codes.encode('ascii') + b'\0' + \
+            b'\0'.join(name.encode('utf-8') for name in names)
+        header = BINARY_MAGIC + self._layout_length.pack(len(layout)) + layout
+        packer = header, self.__struct_of(codes)
+        self.__packers[names, codes] = packer
+        return packer
+
+    def __unpacker(self, layout):
+        """
+        compile (and cache) the names and struct of a layout.
+        """
+        codes, names = layout.split(b'\0', 1)
+        codes = codes.decode('ascii')
+        names = [name.decode('utf-8') for name in names.split(b'\0')] \
+            if codes else []
+        unpacker = names, codes, self.__struct_of(codes)
+        self.__unpackers[layout] = unpacker
+        return unpacker
+
+    @staticmethod
+    def __tag(value):
+        """
+        serialize values that json does not support, datetime are tagged.
+        """
+        if isinstance(value, datetime):
+            return {DATETIME_TAG: value.isoformat()}
+        if isinstance(value, numbers.Integral):
+            return int(value)
+        if isinstance(value, numbers.Real):
+            return float(value)
+        raise TypeError('{} is not serializable.'.format(repr(value)))
+
+    @staticmethod
+    def __untag(obj):
+        """
+        restore tagged datetime values of json frames.
+        """
+        if len(obj) == 1 and DATETIME_TAG in obj:
+            return datetime.fromisoformat(obj[DATETIME_TAG])
+        return obj
+
+    def __fallback(self, key, data):
+        """
+        encode a record that can not be packed by json, datetime tagged.
+        :return: bytes
+        """
+        return TAGGED_JSON_MAGIC + json.dumps(
+            {key: data}, default=self.__tag).encode('utf-8')
+
+    def encode(self, key, data):
+        """
+        :param key: string, redis key of the record.
+        :param data: dict
+        :return: bytes
+        """
+        key_bytes = key.encode('utf-8')
+        args = [len(key_bytes)]
+        strings = [key_bytes]
+        codes = []
+
+        for v in data.values():
+            t = type(v)
+            if t is float:
+                codes.append('d')
+                args.append(v)
+            elif t is int:
+                codes.append('q')
+                args.append(v)
+            elif t is str:
+                b = v.encode('utf-8')
+                codes.append('s')
+                args.append(len(b))
+                strings.append(b)
+            elif t is datetime and v.tzinfo is None:
+                codes.append('t')
+                args.append((v - EPOCH) // ONE_MICROSECOND)
+            elif v is None:
+                codes.append('n')
+            elif t is bool:
+                codes.append('?')
+                args.append(v)
+            elif isinstance(v, numbers.Integral):
+                # numpy integers
+                codes.append('q')
+                args.append(int(v))
+            elif isinstance(v, numbers.Real):
+                # numpy floats
+                codes.append('d')
+                args.append(float(v))
+            else:
+                return self.__fallback(key, data)
+
+        names = tuple(data)
+        codes = ''.join(codes)
+        try:
+            header, packer = self.__packers[names, codes]
+        except KeyError:
+            try:
+                header, packer = self.__packer(names, codes)
+            except AttributeError:
+                # field names are not strings
+                return self.__fallback(key, data)
+
+        try:
+            fixed = packer.pack(*args)
+        except struct.error:
+            # integers out of int64
+            return self.__fallback(key, data)
+        return header + fixed + b''.join(strings)
+
+    def decode(self, payload):
+        """
+        :param payload: bytes
+        :return: (key, data) tuple
+        """
+        if payload[:1] == TAGGED_JSON_MAGIC:
+            return next(iter(json.loads(
+                payload[1:].decode('utf-8'),
+                object_hook=self.__untag).items()))
+        if payload[:1] != BINARY_MAGIC:
+            return codecs[JsonCodec.name].decode(payload)
+
+        layout_length, = self._layout_length.unpack_from(payload, 1)
+        offset = 3 + layout_length
+        layout = payload[3:offset]
+        try:
+            names, codes, unpacker = self.__unpackers[layout]
+        except KeyError:
+            names, codes, unpacker = self.__unpacker(layout)
+
+        values = unpacker.unpack_from(payload, offset)
+        offset += unpacker.size
+
+        key_length = values[0]
+        key = payload[offset:offset + key_length].decode('utf-8')
+        offset += key_length
+
+        data = dict()
+        i = 1
+        for name, code in zip(names, codes):
+            if code == 'n':
+                data[name] = None
+                continue
+            v = values[i]
+            i += 1
+            if code == 's':
+                data[name] = payload[offset:offset + v].decode('utf-8')
+                offset += v
+            elif code == 't':
+                data[name] = EPOCH + timedelta(microseconds=v)
+            else:
+                data[name] = v
+        return key, data
+
+
+codecs = {
+    JsonCodec.name: JsonCodec(),
+    BinaryCodec.name: BinaryCodec()
+}
+
+# channel -> codec, resolved from AthenaConfig.channel_codecs
+_channel_codecs = dict()
+
+
+def get_codec(channel):
+    """
+    codec of the publishing channel. Patterns of AthenaConfig.channel_codecs
+    are matched in order, channels matching no pattern use
+    AthenaConfig.default_codec.
+    :param channel: string
+    :return: JsonCodec or BinaryCodec
+    """
+    try:
+        return _channel_codecs[channel]
+    except KeyError:
+        pass
+
+    name = AthenaConfig.default_codec
+    for pattern in AthenaConfig.channel_codecs:
+        if fnmatchcase(channel, pattern):
+            name = AthenaConfig.channel_codecs[pattern]
+            break
+
+    try:
+        codec = codecs[name]
+    except KeyError:
+        raise ValueError('Unknown codec {}.'.format(name))
+
+    _channel_codecs[channel] = codec
+    return codec
+
+
+def encode_message(channel, key, data):
+    """
+    encode a record to be published on channel.
+    :param channel: string
+    :param key: string, redis key of the record.
+    :param data: dict
+    :return: string or bytes
+    """
+    return get_codec(channel).encode(key, data)
+
+
+def decode_message(payload):
+    """
+    decode a received message, the codec is detected from the first byte.
+    :param payload: bytes
+    :return: (key, data) tuple
+    """
+    if payload[:1] in (BINARY_MAGIC, TAGGED_JSON_MAGIC):
+        return codecs[BinaryCodec.name].decode(payload)
+    return codecs[JsonCodec.name].decode(payload)
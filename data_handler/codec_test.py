@@ -0,0 +1,90 @@
+import unittest
+from datetime import datetime, timezone
+
+import numpy as np
+
+from Athena.settings import AthenaConfig
+from Athena.data_handler import codec
+from Athena.data_handler.codec import JsonCodec, BinaryCodec, \
+    BINARY_MAGIC, TAGGED_JSON_MAGIC, get_codec, encode_message, \
+    decode_message
+
+__author__ = 'zed'
+
+
+class TestCodec(unittest.TestCase):
+    """
+    Test message codecs.
+    """
+    def setUp(self):
+        """
+        :return:
+        """
+        self.key = 'md:Au(T+D):000000123'
+        self.data = {
+            'tag': 'md',
+            'contract': 'Au(T+D)',
+            'last_price': 300.12,
+            'volume': 12,
+            'ex_time': datetime(2016, 8, 2, 13, 29, 51, 500000),
+            'open_interest': None,
+            'is_new': True
+        }
+
+    def test_binary_round_trip(self):
+        binary = BinaryCodec()
+        payload = binary.encode(self.key, self.data)
+
+        # >>> frames are detected by magic byte, values keep their types
+        self.assertEqual(payload[:1], BINARY_MAGIC)
+        key, d = decode_message(payload)
+        self.assertEqual(key, self.key)
+        self.assertEqual(d, self.data)
+
+        # >>> layouts are cached, another record of the same layout
+        self.data['last_price'] = np.float64(300.5)
+        self.data['volume'] = np.int64(13)
+        key, d = binary.decode(binary.encode(self.key, self.data))
+        self.assertEqual(d['last_price'], 300.5)
+        self.assertEqual(d['volume'], 13)
+
+    def test_fallback(self):
+        # >>> records with nested values are encoded by json
+        self.data['range'] = [1, 2]
+        self.data['volume'] = np.int64(12)
+        payload = BinaryCodec().encode(self.key, self.data)
+        self.assertEqual(payload[:1], TAGGED_JSON_MAGIC)
+
+        # >>> datetime values are restored, also nested and tz-aware ones
+        key, d = decode_message(payload)
+        self.assertEqual(key, self.key)
+        self.assertEqual(d, self.data)
+        self.data['range'] = [datetime(2016, 8, 2, 13, 30,
+                                       tzinfo=timezone.utc)]
+        key, d = BinaryCodec().decode(
+            BinaryCodec().encode(self.key, self.data))
+        self.assertEqual(d['range'], self.data['range'])
+        self.assertEqual(type(d['ex_time']), datetime)
+
+        # >>> json codec formats datetime
+        key, d = decode_message(
+            JsonCodec().encode(self.key, self.data).encode('utf-8'))
+        self.assertEqual(d['ex_time'], '2016-08-02 13:29:51')
+
+    def test_channel_codecs(self):
+        channel_codecs = AthenaConfig.channel_codecs
+        AthenaConfig.channel_codecs = {'md:*': 'binary'}
+        codec._channel_codecs.clear()
+        try:
+            # >>> channels are matched by patterns, others use default
+            self.assertEqual(get_codec('md:Au(T+D)').name, 'binary')
+            self.assertEqual(get_codec('flags').name, 'json')
+            payload = encode_message('md:Au(T+D)', self.key, self.data)
+            self.assertEqual(decode_message(payload)[1], self.data)
+        finally:
+            AthenaConfig.channel_codecs = channel_codecs
+            codec._channel_codecs.clear()
+
+
+if __name__ == '__main__':
+    unittest.main()
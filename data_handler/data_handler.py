@@ -1,4 +1,3 @@
-import json
 import time
 from abc import ABCMeta, abstractmethod
 from datetime import datetime
@@ -7,8 +6,14 @@ from Athena.settings import AthenaConfig
 from Athena.trade_time import is_in_trade_time
 from Athena.utils import append_digits_suffix_for_redis_key
 from Athena.data_handler.redis_wrapper import RedisWrapper
-from Athena.data_handler.clean_data import clean_hermes_md_data, \
-    clean_hermes_kl_data, mix_hermes_md_kl_keys
+from Athena.data_handler.replay import merge_hermes_channels, \
+    PrefetchReader, ReplayClock
+from Athena.data_handler.hermes_decoder import HermesTickDecoder, \
+    HermesKLineDecoder
+from Athena.data_handler.bar_builder import BarBuilder
+from Athena.data_handler.codec import get_codec, encode_message
+from Athena.data_handler.transport import make_transport
+from Athena.data_handler.packed_store import PackedStore
 
 HTf, HKf = AthenaConfig.HermesTickFields, AthenaConfig.HermesKLineFields
 
@@ -81,6 +86,39 @@ class HermesDataHandler(DataHandler):
     * _replay_interval: the interval between iterations of hist data replay
         1/interval is replaying frequency. (# data records in 1 second)
 
+    * _replay_speed/_replay_max_gap: replay in scaled real time, driven by
+        exchange time of rows (see replay.ReplayClock). Speed None replays
+        as fast as possible (or stepped by _replay_interval if set), event
+        time gaps longer than _replay_max_gap seconds are shortened.
+
+    * _replay_batch_size: number of historical rows fetched per round trip
+        on replaying. Next batch is fetched in background while current
+        batch is being published.
+
+    * _publish_batch_size/_publish_batch_interval: all redis writes of
+        published messages are staged in one pipeline (pub_pipe). The
+        pipeline is sent to redis when _publish_batch_size messages are
+        staged, or when the oldest staged message has waited
+        _publish_batch_interval seconds (checked on arrival of the next
+        message, and by the live loop while no message arrives). The
+        default batch size 1 sends each message in a single round trip;
+        larger batches are meant for replaying.
+
+    * _md_fields/_kl_fields: fields of md and kl that consumers need.
+        Hermes messages are decoded by precompiled decoders (md_decoder,
+        kl_decoder) and only these fields are converted and published.
+        Default is None, all fields. Ticks of instruments added with
+        build_kline=True also keep the fields bars are built from
+        (BarBuilder.tick_fields).
+
+    * messages are encoded by the codec of each publishing channel, see
+        AthenaConfig.default_codec and AthenaConfig.channel_codecs. With
+        binary codec, datetime fields are published as they are.
+
+    * _transport: transport of published messages, 'pubsub', 'stream' or
+        'shm' (see transport.make_transport). Default is
+        AthenaConfig.transport.
+
     public attributes:
     ----------------
     * subscribed_instruments: list of subscribed instruments.
@@ -133,14 +171,49 @@ class HermesDataHandler(DataHandler):
         indices of data records in Athena db. The counters dict has same
         hierarchies as pub_channels dict.
 
+    * bar_builders: dict, instrument -> BarBuilder. Bars of instruments
+        added with build_kline=True are built from their md ticks and
+        published on the same kl channels, Hermes k-lines are not
+        subscribed. Bars of every builder are completed at the end of
+        their trading session, checked on each tick and, while no message
+        arrives, every _listen_timeout seconds of the live loop.
+
+    * packed_store: PackedStore, with _storage (or AthenaConfig.storage)
+        'packed', md and kl records are appended to it in place of hash
+        sets. Plotting records and the current records are still hash sets.
+        Packed records are not in the time indices of get_range, they are
+        read by time range from the chunk index (PackedStore.read_range).
+        Partial chunks are appended every _storage_flush_interval seconds
+        by the live loop, and when it stops.
+
+    * clock: ReplayClock of current replaying, clock.now is the simulated
+        time. It is also written to AthenaConfig.redis_replay_clock_key in
+        Athena db on every flush of publishing pipeline.
+
     protected methods:
     ----------------
     * __subscribe(self): Implements abstract method of data handler interface.
 
     * __publish(self): Implements abstract method of data handler interface.
 
+    * _stage(self, pipe, data): stage the writes of one message in a
+        pipeline, shared with AsyncHermesDataHandler. Records of md, kl and
+        plotting channels are added to time indices of their channels,
+        scored by exchange time (see RedisWrapper.get_range).
+
     public methods:
     ----------------
+    * flush(self): send staged writes in the publishing pipeline to redis.
+
+    * flush_bars(self): publish bars being built from ticks.
+
+    * close_bars(self, now): publish bars of sessions ended by now.
+
+    * flush_storage(self): append partial chunks of packed storage.
+
+    * distribute_data(self): distribute live data of subscribed
+        instruments, until interrupted.
+
     * add_instrument(self, instrument): public wrapper of subscribe protected
         method. Let the sub connection wrapper listen to the specified
         instrument.
@@ -158,6 +231,34 @@ class HermesDataHandler(DataHandler):
     # replaying time interval
     _replay_interval = 0
 
+    # replaying speed (multiple of real time), longest gap (seconds)
+    _replay_speed = None
+    _replay_max_gap = None
+
+    # number of rows fetched per round trip on replaying
+    _replay_batch_size = 1000
+
+    # publishing pipeline batch, (# messages, seconds)
+    _publish_batch_size = 1
+    _publish_batch_interval = 0.05
+
+    # longest wait of live loop for a message, before timed tasks run
+    _listen_timeout = 1
+
+    # md/kl fields needed by consumers, None for all fields.
+    _md_fields = None
+    _kl_fields = None
+
+    # transport of published messages, None for AthenaConfig.transport
+    _transport = None
+
+    # storage of published records, None for AthenaConfig.storage
+    _storage = None
+
+    # seconds between appends of partial chunks of packed storage by the
+    # live loop
+    _storage_flush_interval = 10
+
     def __init__(self):
         """
         constructor.
@@ -170,6 +271,27 @@ class HermesDataHandler(DataHandler):
         # create a listener
         self.sub = self.sub_wrapper.connection.pubsub()
 
+        # decoders of hermes messages
+        self.md_decoder = HermesTickDecoder(fields=self._md_fields)
+        self.kl_decoder = HermesKLineDecoder(fields=self._kl_fields)
+
+        # transport of published messages (pub/sub or streams)
+        self.transport = make_transport(self.pub_wrapper, self._transport)
+
+        # packed storage of md and kl records, None for hash sets
+        self.packed_store = None
+        if (self._storage or AthenaConfig.storage) == 'packed':
+            self.packed_store = PackedStore(self.pub_wrapper)
+        self.last_storage_flush_time = time.time()
+
+        # pipeline that stages the writes of published messages
+        self.pub_pipe = self.pub_wrapper.pipeline()
+        self.pub_pending = 0
+        self.last_flush_time = time.time()
+
+        # replay clock, set on replaying
+        self.clock = None
+
         # prepare subscribe/publishing list
         self.subscribed_instruments = []
         self.pub_channels = {
@@ -184,22 +306,58 @@ class HermesDataHandler(DataHandler):
             'kl': dict()
         }
 
+        # instrument -> BarBuilder, of instruments whose bars are built
+        # from ticks.
+        self.bar_builders = dict()
+
     def __subscribe(self, channels):
         """
 
         :return:
         """
-        self.sub.subscribe(channels)
+        # no listener, channels are subscribed by subclass.
+        if self.sub is not None:
+            self.sub.subscribe(channels)
 
     def __publish(self, data):
         """
         publish (cleaned) data into redis db.
+        All writes of one message are staged in the publishing pipeline,
+        which is flushed by flush() once the batch size or the batch
+        interval is reached.
         :param data:
         :return:
         """
+        if not self._stage(self.pub_pipe, data):
+            return 0
+
+        # flush the pipeline if batch is full or has waited long enough.
+        self.pub_pending += 1
+        if self.pub_pending >= self._publish_batch_size or \
+                time.time() - self.last_flush_time \
+                >= self._publish_batch_interval:
+            self.flush()
+        return 1
+
+    def _stage(self, pipe, data):
+        """
+        stage all writes of one (cleaned) message in pipe: hash sets,
+        published messages and the current record.
+        :param pipe: redis pipeline.
+        :param data: dict
+        :return: int, 1 if staged, 0 if data is of unknown type.
+        """
         # If data is of type md:
         if data['tag'] == AthenaConfig.AthenaMessageTypes.md:
 
+            # bars of ended sessions and bars completed by this tick come
+            # before it
+            self._stage_closed_bars(pipe, data[HTf.ex_time])
+            builder = self.bar_builders.get(data[HTf.contract])
+            if builder is not None:
+                for bar in builder.update(data):
+                    self._stage(pipe, bar)
+
             # find instrument and map to pub channel
             this_instrument = data[HTf.contract]
             pub_channel = self.pub_channels['md'][this_instrument]
@@ -210,30 +368,35 @@ class HermesDataHandler(DataHandler):
                 counter=self.counters['md'][this_instrument]
             )
 
-            # publish dict data
-            self.pub_wrapper.set_dict(athena_unique_key, data)
+            # publish dict data, indexed by exchange time
+            if self.packed_store is not None:
+                self.packed_store.append(pub_channel, data, pipe)
+            else:
+                score = self.pub_wrapper.index_score(data[HTf.ex_time])
+                self.pub_wrapper.set_indexed_dict(
+                    pub_channel, athena_unique_key, data, score, pipe)
 
             # publish str message
-            # first serialize datetime fields (ex and local time)
-            data[HTf.ex_time] = data[HTf.ex_time].strftime(
-                AthenaConfig.dt_format)
-            data[HTf.local_time] = data[HTf.local_time].strftime(
-                AthenaConfig.dt_format)
-
-            message = json.dumps({athena_unique_key: data})
-            self.pub_wrapper.connection.publish(
-                channel=pub_channel,
-                message=message
-            )
+            # first serialize datetime fields (ex and local time), unless
+            # the codec of channel carries datetime.
+            codec = get_codec(pub_channel)
+            if not codec.native_datetime:
+                data[HTf.ex_time] = data[HTf.ex_time].strftime(
+                    AthenaConfig.dt_format)
+                data[HTf.local_time] = data[HTf.local_time].strftime(
+                    AthenaConfig.dt_format)
+
+            message = codec.encode(athena_unique_key, data)
+            self.transport.publish(pub_channel, message, pipe)
 
             # update the one record for storing last md
             # note that this 'current' can only be retrieved subjectively
             athena_unique_key_current = str(pub_channel) + ':0'
-            self.pub_wrapper.set_dict(athena_unique_key_current, data)
+            pipe.hmset(athena_unique_key_current,
+                       self.pub_wrapper.hash_values(data))
 
             # increment to counter
             self.counters['md'][this_instrument] += 1
-            return 1
 
         # If data is of type kline
         elif data['tag'] == AthenaConfig.AthenaMessageTypes.kl:
@@ -255,29 +418,33 @@ class HermesDataHandler(DataHandler):
                 self.counters['kl'][this_instrument][dur_specifier]
             )
 
-            # publish dict data
-            self.pub_wrapper.set_dict(athena_unique_key, data)
+            # publish dict data, indexed by exchange time
+            score = self.pub_wrapper.index_score(data[HKf.ex_time])
+            if self.packed_store is not None:
+                self.packed_store.append(pub_channel, data, pipe)
+            else:
+                self.pub_wrapper.set_indexed_dict(
+                    pub_channel, athena_unique_key, data, score, pipe)
 
             # publish str message
             # first serialize datetime fields (ex_open, open and close time)
-            for field in HKf.times:
-                if type(data[field]) == datetime:
-                    data[field] = data[field].strftime(
-                        AthenaConfig.dt_format)
-
-            message = json.dumps({athena_unique_key: data})
-            self.pub_wrapper.connection.publish(
-                channel=pub_channel,
-                message=message
-            )
-
-            # publish plotting message
-            if type(self.pub_channels['kl_plot']
-                    [this_instrument][dur_specifier]) == str:
-                pub_channel_plot = \
-                    self.pub_channels['kl_plot'][
-                        this_instrument][dur_specifier]
-
+            codec = get_codec(pub_channel)
+            if not codec.native_datetime:
+                for field in HKf.times:
+                    if type(data[field]) == datetime:
+                        data[field] = data[field].strftime(
+                            AthenaConfig.dt_format)
+
+            message = codec.encode(athena_unique_key, data)
+            self.transport.publish(pub_channel, message, pipe)
+
+            # publish plotting message(s), one for each plot duplicate.
+            plot_channels = \
+                self.pub_channels['kl_plot'][this_instrument][dur_specifier]
+            if type(plot_channels) == str:
+                plot_channels = [plot_channels]
+
+            for pub_channel_plot in plot_channels:
                 # map to new key in Athena db (plotting)
                 athena_unique_key_plotting = \
                     append_digits_suffix_for_redis_key(
@@ -287,65 +454,124 @@ class HermesDataHandler(DataHandler):
                     )
 
                 # publish plotting (dict) data
-                self.pub_wrapper.set_dict(
-                    athena_unique_key_plotting, data)
+                self.pub_wrapper.set_indexed_dict(
+                    pub_channel_plot, athena_unique_key_plotting, data,
+                    score, pipe)
 
                 # publish plotting str message.
-                plot_message = json.dumps(
-                    {athena_unique_key_plotting: data}
-                )
-                self.pub_wrapper.connection.publish(
-                    channel=pub_channel_plot,
-                    message=plot_message
+                plot_message = encode_message(
+                    pub_channel_plot, athena_unique_key_plotting, data
                 )
+                self.transport.publish(pub_channel_plot, plot_message, pipe)
 
-            elif type(self.pub_channels['kl_plot'][
-                        this_instrument][dur_specifier]) == list:
+            # update the one record for storing last kl
+            athena_unique_key_current = str(pub_channel) + ':0'
+            pipe.hmset(athena_unique_key_current,
+                       self.pub_wrapper.hash_values(data))
 
-                for i in range(len(self.pub_channels['kl_plot'][
-                        this_instrument][dur_specifier])):
+            # increment to counter
+            self.counters['kl'][this_instrument][dur_specifier] += 1
 
-                    pub_channel_plot = \
-                        self.pub_channels['kl_plot'][
-                            this_instrument][dur_specifier][i]
+        else:
+            return 0
 
-                    # map to new key in Athena db (plotting)
-                    athena_unique_key_plotting = \
-                        append_digits_suffix_for_redis_key(
-                            prefix=pub_channel_plot,
-                            counter=self.counters['kl'][
-                                this_instrument][dur_specifier]
-                        )
+        return 1
 
-                    # publish plotting (dict) data
-                    self.pub_wrapper.set_dict(
-                        athena_unique_key_plotting, data)
+    def flush(self):
+        """
+        send all staged writes in publishing pipeline to redis in one
+        round trip.
+        :return: int, number of messages flushed.
+        """
+        flushed = self.pub_pending
+        if flushed:
+            # share simulated time of replaying
+            if self.clock is not None and self.clock.now is not None:
+                self.pub_pipe.set(
+                    AthenaConfig.redis_replay_clock_key,
+                    self.clock.now.strftime(AthenaConfig.dt_format)
+                )
+            self.pub_pipe.execute()
+            self.pub_pending = 0
+        self.last_flush_time = time.time()
+        return flushed
 
-                    # publish plotting str message.
-                    plot_message = json.dumps(
-                        {athena_unique_key_plotting: data}
-                    )
-                    self.pub_wrapper.connection.publish(
-                        channel=pub_channel_plot,
-                        message=plot_message
-                    )
+    def flush_bars(self):
+        """
+        publish bars being built from ticks, and send them to redis.
+        :return: int, number of bars published.
+        """
+        count = 0
+        for builder in self.bar_builders.values():
+            for bar in builder.flush():
+                count += self.__publish(bar)
+        self.flush()
+        return count
+
+    def _stage_closed_bars(self, pipe, now):
+        """
+        stage the bars of every builder whose session has ended by now.
+        :param pipe: redis pipeline.
+        :param now: datetime, exchange time.
+        :return: int, number of bars staged.
+        """
+        count = 0
+        for builder in self.bar_builders.values():
+            for bar in builder.close(now):
+                count += self._stage(pipe, bar)
+        return count
 
-            # update the one record for storing last kl
-            athena_unique_key_current = str(pub_channel) + ':0'
-            self.pub_wrapper.set_dict(athena_unique_key_current, data)
+    def close_bars(self, now):
+        """
+        publish bars of sessions that have ended by now, and send them to
+        redis.
+        :param now: datetime, exchange time.
+        :return: int, number of bars published.
+        """
+        count = self._stage_closed_bars(self.pub_pipe, now)
+        if count:
+            self.pub_pending += count
+            self.flush()
+        return count
 
-            # increment to counter
-            self.counters['kl'][this_instrument][dur_specifier] += 1
-            return 1
+    def _stage_storage(self, pipe, force=False):
+        """
+        stage partial chunks of packed storage, if _storage_flush_interval
+        has passed since they were last staged.
+        :param pipe: redis pipeline.
+        :param force: bool, stage them regardless of the interval.
+        :return: int, number of records staged.
+        """
+        if self.packed_store is None or not force and \
+                time.time() - self.last_storage_flush_time \
+                < self._storage_flush_interval:
+            return 0
+        self.last_storage_flush_time = time.time()
+        return self.packed_store.flush(pipe)
+
+    def flush_storage(self, force=True):
+        """
+        append partial chunks of packed storage, and send them to redis.
+        :param force: bool, False to skip if appended less than
+            _storage_flush_interval seconds ago.
+        :return: int, number of records appended.
+        """
+        count = self._stage_storage(self.pub_pipe, force)
+        if count:
+            self.pub_pending += count
+            self.flush()
+        return count
 
     def add_instrument(self, instrument, kline_dur_specifiers,
-                       duplicate=1):
+                       duplicate=1, build_kline=False):
         """
         Begin to listen to one single instrument.
         :param instrument: string
         :param duplicate:
         :param kline_dur_specifiers: tuple of strings.
             Default is ('1m'), subscribe 1 minute kline only.
+        :param build_kline: bool, build bars from md ticks (see
+            bar_builder.BarBuilder) instead of subscribing Hermes k-lines.
         :return:
         """
         # if the instrument already subscribed
@@ -362,8 +588,14 @@ class HermesDataHandler(DataHandler):
         # otherwise
         channels = [HermesDataHandler._md_map[instrument]]
 
-        for dur in kline_dur_specifiers:
-            channels.append(HermesDataHandler._kl_map[dur][instrument])
+        if build_kline:
+            self.bar_builders[instrument] = BarBuilder(
+                instrument, kline_dur_specifiers)
+            # ticks keep the fields of bars, whatever _md_fields declares
+            self.md_decoder.require(BarBuilder.tick_fields)
+        else:
+            for dur in kline_dur_specifiers:
+                channels.append(HermesDataHandler._kl_map[dur][instrument])
 
         # subscribe to channels
         self.__subscribe(channels)
@@ -398,91 +630,96 @@ class HermesDataHandler(DataHandler):
                     clean_up=True,
                     attach_end_flag=False):
         """
-
-        :param kline_dur_specifier:
+        replay the data cached in Hermes db of subscribed instruments.
+        Keys of each Hermes directory are scanned and merged in time
+        order as a stream, see replay.merge_hermes_channels.
         :param clean_up:
         :param attach_end_flag:
         :return:
         """
         start_time = time.time()
 
-        md_keys_to_mix = dict()
-        kl_keys_to_mix = dict()
+        # replay clock
+        self.clock = ReplayClock(
+            speed=self._replay_speed,
+            step=self._replay_interval,
+            max_gap=self._replay_max_gap
+        )
 
+        # Hermes cached directories, md first on ties of time.
+        md_directories = []
+        kl_directories = []
         for inst in self.subscribed_instruments:
-            # Hermes cached directory for md
-            md_dir = HermesDataHandler._md_map[inst]
-            # retrieve md keys
-            md_keys = self.sub_wrapper.get_keys('{}:*'.format(md_dir))
-            md_keys_to_mix[inst] = md_keys
-
-            kl_keys_to_mix[inst] = dict()
+            md_directories.append(HermesDataHandler._md_map[inst])
+            if inst in self.bar_builders:
+                continue
             for dur in self.pub_channels['kl'][inst]:
-                # Hermes cached directory for kl
-                kl_dir = HermesDataHandler._kl_map[dur][inst]
-                # retrieve kl keys
-                kl_keys = self.sub_wrapper.get_keys('{}:*'.format(kl_dir))
-                kl_keys_to_mix[inst][dur] = kl_keys
-
-        # sort the keys
-        sorted_keys = mix_hermes_md_kl_keys(
-            md_keys_to_mix, kl_keys_to_mix
+                kl_directories.append(HermesDataHandler._kl_map[dur][inst])
+
+        # stream of keys in time order
+        sorted_keys = merge_hermes_channels(
+            self.sub_wrapper, md_directories + kl_directories
         )
 
         # flush Athena db
         if clean_up:
             self.pub_wrapper.flush_db()
 
-        num_keys = len(sorted_keys)
-
-        # pop row from historical data stream
-        for k in sorted_keys:
-            try:
-                row = self.sub_wrapper.get_dict(k)
-            except UnicodeError:
-                print('[Data Handler]: Unicode error at key {}.'.format(k))
-                continue
-
-            # contract name
-            if b'md' in k:
+        num_keys = 0
+
+        # pop row from historical data stream, rows are fetched in
+        # batches ahead of publishing.
+        reader = PrefetchReader(self.sub_wrapper, sorted_keys,
+                                batch_size=self._replay_batch_size)
+        try:
+            for k, row in reader:
+                num_keys += 1
+                if row is None:
+                    print('[Data Handler]: Unicode error at key {}.'.format(k))
+                    continue
 
-                # clean data (hash set)
-                cleaned_row = clean_hermes_md_data(row, is_hash_set=True)
-                update_time = cleaned_row[HTf.ex_time]
-                contract = cleaned_row[HTf.contract]
+                # decode hash set, only trading time fields are converted
+                # before filtering.
+                if b'md' in k:
+                    record = self.md_decoder.decode_hash(row, k.decode('utf8'))
+                elif b'kl' in k:
+                    record = self.kl_decoder.decode_hash(row, k.decode('utf8'))
+                else:
+                    print(k)
+                    raise ValueError
 
-            elif b'kl' in k:
-                # clean data (hash set)
                 try:
-                    cleaned_row = clean_hermes_kl_data(row, is_hash_set=True)
+                    if is_in_trade_time(record.ex_time, record.contract):
+                        # wait until the row is due on replay clock,
+                        # staged messages are sent before waiting.
+                        delay = self.clock.advance(record.ex_time)
+                        if delay:
+                            self.flush()
+                            time.sleep(delay)
+
+                        # publish data
+                        self.__publish(record.materialize())
                 except OSError:
-                    continue
-                update_time = cleaned_row[HKf.ex_time]
-                contract = cleaned_row[HKf.contract]
+                    print('[Data Handler]: Illegal value at key {}.'.format(k))
+        finally:
+            reader.close()
 
-            else:
-                print(k)
-                raise ValueError
-
-            if is_in_trade_time(update_time, contract):
-                # publish data
-                self.__publish(cleaned_row)
-
-            if self._replay_interval:
-                time.sleep(self._replay_interval)
+        # send the rest of staged messages
+        self.flush()
+        self.clock = None
 
         if attach_end_flag:
+            # bars being built are complete at the end of data
+            self.flush_bars()
+            self.flush_storage()
             time.sleep(1)
             # publish end flag
             end_flag = {
                 'tag': 'flag',
                 'type':'flag_0'
             }
-            end_message = json.dumps({'flags:0': end_flag})
-            self.pub_wrapper.connection.publish(
-                channel='flags',
-                message=end_message
-            )
+            end_message = encode_message('flags', 'flags:0', end_flag)
+            self.transport.publish('flags', end_message)
 
         # end of replaying, show a statistic
         end_time = time.time()
@@ -491,42 +728,60 @@ class HermesDataHandler(DataHandler):
                 num_keys, end_time - start_time)
         )
 
+    def __on_timer(self):
+        """
+        tasks of live loop run every _listen_timeout seconds: bars of
+        sessions ended by local clock are published, partial chunks of
+        packed storage are appended every _storage_flush_interval seconds.
+        """
+        self.close_bars(datetime.now())
+        self.flush_storage(force=False)
+
     def distribute_data(self):
         """
 
         :return:
         """
         fixed_history = False
-        for message in self.sub.listen():
-            if message['type'] == 'message':
+        last_timer = time.time()
+        try:
+            while True:
+                # wake up in time to send staged messages
+                timeout = self._listen_timeout
+                if self.pub_pending:
+                    timeout = min(timeout, max(
+                        0, self._publish_batch_interval -
+                        (time.time() - self.last_flush_time)))
+                message = self.sub.get_message(timeout=timeout)
+
+                # staged messages that have waited long enough are sent
+                if self.pub_pending and time.time() - self.last_flush_time \
+                        >= self._publish_batch_interval:
+                    self.flush()
+
+                # timed tasks, also while messages are filtered out
+                if time.time() - last_timer >= self._listen_timeout:
+                    self.__on_timer()
+                    last_timer = time.time()
+
+                if message is None or message['type'] != 'message':
+                    continue
 
                 # fix history
                 if not fixed_history:
                     self.replay_data()
                     fixed_history = True
 
-                # clean data
+                # decode message, only trading time fields are converted
+                # before filtering.
                 try:
-                    # decompress message to dict
-                    str_message = message['data'].decode('utf-8')
-                    l = str_message.split(AthenaConfig.hermes_md_sep_char)
-                    d = dict(zip(l[0::2], l[1::2]))
-
-                    if HKf.close_time in d:
-                        # clean kl data
-                        cleaned_data = clean_hermes_kl_data(
-                            d, is_hash_set=True)
-                        update_time = cleaned_data[HKf.ex_time]
-                        contract = cleaned_data[HKf.contract]
-
-                    elif HTf.bid_vol_1 in d:
-                        # clean tick data
-                        cleaned_data = clean_hermes_md_data(
-                            d, is_hash_set=True)
-                        update_time = cleaned_data[HTf.ex_time]
-                        contract = cleaned_data[HTf.contract]
-
-                    else: raise ValueError
+                    if message['channel'][:2] == b'kl':
+                        record = self.kl_decoder.decode(message['data'])
+                    else:
+                        record = self.md_decoder.decode(message['data'])
+
+                    update_time = record.ex_time
+                    contract = record.contract
 
                 except UnicodeError:
                     # catch the unicode error.
@@ -535,5 +790,8 @@ class HermesDataHandler(DataHandler):
                     continue
 
                 if is_in_trade_time(update_time, contract):
-                    self.__publish(cleaned_data)
-
+                    self.__publish(record.materialize())
+        finally:
+            # partial chunks and staged messages are sent when stopped
+            self.flush_storage()
+            self.flush()
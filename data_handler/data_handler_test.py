@@ -0,0 +1,143 @@
+import time
+import unittest
+from datetime import datetime, timedelta
+
+from Athena.settings import AthenaConfig
+from Athena.data_handler import codec
+from Athena.data_handler.codec import decode_message
+from Athena.data_handler.data_handler import HermesDataHandler
+from Athena.data_handler.packed_store import PackedStore
+from Athena.data_handler.packed_store_test import Wrapper
+from Athena.data_handler.async_data_handler_test import make_message
+HTf, HKf = AthenaConfig.HermesTickFields, AthenaConfig.HermesKLineFields
+
+__author__ = 'zed'
+
+
+class Sub(object):
+    """
+    pubsub stand-in, nothing arrives until the loop is interrupted.
+    """
+    def __init__(self, count):
+        self.count = count
+
+    def get_message(self, timeout=None):
+        self.count -= 1
+        if self.count < 0:
+            raise KeyboardInterrupt
+        return None
+
+
+class Pipeline(object):
+    """
+    redis pipeline stand-in, records commands.
+    """
+    def __init__(self):
+        self.commands = []
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+        return command
+
+
+class TestDataHandler(unittest.TestCase):
+    """
+    Test staging and timed tasks of the live loop of data handler.
+    """
+    def test_stage_hashes(self):
+        channel_codecs = AthenaConfig.channel_codecs
+        AthenaConfig.channel_codecs = {'md:*': 'binary'}
+        codec._channel_codecs.clear()
+        try:
+            handler = HermesDataHandler()
+            handler.sub = None
+            handler.add_instrument('au1612', ['1m'])
+            message = make_message('au1612', datetime(2016, 9, 29, 10), 300)
+            record = handler.md_decoder.decode(message['data']).materialize()
+            record[HTf.open_interest] = None
+            pipe = Pipeline()
+            self.assertEqual(handler._stage(pipe, record), 1)
+        finally:
+            AthenaConfig.channel_codecs = channel_codecs
+            codec._channel_codecs.clear()
+
+        # >>> messages of binary channels carry datetime
+        published = [kwargs['message'] for name, args, kwargs
+                     in pipe.commands if name == 'publish']
+        data = decode_message(published[0])[1]
+        self.assertEqual(data[HTf.ex_time], datetime(2016, 9, 29, 10))
+
+        # >>> hash sets are stored as strings and numbers regardless
+        hashes = [args for name, args, kwargs in pipe.commands
+                  if name == 'hmset']
+        self.assertEqual([key for key, values in hashes],
+                         ['md:au1612:000000000', 'md:au1612:0'])
+        for key, values in hashes:
+            self.assertEqual(values[HTf.ex_time], '2016-09-29 10:00:00')
+            self.assertEqual(values[HTf.open_interest], '')
+            for value in values.values():
+                self.assertIn(type(value), (str, int, float))
+
+    def test_bar_fields(self):
+        class PriceHandler(HermesDataHandler):
+            _md_fields = [HTf.last_price]
+
+        handler = PriceHandler()
+        handler.sub = None
+        handler.add_instrument('au1612', ['1m'], build_kline=True)
+        t0 = datetime(2016, 9, 29, 10)
+        ticks = []
+        for i in range(3):
+            message = make_message('au1612', t0 + timedelta(seconds=30 * i),
+                                   300 + i)
+            ticks.append(handler.md_decoder.decode(
+                message['data']).materialize())
+            ticks[-1][HTf.volume] = 10 * i
+
+        # >>> declared fields are extended by the fields of bars
+        self.assertIn(HTf.turnover, ticks[0])
+        self.assertIn(HTf.open_interest, ticks[0])
+        self.assertNotIn(HTf.bid_vol_1, ticks[0])
+
+        builder = handler.bar_builders['au1612']
+        bars = [bar for tick in ticks for bar in builder.update(tick)]
+        self.assertEqual(len(bars), 1)
+        self.assertEqual(bars[0][HKf.volume], 10)
+        self.assertEqual(bars[0][HKf.close_price], 301.)
+
+    def test_flush_storage(self):
+        handler = HermesDataHandler()
+        wrapper = Wrapper()
+        handler.packed_store = PackedStore(wrapper, chunk_size=4)
+        handler.pub_pipe = wrapper.connection
+        handler._listen_timeout = 0
+        chunks = wrapper.connection.lists
+
+        t0 = datetime(2016, 9, 29, 9, 30)
+        for i in range(5):
+            handler.packed_store.append('md:au1612', {
+                'tag': 'md', HTf.ex_time: t0 + timedelta(seconds=i)})
+        key = PackedStore.chunks_key('md:au1612')
+        self.assertEqual(len(chunks[key]), 1)
+
+        # >>> partial chunks are appended by the timer once due
+        handler._HermesDataHandler__on_timer()
+        self.assertEqual(len(chunks[key]), 1)
+        handler.last_storage_flush_time = \
+            time.time() - handler._storage_flush_interval
+        handler._HermesDataHandler__on_timer()
+        self.assertEqual(len(chunks[key]), 2)
+
+        # >>> and when the live loop stops
+        handler.packed_store.append('md:au1612', {
+            'tag': 'md', HTf.ex_time: t0 + timedelta(seconds=5)})
+        handler.sub = Sub(3)
+        self.assertRaises(KeyboardInterrupt, handler.distribute_data)
+        self.assertEqual(len(chunks[key]), 3)
+        self.assertEqual(len(handler.packed_store.read_range(
+            'md:au1612', t0)[HTf.ex_time]), 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -83,14 +83,16 @@ class HermesPipe(object):
                         zip(list_message[0::2], list_message[1::2])
                     )
 
-                    # publish dict data to local redis.
-                    self.local_redis.set_dict(
-                        key=athena_unique_key,
-                        data=dict_data
+                    # publish dict data to local redis, indexed by the
+                    # time suffix of key for replaying.
+                    pub_channel, _, suffix = athena_unique_key.rpartition(
+                        ':')
+                    self.local_redis.set_indexed_dict(
+                        pub_channel, athena_unique_key, dict_data,
+                        int(suffix)
                     )
 
                     # publish str data
-                    pub_channel = athena_unique_key.split(':')[0]
                     self.local_redis.connection.publish(
                         channel=pub_channel,
                         message=str_message
@@ -98,4 +100,8 @@ class HermesPipe(object):
                 except UnicodeError:
                     print('[Data Handler]: Unicode error at {}'.format(
                         message
+                    ))
+                except ValueError:
+                    print('[Data Pipe]: Illegal key in {}'.format(
+                        message
                     ))
\ No newline at end of file
@@ -0,0 +1,335 @@
+from Athena.utils import filetime_to_dt, EPOCH_AS_FILETIME
+from Athena.settings import AthenaConfig
+
+HTf, HKf = AthenaConfig.HermesTickFields, AthenaConfig.HermesKLineFields
+
+__author__ = 'zed'
+
+
+# -------------------------------------------------------------------------
+def _scaled_float(raw):
+    """hermes prices are integers scaled by 10000."""
+    return float(raw) / 10000
+
+
+def _filetime(raw):
+    """filetime string to datetime."""
+    return filetime_to_dt(int(raw))
+
+
+def _safe_filetime(raw):
+    """filetime string to datetime, illegal time is mapped to epoch."""
+    try:
+        return filetime_to_dt(int(raw))
+    except OSError:
+        return filetime_to_dt(EPOCH_AS_FILETIME)
+
+
+# -------------------------------------------------------------------------
+class HermesRecord(object):
+    """
+    One decoded Hermes message. The raw values are kept as received and
+    every field is converted on its first access only, so that messages
+    rejected by filters (trade time, etc.) never pay for the conversion of
+    the whole order book.
+
+    Fields are read like a dictionary, record[HTf.ex_time].
+    materialize() converts the declared fields and returns a plain dict,
+    which is what the publishers expect.
+    """
+    __slots__ = ('_decoder', '_values', '_index', '_cache')
+
+    def __init__(self, decoder, values, index):
+        """
+        constructor.
+        :param decoder: HermesDecoder, the decoder made this record.
+        :param values: list of raw values (index is a dict), or the raw
+            dictionary itself (index is None).
+        :param index: dict, field -> position in values.
+        """
+        self._decoder = decoder
+        self._values = values
+        self._index = index
+        self._cache = dict()
+
+    def raw(self, field):
+        """
+        get raw (unconverted) value of field.
+        :param field: string
+        :return: string
+        """
+        if self._index is None:
+            return self._values[field]
+        return self._values[self._index[field]]
+
+    def raw_fields(self):
+        """
+        list the fields carried by the raw message.
+        :return: iterable of strings
+        """
+        if self._index is None:
+            return self._values.keys()
+        return self._index.keys()
+
+    @property
+    def ex_time(self):
+        """exchange update time, datetime."""
+        return self[self._decoder.ex_time_field]
+
+    @property
+    def contract(self):
+        """contract name."""
+        return self[self._decoder.contract_field]
+
+    def __getitem__(self, field):
+        try:
+            return self._cache[field]
+        except KeyError:
+            value = self._decoder.convert(self, field)
+            self._cache[field] = value
+            return value
+
+    def __contains__(self, field):
+        return field in self._decoder.derived_fields or \
+            field in self.raw_fields()
+
+    def get(self, field, default=None):
+        try:
+            return self[field]
+        except KeyError:
+            return default
+
+    def materialize(self):
+        """
+        convert all declared fields of the record.
+        :return: dict
+        """
+        fields = self._decoder.fields
+        d = dict()
+        for field in self.raw_fields():
+            if fields is None or field in fields:
+                d[field] = self[field]
+        for field in self._decoder.derived_fields:
+            d[field] = self[field]
+        return d
+
+
+# -------------------------------------------------------------------------
+class HermesDecoder(object):
+    """
+    Decoder of Hermes messages of one schema (tick or k-line), built once
+    and used for every message.
+
+    The conversion of each field (rescaled float, integer, filetime) is
+    looked up in a table compiled from the AthenaConfig field classes on
+    construction. Hermes messages are 'field|value|field|value|...'
+    strings; the layout of fields is learnt from the messages, so that a
+    message with the known layout is parsed positionally and never turned
+    into a dictionary. The contract name is parsed from the Hermes key and
+    cached per key prefix (i.e. per Hermes directory).
+
+    Derived fields ('tag', contract, ...) are computed from other fields
+    instead of being read from the message.
+
+    class attributes:
+    ----------------
+    * tag, headers, floats, integers, times: schema of the message,
+        implemented by concrete decoders.
+
+    * required_fields: fields needed by the publishers, always kept.
+
+    public attributes:
+    ----------------
+    * fields: set of fields declared by consumers, only these (and derived
+        fields) are kept by HermesRecord.materialize(). None means all.
+    """
+    tag = None
+    headers = ()
+    floats = ()
+    integers = ()
+    times = ()
+    time_converter = staticmethod(_filetime)
+    key_field = None
+    contract_field = None
+    ex_time_field = None
+    required_fields = ()
+
+    def __init__(self, fields=None, raw_times=False):
+        """
+        constructor.
+        :param fields: iterable of strings, fields the consumers need.
+            Default is None, keeps all fields.
+        :param raw_times: bool, keep time fields as integer filetime instead
+            of datetime, for bulk paths that convert times of many records
+            at once (see utils.filetime_to_dt64).
+        """
+        self.fields = None
+        if fields is not None:
+            self.fields = set(fields) | set(self.required_fields)
+
+        # compile conversion table.
+        self._converters = dict()
+        for field in self.floats:
+            self._converters[field] = _scaled_float
+        for field in self.integers:
+            self._converters[field] = int
+        for field in self.times:
+            self._converters[field] = \
+                int if raw_times else self.time_converter
+
+        self.derived_fields = self._derived_fields()
+
+        # layout of positional messages, initially the schema headers.
+        self._layout = list(self.headers)
+        self._index = dict(zip(self._layout, range(len(self._layout))))
+
+        # key prefix -> contract name cache
+        self._contracts = dict()
+
+    def require(self, fields):
+        """
+        keep fields in materialized records, in addition to the declared
+        ones. Nothing to do if all fields are kept.
+        :param fields: iterable of strings.
+        :return:
+        """
+        if self.fields is not None:
+            self.fields.update(fields)
+
+    def _derived_fields(self):
+        """
+        :return: tuple of names of derived fields.
+        """
+        return 'tag', self.contract_field
+
+    def _parse_contract(self, prefix):
+        """
+        parse contract name from prefix of Hermes key.
+        :param prefix: string, like 'md.uftreal.au1612'
+        :return: string
+        """
+        raise NotImplementedError
+
+    def contract(self, key):
+        """
+        contract name of a Hermes key, cached per prefix.
+        :param key: string, Hermes key like 'md.uftreal.au1612:1311...'
+        :return: string
+        """
+        prefix = key.split(':', 1)[0]
+        try:
+            return self._contracts[prefix]
+        except KeyError:
+            contract = self._parse_contract(prefix)
+            self._contracts[prefix] = contract
+            return contract
+
+    def convert(self, record, field):
+        """
+        compute the value of one field of record.
+        :param record: HermesRecord
+        :param field: string
+        :return:
+        """
+        if field == self.contract_field:
+            return self.contract(record.raw(self.key_field))
+        if field == 'tag':
+            return self.tag
+
+        raw = record.raw(field)
+        converter = self._converters.get(field)
+        if converter is None:
+            return raw
+        return converter(raw)
+
+    def decode(self, message):
+        """
+        decode a message published by Hermes.
+        :param message: bytes or string, 'field|value|field|value...'
+        :return: HermesRecord
+        """
+        if type(message) == bytes:
+            message = message.decode('utf-8')
+        l = message.split(AthenaConfig.hermes_md_sep_char)
+
+        keys = l[0::2]
+        if keys != self._layout:
+            # new layout, re-index positions.
+            self._layout = keys
+            self._index = dict(zip(keys, range(len(keys))))
+
+        return HermesRecord(self, l[1::2], self._index)
+
+    def decode_hash(self, d, key=None):
+        """
+        decode a hash set, as returned by RedisWrapper.get_dict().
+        :param d: dict
+        :param key: string, redis key of the hash set. Used to find the
+            contract if the hash set does not carry the key field.
+        :return: HermesRecord
+        """
+        if key is not None and self.key_field not in d:
+            d[self.key_field] = key
+        return HermesRecord(self, d, None)
+
+
+class HermesTickDecoder(HermesDecoder):
+    """
+    Decoder of Hermes md (tick) messages.
+    """
+    tag = AthenaConfig.AthenaMessageTypes.md
+    headers = HTf.hermes_tick_headers
+    floats = HTf.floats
+    integers = HTf.integers
+    times = (HTf.ex_time, HTf.local_time)
+    key_field = HTf.key
+    contract_field = HTf.contract
+    ex_time_field = HTf.ex_time
+    required_fields = (HTf.ex_time, HTf.local_time, HTf.key)
+
+    def _parse_contract(self, prefix):
+        """
+        'md.uftreal.au1612' -> 'au1612', 'md.ksdreal.Au99.99' -> 'Au99.99'
+        """
+        parsed_key = prefix.split('.')
+        if len(parsed_key) == 4:  # Au99.99, an extra '.'
+            return '.'.join([parsed_key[-2], parsed_key[-1]])
+        return parsed_key[-1]
+
+
+class HermesKLineDecoder(HermesDecoder):
+    """
+    Decoder of Hermes kl (k-line) messages. Illegal time fields are mapped
+    to the epoch instead of raising.
+    """
+    tag = AthenaConfig.AthenaMessageTypes.kl
+    headers = HKf.hermes_kline_headers
+    floats = HKf.floats
+    integers = HKf.integers
+    times = HKf.times
+    time_converter = staticmethod(_safe_filetime)
+    key_field = HKf.key
+    contract_field = HKf.contract
+    ex_time_field = HKf.ex_time
+    required_fields = HKf.times + (HKf.duration, HKf.key)
+
+    def _derived_fields(self):
+        return 'tag', self.contract_field, HKf.duration_specifier
+
+    def _parse_contract(self, prefix):
+        """
+        'kl.uftreal.au1612.1m' -> 'au1612',
+        'kl.ksdreal.Au99.99.1m' -> 'Au99.99'
+        """
+        parsed_key = prefix.split('.')
+        if len(parsed_key) == 4:
+            return parsed_key[-2]
+        elif len(parsed_key) == 5:  # Au99.99, an extra '.'
+            return '.'.join([parsed_key[-3], parsed_key[-2]])
+        return parsed_key[-1]
+
+    def convert(self, record, field):
+        if field == HKf.duration_specifier:
+            return AthenaConfig.hermes_kl_seconds_to_dur[
+                record[HKf.duration]]
+        return super(HermesKLineDecoder, self).convert(record, field)
@@ -0,0 +1,90 @@
+import unittest
+from datetime import datetime
+
+from Athena.settings import AthenaConfig
+from Athena.data_handler.hermes_decoder import HermesTickDecoder, \
+    HermesKLineDecoder
+HTf, HKf = AthenaConfig.HermesTickFields, AthenaConfig.HermesKLineFields
+
+__author__ = 'zed'
+
+
+def make_message(fields):
+    """
+    make 'field|value|...' string as published by Hermes.
+    :param fields: list of (field, value) tuples.
+    :return:
+    """
+    return AthenaConfig.hermes_md_sep_char.join(
+        x for pair in fields for x in pair)
+
+
+class TestHermesDecoder(unittest.TestCase):
+    """
+    Test hermes message decoders.
+    """
+    def setUp(self):
+        """
+        :return:
+        """
+        self.tick_fields = dict([(h, '0') for h in HTf.hermes_tick_headers])
+        self.tick_fields[HTf.ex_time] = '131145893910000000'
+        self.tick_fields[HTf.local_time] = '131145893910000000'
+        self.tick_fields[HTf.last_price] = '3001200'
+        self.tick_fields[HTf.bid_vol_1] = '12'
+        self.tick_fields[HTf.key] = 'md.ksdreal.Au99.99:131145893910000000'
+        self.tick_message = make_message(
+            [(h, self.tick_fields[h]) for h in HTf.hermes_tick_headers])
+
+        self.kl_fields = dict([(h, '0') for h in HKf.hermes_kline_headers])
+        for field in HKf.times:
+            self.kl_fields[field] = '131145893910000000'
+        self.kl_fields[HKf.duration] = '60'
+        self.kl_fields[HKf.close_price] = '3001200'
+        self.kl_fields[HKf.key] = 'kl.uftreal.au1612.1m:131145893910000000'
+
+    def test_decode_tick(self):
+        decoder = HermesTickDecoder()
+        d = decoder.decode(self.tick_message.encode('utf-8')).materialize()
+
+        # >>> prices are rescaled, volumes are integers
+        self.assertEqual(d[HTf.last_price], 300.12)
+        self.assertEqual(d[HTf.bid_vol_1], 12)
+        self.assertEqual(d[HTf.ex_time], datetime(2016, 8, 2, 13, 29, 51))
+
+        # >>> contract with an extra '.' is parsed from key
+        self.assertEqual(d[HTf.contract], 'Au99.99')
+        self.assertEqual(d['tag'], AthenaConfig.AthenaMessageTypes.md)
+
+        # >>> hash sets are decoded to the same dict
+        h = decoder.decode_hash(dict(self.tick_fields)).materialize()
+        self.assertEqual(d, h)
+
+    def test_declared_fields(self):
+        decoder = HermesTickDecoder(fields=[HTf.last_price])
+        record = decoder.decode(self.tick_message)
+
+        # >>> only declared and required fields are kept
+        d = record.materialize()
+        self.assertIn(HTf.last_price, d)
+        self.assertIn(HTf.ex_time, d)
+        self.assertNotIn(HTf.bid_vol_1, d)
+
+        # >>> undeclared fields are still converted on access
+        self.assertEqual(record[HTf.bid_vol_1], 12)
+
+    def test_decode_kline(self):
+        decoder = HermesKLineDecoder()
+
+        # >>> hash set without key field takes the redis key
+        row = dict(self.kl_fields)
+        key = row.pop(HKf.key)
+        d = decoder.decode_hash(row, key).materialize()
+        self.assertEqual(d[HKf.contract], 'au1612')
+        self.assertEqual(d[HKf.duration], 60)
+        self.assertEqual(d[HKf.duration_specifier], '1m')
+        self.assertEqual(d[HKf.close_price], 300.12)
+
+
+if __name__ == '__main__':
+    unittest.main()
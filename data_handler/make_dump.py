@@ -1,220 +1,314 @@
+import json
+import hashlib
+import multiprocessing
 from datetime import datetime
+
+import numpy as np
+
 from Athena.data_handler.sql_wrapper import SQLWrapper
 from Athena.data_handler.redis_wrapper import RedisWrapper
+from Athena.data_handler.query_cache import QueryCache
 from Athena.settings import AthenaConfig
-from Athena.utils import dt_to_filetime
+from Athena.utils import dt64_to_filetime
 HKf, SKf = AthenaConfig.HermesKLineFields, AthenaConfig.SQLKlineFields
 HTf, STf = AthenaConfig.HermesTickFields, AthenaConfig.SQLTickFields
 
+# column of hermes directory of converted rows
+CHANNEL_COLUMN = '_channel'
+
+# sql columns -> hermes fields of prices (scaled by 10000)
+kl_price_fields = (
+    (SKf.open_price, HKf.open_price),
+    (SKf.high_price, HKf.high_price),
+    (SKf.low_price, HKf.low_price),
+    (SKf.close_price, HKf.close_price),
+    (SKf.average_price, HKf.average_price),
+)
+md_price_fields = (
+    (STf.last_price, HTf.last_price),
+    (STf.average_price, HTf.average_price),
+    (STf.highest_price, HTf.high_price),
+    (STf.lowest_price, HTf.low_price),
+) + tuple(
+    (getattr(STf, 'bid_{}'.format(i)), getattr(HTf, 'bid_{}'.format(i)))
+    for i in range(1, 11)
+) + tuple(
+    (getattr(STf, 'ask_{}'.format(i)), getattr(HTf, 'ask_{}'.format(i)))
+    for i in range(1, 11)
+)
+
+# sql columns -> hermes fields of integers
+kl_integer_fields = (
+    (SKf.duration, HKf.duration),
+    (SKf.volume, HKf.volume),
+    (SKf.turnover, HKf.turnover),
+    (SKf.total_volume, HKf.total_volume),
+    (SKf.total_turnover, HKf.total_turnover),
+    (SKf.open_interest, HKf.open_interest),
+)
+md_integer_fields = (
+    (STf.volume, HTf.volume),
+    (STf.turnover, HTf.turnover),
+    (STf.open_int, HTf.open_interest),
+) + tuple(
+    (getattr(STf, 'bid_vol_{}'.format(i)),
+     getattr(HTf, 'bid_vol_{}'.format(i)))
+    for i in range(1, 11)
+) + tuple(
+    (getattr(STf, 'ask_vol_{}'.format(i)),
+     getattr(HTf, 'ask_vol_{}'.format(i)))
+    for i in range(1, 11)
+)
+
+# hermes fields not in sql, always 0
+kl_zero_fields = (HKf.open_time, HKf.high_time, HKf.low_time,
+                  HKf.pre_close_price)
+md_zero_fields = (HTf.update_ms, HTf.pre_open_interest, HTf.pre_clear_price,
+                  HTf.pre_close_price, HTf.open_price, HTf.close_price,
+                  HTf.clear_price)
+
+
+def time_column_to_filetime(column):
+    """
+    convert one time column of sql rows to filetime.
+    :param column: array-like of datetime or sql strings.
+    :return: numpy array of int64
+    """
+    column = np.asarray(column).tolist()
+    if column and isinstance(column[0], str):
+        # sql string has 7 digits of fractional seconds, trim to 6.
+        column = [t[:-1] for t in column]
+    elif column and type(column[0]) != datetime:
+        raise TypeError
+    return dt64_to_filetime(column)
+
+
+def map_column(column, mapping):
+    """
+    map values of a column, each distinct value is looked up once.
+    :param column: array-like
+    :param mapping: function
+    :return: numpy array
+    """
+    values, inverse = np.unique(np.asarray(column), return_inverse=True)
+    return np.array([mapping(v) for v in values.tolist()])[inverse]
+
 
-def make_dump(symbols, begin_time, end_time, table, data_type, flush=False):
+def scale_prices(column):
+    """
+    :param column: array-like of prices.
+    :return: numpy array of int64, prices * 10000 (truncated).
     """
+    return (np.asarray(column, dtype=np.float64) * 10000).astype(np.int64)
 
+
+def convert_kl_columns(columns):
+    """
+    convert columns of k-lines selected from sql to hermes fields.
+    :param columns: dict, sql column -> numpy array.
+    :return: dict, hermes field (and CHANNEL_COLUMN) -> numpy array.
+    """
+    n = len(columns[SKf.contract])
+    duration = np.asarray(columns[SKf.duration], dtype=np.int64)
+    ft_ex = time_column_to_filetime(columns[SKf.ex_update_time])
+
+    converted = {
+        CHANNEL_COLUMN: np.array([
+            AthenaConfig.hermes_kl_mapping[
+                AthenaConfig.hermes_kl_seconds_to_dur[d]][c]
+            for d, c in zip(duration.tolist(),
+                            np.asarray(columns[SKf.contract]).tolist())
+        ]) if n else np.zeros(0, str),
+        HKf.exchange: np.asarray(columns[SKf.exchange]).astype(str),
+        HKf.day: np.asarray(columns[SKf.day]).astype(str),
+        HKf.ex_time: ft_ex,
+        HKf.local_time: time_column_to_filetime(columns[SKf.update_time]),
+        HKf.close_time: ft_ex,
+    }
+    for sql_field, field in kl_price_fields:
+        converted[field] = scale_prices(columns[sql_field])
+    for sql_field, field in kl_integer_fields:
+        converted[field] = np.asarray(columns[sql_field]).astype(np.int64)
+    for field in kl_zero_fields:
+        converted[field] = np.zeros(n, np.int64)
+    return converted
+
+
+def convert_md_columns(columns):
+    """
+    convert columns of ticks selected from sql to hermes fields.
+    :param columns: dict, sql column -> numpy array.
+    :return: dict, hermes field (and CHANNEL_COLUMN) -> numpy array.
+    """
+    n = len(columns[STf.contract])
+    converted = {
+        CHANNEL_COLUMN: map_column(
+            columns[STf.contract],
+            lambda c: AthenaConfig.hermes_md_mapping[c]
+        ) if n else np.zeros(0, str),
+        HTf.exchange: np.asarray(columns[STf.exchange]).astype(str),
+        HTf.day: np.asarray(columns[STf.day]).astype(str),
+        HTf.ex_time: time_column_to_filetime(columns[STf.ex_update_time]),
+        HTf.local_time: time_column_to_filetime(
+            columns[STf.local_update_time]),
+    }
+    for sql_field, field in md_price_fields:
+        converted[field] = scale_prices(columns[sql_field])
+    for sql_field, field in md_integer_fields:
+        converted[field] = np.asarray(columns[sql_field]).astype(np.int64)
+    for field in md_zero_fields:
+        converted[field] = np.zeros(n, np.int64)
+    return converted
+
+
+def dump_columns(r, columns, time_field, pipeline_size=5000):
+    """
+    write converted rows into hermes db, keys are
+    '<directory>:<filetime of time_field>'. Hash sets are written in
+    pipelined batches of pipeline_size rows, one round trip per batch.
+    :param r: RedisWrapper of hermes db.
+    :param columns: dict, hermes field (and CHANNEL_COLUMN) -> numpy array.
+    :param time_field: string, field of key suffixes.
+    :param pipeline_size: int, rows per round trip.
+    :return: int, number of rows written.
+    """
+    fields = [f for f in columns if f != CHANNEL_COLUMN]
+    values = [columns[f].tolist() for f in fields]
+    keys = np.char.add(
+        np.char.add(np.asarray(columns[CHANNEL_COLUMN], dtype=str), ':'),
+        np.asarray(columns[time_field]).astype(str)
+    ).tolist()
+
+    pipe = r.pipeline()
+    staged = 0
+    for key, row in zip(keys, zip(*values)):
+        pipe.hmset(key, dict(zip(fields, row)))
+        staged += 1
+        if staged >= pipeline_size:
+            pipe.execute()
+            staged = 0
+    if staged:
+        pipe.execute()
+    return len(keys)
+
+
+# data type -> (sql columns, converter, time field of keys)
+dump_types = {
+    'kl': (SKf.kline_headers, convert_kl_columns, HKf.local_time),
+    'md': (STf.tick_headers, convert_md_columns, HTf.local_time),
+}
+
+# version of the conversion of rows, to be bumped on changes of
+# convert_kl_columns/convert_md_columns, so that rows converted earlier
+# are not served from the query cache.
+CONVERSION_VERSION = 1
+
+
+def dump_version(data_type):
+    """
+    version of rows converted for data_type, part of their query cache
+    key: data type, CONVERSION_VERSION and a digest of the mappings of
+    hermes directories used by the conversion.
+    :param data_type: string, 'kl' or 'md'.
+    :return: string
+    """
+    if data_type == 'kl':
+        mappings = [AthenaConfig.hermes_kl_mapping,
+                    AthenaConfig.hermes_kl_seconds_to_dur]
+    else:
+        mappings = [AthenaConfig.hermes_md_mapping]
+    digest = hashlib.sha1(json.dumps(
+        mappings, sort_keys=True, default=str).encode('utf8')).hexdigest()
+    return '{}.{}.{}'.format(data_type, CONVERSION_VERSION, digest)
+
+
+def dump_symbol(symbol, begin_time, end_time, table, data_type,
+                batch_size=10000, use_cache=True):
+    """
+    dump historical rows of one symbol from sql table into hermes db, see
+    make_dump.
+    :return: int, number of rows dumped.
+    """
+    r = RedisWrapper(db=AthenaConfig.hermes_db_index)
+    headers, convert, time_field = dump_types[data_type]
+    query = (table, [symbol], begin_time, end_time, headers)
+    version = dump_version(data_type)
+
+    cache = QueryCache() if use_cache else None
+    cached = cache.get(*query, version=version) if use_cache else None
+    writer = None
+    if cached is not None:
+        batches = cached.iter_batches(batch_size)
+    else:
+        s = SQLWrapper()
+        batches = (convert(columns) for columns in s.iter_hist_data(
+            symbols_list=[symbol],
+            begin_time=begin_time,
+            end_time=end_time,
+            table=table,
+            columns=headers,
+            batch_size=batch_size,
+            as_arrays=True
+        ))
+        if use_cache:
+            writer = cache.writer(*query, version=version)
+
+    counter = 0
+    try:
+        for columns in batches:
+            if writer is not None:
+                writer.append(columns)
+            counter += dump_columns(r, columns, time_field)
+            print('[Redis]: Transported {} of {}.'.format(counter, symbol))
+    except BaseException:
+        if writer is not None:
+            writer.abort()
+        raise
+
+    if writer is not None:
+        writer.commit()
+    return counter
+
+
+def make_dump(symbols, begin_time, end_time, table, data_type, flush=False,
+              batch_size=10000, use_cache=True, workers=1):
+    """
+    dump historical rows of symbols from sql table into hermes db. Rows are
+    streamed from sql symbol by symbol, converted column-wise and written
+    in pipelined batches. Converted rows of each symbol are kept in the
+    local query cache (see query_cache.QueryCache, keyed with
+    dump_version), so that later dumps of the symbol over the same time
+    window skip sql and conversion, whatever other symbols they dump.
+    With workers > 1, symbols are dumped in parallel processes, one symbol
+    per task, each with its own connections.
     :param symbols:
     :param begin_time:
     :param end_time:
     :param table:
-    :param data_type:
+    :param data_type: string, 'kl' or 'md'.
     :param flush:
-    :return:
+    :param batch_size: int, rows converted and written at once.
+    :param use_cache: bool, whether to use the query cache.
+    :param workers: int, number of processes.
+    :return: int, number of rows dumped.
     """
-    s = SQLWrapper()
     r = RedisWrapper(db=AthenaConfig.hermes_db_index)
 
     if flush:
         r.hermes_db_protected = False
         r.flush_db()
 
-    rows = s.select_hist_data(
-        symbols_list=symbols,
-        begin_time=begin_time,
-        end_time=end_time,
-        table=table
-    )
+    tasks = [(symbol, begin_time, end_time, table, data_type, batch_size,
+              use_cache) for symbol in symbols]
+    if workers > 1 and len(symbols) > 1:
+        with multiprocessing.Pool(min(workers, len(symbols))) as pool:
+            counts = pool.starmap(dump_symbol, tasks, chunksize=1)
+    else:
+        counts = [dump_symbol(*task) for task in tasks]
 
-    num_rows = len(rows)
-
-    # transport k-lines
-    if data_type == 'kl':
-        counter = 0
-        for row in rows:
-            # compress to dictionary
-            d_sql = dict(zip(SKf.kline_headers, row))
-
-            # update time, dt and ft
-            if type(d_sql[SKf.update_time]) == str:
-
-                update_time = d_sql[SKf.update_time][:-1]
-                dt = datetime.strptime(
-                    update_time, AthenaConfig.sql_storage_dt_format)
-                ex_update_time = d_sql[SKf.ex_update_time][:-1]
-                dt_ex = datetime.strptime(
-                    ex_update_time, AthenaConfig.sql_storage_dt_format)
-
-            elif type(d_sql[SKf.update_time]) == datetime:
-
-                dt = d_sql[SKf.update_time]
-                dt_ex = d_sql[SKf.ex_update_time]
-
-            else: raise TypeError
-
-            ft = dt_to_filetime(dt)
-            ft_ex = dt_to_filetime(dt_ex)
-
-            contract = d_sql[SKf.contract]
-            duration = int(d_sql[SKf.duration])
-            duration_specifier = \
-                AthenaConfig.hermes_kl_seconds_to_dur[duration]
-
-            # map to pub channel
-            pub_channel = \
-                AthenaConfig.hermes_kl_mapping[duration_specifier][contract]
-
-            # map to key
-            athena_unique_key = pub_channel + ':' + str(ft)
-
-            d_pub = {
-                HKf.duration: duration,
-                HKf.exchange: d_sql[SKf.exchange],
-                HKf.day: d_sql[SKf.day],
-                HKf.ex_time: ft_ex,
-                HKf.local_time: ft,
-                HKf.open_time: 0,
-                HKf.high_time: 0,
-                HKf.low_time: 0,
-                HKf.close_time: ft_ex,
-                HKf.pre_close_price: 0,
-                HKf.open_price: int(float(d_sql[SKf.open_price]) * 10000),
-                HKf.high_price: int(float(d_sql[SKf.high_price]) * 10000),
-                HKf.low_price: int(float(d_sql[SKf.low_price]) * 10000),
-                HKf.close_price: int(float(d_sql[SKf.close_price]) * 10000),
-                HKf.average_price: int(
-                    float(d_sql[SKf.average_price]) * 10000),
-                HKf.volume: int(d_sql[SKf.volume]),
-                HKf.turnover: int(d_sql[SKf.turnover]),
-                HKf.total_volume: int(d_sql[SKf.total_volume]),
-                HKf.total_turnover: int(d_sql[SKf.total_turnover]),
-                HKf.open_interest: int(d_sql[SKf.open_interest])
-            }
-
-            r.set_dict(
-                key=athena_unique_key,
-                data=d_pub
-            )
-
-            counter += 1
-            if not counter % 10000:
-                print('[Redis]: Transported {}/{}.'.format(
-                    counter, num_rows))
-
-    # transport k-lines
-    elif data_type == 'md':
-        counter = 0
-        for row in rows:
-            # compress to dictionary
-            d_sql = dict(zip(STf.tick_headers, row))
-
-            # update time, dt and ft
-            if type(d_sql[STf.local_update_time]) == str:
-
-                update_time = d_sql[STf.local_update_time][:-1]
-                dt = datetime.strptime(
-                    update_time, AthenaConfig.sql_storage_dt_format)
-
-                ex_update_time = d_sql[STf.ex_update_time][:-1]
-                dt_ex = datetime.strptime(
-                    ex_update_time, AthenaConfig.sql_storage_dt_format)
-
-            elif type(d_sql[STf.local_update_time]) == datetime:
-
-                dt = d_sql[STf.local_update_time]
-                dt_ex = d_sql[STf.ex_update_time]
-
-            else: raise TypeError
-
-            ft = dt_to_filetime(dt)
-            ft_ex = dt_to_filetime(dt_ex)
-
-            contract = d_sql[STf.contract]
-
-            # map to pub channel
-            pub_channel = \
-                AthenaConfig.hermes_md_mapping[contract]
-
-            # map to key
-            athena_unique_key = pub_channel + ':' + str(ft)
-
-            d_pub = {
-                HTf.exchange: d_sql[STf.exchange],
-                HTf.day: d_sql[STf.day],
-                HTf.ex_time: ft_ex,
-                HTf.local_time: ft,
-                HTf.update_ms: 0,
-                HTf.last_price: int(float(d_sql[STf.last_price]) * 10000),
-                HTf.volume: int(d_sql[STf.volume]),
-                HTf.turnover: int(d_sql[STf.turnover]),
-                HTf.open_interest: int(d_sql[STf.open_int]),
-                HTf.pre_open_interest: 0,
-                HTf.pre_clear_price: 0,
-                HTf.pre_close_price: 0,
-                HTf.average_price: int(
-                    float(d_sql[STf.average_price]) * 10000),
-                HTf.open_price: 0,
-                HTf.close_price: 0,
-                HTf.clear_price: 0,
-                HTf.high_price: int(float(d_sql[STf.highest_price]) * 10000),
-                HTf.low_price: int(float(d_sql[STf.lowest_price]) * 10000),
-                HTf.bid_1: int(float(d_sql[STf.bid_1]) * 10000),
-                HTf.bid_2: int(float(d_sql[STf.bid_2]) * 10000),
-                HTf.bid_3: int(float(d_sql[STf.bid_3]) * 10000),
-                HTf.bid_4: int(float(d_sql[STf.bid_4]) * 10000),
-                HTf.bid_5: int(float(d_sql[STf.bid_5]) * 10000),
-                HTf.bid_6: int(float(d_sql[STf.bid_6]) * 10000),
-                HTf.bid_7: int(float(d_sql[STf.bid_7]) * 10000),
-                HTf.bid_8: int(float(d_sql[STf.bid_8]) * 10000),
-                HTf.bid_9: int(float(d_sql[STf.bid_9]) * 10000),
-                HTf.bid_10: int(float(d_sql[STf.bid_10]) * 10000),
-                HTf.bid_vol_1: int(d_sql[STf.bid_vol_1]),
-                HTf.bid_vol_2: int(d_sql[STf.bid_vol_2]),
-                HTf.bid_vol_3: int(d_sql[STf.bid_vol_3]),
-                HTf.bid_vol_4: int(d_sql[STf.bid_vol_4]),
-                HTf.bid_vol_5: int(d_sql[STf.bid_vol_5]),
-                HTf.bid_vol_6: int(d_sql[STf.bid_vol_6]),
-                HTf.bid_vol_7: int(d_sql[STf.bid_vol_7]),
-                HTf.bid_vol_8: int(d_sql[STf.bid_vol_8]),
-                HTf.bid_vol_9: int(d_sql[STf.bid_vol_9]),
-                HTf.bid_vol_10: int(d_sql[STf.bid_vol_10]),
-                HTf.ask_1: int(float(d_sql[STf.ask_1] )* 10000),
-                HTf.ask_2: int(float(d_sql[STf.ask_2]) * 10000),
-                HTf.ask_3: int(float(d_sql[STf.ask_3]) * 10000),
-                HTf.ask_4: int(float(d_sql[STf.ask_4]) * 10000),
-                HTf.ask_5: int(float(d_sql[STf.ask_5]) * 10000),
-                HTf.ask_6: int(float(d_sql[STf.ask_6]) * 10000),
-                HTf.ask_7: int(float(d_sql[STf.ask_7]) * 10000),
-                HTf.ask_8: int(float(d_sql[STf.ask_8]) * 10000),
-                HTf.ask_9: int(float(d_sql[STf.ask_9]) * 10000),
-                HTf.ask_10: int(float(d_sql[STf.ask_10]) * 10000),
-                HTf.ask_vol_1: int(d_sql[STf.ask_vol_1]),
-                HTf.ask_vol_2: int(d_sql[STf.ask_vol_2]),
-                HTf.ask_vol_3: int(d_sql[STf.ask_vol_3]),
-                HTf.ask_vol_4: int(d_sql[STf.ask_vol_4]),
-                HTf.ask_vol_5: int(d_sql[STf.ask_vol_5]),
-                HTf.ask_vol_6: int(d_sql[STf.ask_vol_6]),
-                HTf.ask_vol_7: int(d_sql[STf.ask_vol_7]),
-                HTf.ask_vol_8: int(d_sql[STf.ask_vol_8]),
-                HTf.ask_vol_9: int(d_sql[STf.ask_vol_9]),
-                HTf.ask_vol_10: int(d_sql[STf.ask_vol_10]),
-            }
-
-            r.set_dict(
-                key=athena_unique_key,
-                data=d_pub
-            )
-
-            counter += 1
-            if not counter % 10000:
-                print('[Redis]: Transported {}/{}.'.format(
-                    counter, num_rows))
+    print('[Redis]: Transported {} rows of {} symbols.'.format(
+        sum(counts), len(symbols)))
+    return sum(counts)
 
 
 if __name__ == '__main__':
@@ -236,5 +330,3 @@ if __name__ == '__main__':
         data_type='md',
         flush=False
     )
-
-
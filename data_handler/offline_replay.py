@@ -0,0 +1,265 @@
+import time
+import heapq
+from datetime import datetime
+
+import numpy as np
+
+from Athena.settings import AthenaConfig
+from Athena.trade_time import trade_calendar
+from Athena.utils import filetime_to_dt64, dt_to_filetime
+from Athena.data_handler.archive import ColumnArchive, schema_of, \
+    time_fields
+from Athena.data_handler.transport import LocalTransport, local_bus
+from Athena.data_handler.bar_builder import BarBuilder
+HTf, HKf = AthenaConfig.HermesTickFields, AthenaConfig.HermesKLineFields
+
+__author__ = 'zed'
+
+
+class LocalStore(object):
+    """
+    In-memory stand-in of RedisWrapper for offline replay. Keeps the last
+    hash set of each directory (key without its counter suffix), enough
+    for 'current' records.
+    """
+    def __init__(self):
+        """
+        constructor.
+        """
+        self.data = dict()
+
+    def set_dict(self, key, data):
+        """
+        :param key: string
+        :param data: dict
+        :return:
+        """
+        self.data[key.rsplit(':', 1)[0]] = data
+
+    def set_indexed_dict(self, channel, key, data, score, pipe=None):
+        """
+        same as set_dict, records are not indexed.
+        """
+        self.set_dict(key, data)
+
+    def get_dict(self, key):
+        """
+        :param key: string
+        :return: dict, empty if not found.
+        """
+        return self.data.get(key.rsplit(':', 1)[0], dict())
+
+
+def time_key(value):
+    """
+    filetime of the time of a record, so that sources with different time
+    types are merged by one key.
+    :param value: datetime, datetime64, string (AthenaConfig.dt_format,
+        or AthenaConfig.sql_storage_dt_format with fractions of second) or
+        filetime.
+    :return: int
+    """
+    if isinstance(value, str):
+        value = datetime.strptime(
+            value, AthenaConfig.sql_storage_dt_format if '.' in value
+            else AthenaConfig.dt_format)
+    elif isinstance(value, np.datetime64):
+        value = value.astype('datetime64[us]').item()
+    if isinstance(value, datetime):
+        return dt_to_filetime(value)
+    return int(value)
+
+
+class OfflineReplay(object):
+    """
+    Offline replay engine, feeds signals and strategies running in this
+    process directly, without redis.
+
+    Records of all sources are merged in order of exchange time and handed
+    over to the on_message() of subscribers on the channels that the data
+    handler would publish them (md:<instrument>, kl:<instrument>.<dur>).
+    Signals and strategies must be created with the 'local' transport
+    (AthenaConfig.transport, or their _transport attribute), then their
+    publishing calls on_message() of downstream subscribers right away.
+
+    Sources are the columnar archive (add_instrument) or any iterable of
+    cleaned records in time order (add_records), like results of SQL
+    queries. Sources are merged by the filetime of their times (see
+    time_key), whether datetime, strings or filetime. Records of the
+    archive are filtered by trading sessions, time fields are datetime,
+    and bars are counted as by the data handler.
+    Bars of any duration can also be built from archived ticks.
+
+    Usage:
+    ----------------
+        AthenaConfig.transport = 'local'
+        engine = OfflineReplay()
+        engine.add_instrument('au1612', ['1m'])
+        engine.add(MovingAverage(['kl:au1612.1m'], [...]))
+        engine.add(MyStrategy([...], [...]))
+        engine.run(begin, end)
+    """
+    def __init__(self, archive=None, bus=None):
+        """
+        constructor.
+        :param archive: ColumnArchive, default is archive at
+            AthenaConfig.archive_root.
+        :param bus: LocalBus of subscribers, default is local_bus.
+        """
+        self.archive = archive or ColumnArchive()
+        self.bus = bus or local_bus
+        self.store = LocalStore()
+
+        # list of (channel, kind, instrument) of archive
+        self.instruments = []
+        # list of (channel, records) of other sources
+        self.sources = []
+
+        # md channel -> BarBuilder; kl channel -> count of bars
+        self.bar_builders = dict()
+        self.bar_counts = dict()
+
+        self.num_records = 0
+
+    def add(self, instance):
+        """
+        drive a signal, strategy or any object with a local transport
+        and on_message(), its hash sets are kept in memory.
+        :param instance: object
+        :return:
+        """
+        if not isinstance(instance.transport, LocalTransport):
+            raise ValueError('{} does not use local transport.'.format(
+                type(instance).__name__))
+        instance.transport.handler = instance.on_message
+        if hasattr(instance, 'redis_wrapper'):
+            instance.redis_wrapper = self.store
+        if hasattr(instance, 'packed_store'):
+            instance.packed_store = None
+
+    def add_instrument(self, instrument, kline_dur_specifiers=('1m',),
+                       md=True, build_kline=False):
+        """
+        replay archived md and bars of instrument.
+        :param instrument: string
+        :param kline_dur_specifiers: tuple of strings.
+        :param md: bool, whether to replay ticks.
+        :param build_kline: bool, build bars from archived ticks (see
+            bar_builder.BarBuilder) instead of replaying archived bars.
+        :return:
+        """
+        if md or build_kline:
+            self.instruments.append(
+                ('md:' + instrument, 'md', instrument))
+        if build_kline:
+            self.bar_builders['md:' + instrument] = BarBuilder(
+                instrument, kline_dur_specifiers)
+            return
+        for dur in kline_dur_specifiers:
+            self.instruments.append(
+                ('kl:' + instrument + '.' + dur, 'kl.' + dur, instrument))
+
+    def add_records(self, channel, records, time_field=HTf.ex_time):
+        """
+        replay records of another source on channel.
+        :param channel: string
+        :param records: iterable of dicts, in order of time_field.
+        :param time_field: string, time field to merge records by, see
+            time_key.
+        :return:
+        """
+        self.sources.append((channel, records, time_field))
+
+    def __archive_stream(self, order, channel, kind, instrument, begin,
+                         end):
+        """
+        generator of (filetime, order, sequence, channel, record) of
+        archived records.
+        """
+        ex_time = schema_of(kind)[0][0]
+        dur = kind[3:] if kind.startswith('kl.') else None
+        sequence = 0
+
+        for day, columns in self.archive.iter_days(
+                instrument, kind, begin, end):
+            times = filetime_to_dt64(columns[ex_time])
+            mask = trade_calendar.mask(times, instrument)
+
+            fields = list(columns)
+            values = []
+            for field in fields:
+                column = columns[field][mask]
+                if field in time_fields:
+                    column = filetime_to_dt64(column).astype(object)
+                values.append(column.tolist())
+
+            keys = columns[ex_time][mask].tolist()
+            for key, row in zip(keys, zip(*values)):
+                record = dict(zip(fields, row))
+                record[HTf.contract] = instrument
+                if dur is None:
+                    record['tag'] = AthenaConfig.AthenaMessageTypes.md
+                else:
+                    record['tag'] = AthenaConfig.AthenaMessageTypes.kl
+                    record[HKf.duration_specifier] = dur
+                    record[HKf.count] = sequence
+                yield key, order, sequence, channel, record
+                sequence += 1
+
+    @staticmethod
+    def __source_stream(order, channel, records, time_field):
+        """
+        generator of (filetime, order, sequence, channel, record) of
+        records.
+        """
+        sequence = 0
+        for record in records:
+            yield time_key(record[time_field]), order, sequence, channel, \
+                record
+            sequence += 1
+
+    def __dispatch_bars(self, bars):
+        """
+        count and dispatch built bars.
+        :param bars: list of dicts.
+        """
+        for bar in bars:
+            channel = 'kl:' + bar[HKf.contract] + '.' + \
+                bar[HKf.duration_specifier]
+            bar[HKf.count] = self.bar_counts.get(channel, 0)
+            self.bar_counts[channel] = bar[HKf.count] + 1
+            self.bus.dispatch(channel, bar)
+
+    def run(self, begin=None, end=None):
+        """
+        replay all sources in time order.
+        :param begin: datetime, None for no bound.
+        :param end: datetime, None for no bound.
+        :return: int, number of records replayed.
+        """
+        streams = []
+        for channel, kind, instrument in self.instruments:
+            streams.append(self.__archive_stream(
+                len(streams), channel, kind, instrument, begin, end))
+        for channel, records, time_field in self.sources:
+            streams.append(self.__source_stream(
+                len(streams), channel, records, time_field))
+
+        start_time = time.time()
+        count = 0
+        for t, order, sequence, channel, record in heapq.merge(*streams):
+            # bars completed by a tick come before it
+            if channel in self.bar_builders:
+                self.__dispatch_bars(
+                    self.bar_builders[channel].update(record))
+            self.bus.dispatch(channel, record)
+            count += 1
+
+        # bars being built are complete at the end of data
+        for builder in self.bar_builders.values():
+            self.__dispatch_bars(builder.flush())
+
+        self.num_records += count
+        print('[Offline Replay]: Replayed {} records in {} seconds.'.format(
+            count, time.time() - start_time))
+        return count
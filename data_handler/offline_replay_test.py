@@ -0,0 +1,128 @@
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from Athena.settings import AthenaConfig
+from Athena.utils import dt_to_filetime
+from Athena.signals.signal import SignalTemplate
+from Athena.strategies.strategy import StrategyTemplate
+from Athena.data_handler.archive import ColumnArchive
+from Athena.data_handler.transport import local_bus
+from Athena.data_handler.offline_replay import OfflineReplay
+HTf, HKf = AthenaConfig.HermesTickFields, AthenaConfig.HermesKLineFields
+
+__author__ = 'zed'
+
+
+class LastPriceSignal(SignalTemplate):
+    """
+    Signal republishing last prices, in local transport.
+    """
+    signal_name_prefix = 'signal:last_price'
+    _transport = 'local'
+
+    def __init__(self, subscribe_list):
+        super(LastPriceSignal, self).__init__(subscribe_list)
+        self._map_to_channels([])
+        self.tag = 'last_price'
+        self.received = []
+
+    def on_message(self, message):
+        self.received.append(message)
+        if message['tag'] == 'md':
+            self.publish({'price': message[HTf.last_price]}, plot=False)
+
+
+class CollectingStrategy(StrategyTemplate):
+    """
+    Strategy collecting messages, in local transport.
+    """
+    _transport = 'local'
+
+    def __init__(self, subscribe_list):
+        super(CollectingStrategy, self).__init__(subscribe_list)
+        self.received = []
+
+    def on_message(self, message):
+        self.received.append(message)
+
+
+class TestOfflineReplay(unittest.TestCase):
+    """
+    Test offline replay engine.
+    """
+    def setUp(self):
+        """
+        :return:
+        """
+        self.root = tempfile.mkdtemp()
+        self.archive = ColumnArchive(self.root)
+        t0 = datetime(2016, 9, 29, 9, 30)
+
+        # ticks every 20 seconds, the last one at noon break
+        times = [t0 + timedelta(seconds=20 * i) for i in range(6)]
+        times.append(datetime(2016, 9, 29, 12))
+        self.archive.append('au1612', 'md', '20160929', {
+            HTf.ex_time: times,
+            HTf.last_price: [300. + i for i in range(7)]
+        })
+        self.archive.append('au1612', 'kl.1m', '20160929', {
+            HKf.ex_time: [t0 + timedelta(seconds=59)],
+            HKf.close_price: [301.]
+        })
+
+    def tearDown(self):
+        """
+        :return:
+        """
+        local_bus.clear()
+        shutil.rmtree(self.root)
+
+    def test_replay(self):
+        signal = LastPriceSignal(['md:au1612', 'kl:au1612.1m'])
+        strategy = CollectingStrategy([signal.pub_channel])
+
+        engine = OfflineReplay(self.archive)
+        engine.add_instrument('au1612', ['1m'])
+        engine.add(signal)
+        engine.add(strategy)
+
+        # >>> records out of trade time are filtered
+        self.assertEqual(engine.run(), 7)
+
+        # >>> md and bars are merged in time order
+        self.assertEqual([m['tag'] for m in signal.received],
+                         ['md', 'md', 'md', 'kl', 'md', 'md', 'md'])
+        self.assertEqual(signal.received[3][HKf.count], 0)
+        self.assertEqual(signal.received[0][HTf.ex_time],
+                         datetime(2016, 9, 29, 9, 30))
+
+        # >>> published signals are delivered downstream right away
+        self.assertEqual([m['price'] for m in strategy.received],
+                         [300., 301., 302., 303., 304., 305.])
+        self.assertEqual(
+            engine.store.get_dict(signal.pub_channel + ':0')['price'], 305.)
+
+    def test_mixed_sources(self):
+        strategy = CollectingStrategy(['md:au1612', 'signal:a', 'signal:b'])
+        engine = OfflineReplay(self.archive)
+        engine.add_instrument('au1612', [])
+        engine.add(strategy)
+
+        # times as strings (json, sql) and as filetime
+        engine.add_records('signal:a', [
+            {'tag': 'a', HTf.ex_time: '2016-09-29 09:30:10'},
+            {'tag': 'a', HTf.ex_time: '2016-09-29 09:30:50.500000'}])
+        engine.add_records('signal:b', [
+            {'tag': 'b', HTf.ex_time: dt_to_filetime(
+                datetime(2016, 9, 29, 9, 30, 20))}])
+
+        # >>> sources are merged by time, ties in order of sources
+        self.assertEqual(engine.run(), 9)
+        self.assertEqual([m['tag'] for m in strategy.received], [
+            'md', 'a', 'md', 'b', 'md', 'a', 'md', 'md', 'md'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,266 @@
+import json
+from datetime import datetime
+
+import numpy as np
+
+from Athena.settings import AthenaConfig
+from Athena.utils import dt_to_filetime, dt_to_epoch
+from Athena.data_handler.archive import schema_of, kind_of, time_fields
+
+__author__ = 'zed'
+
+# width of string fields of inferred schemas
+STRING_WIDTH = 32
+
+# field of chunk time indices, exchange time of md and kl records
+INDEX_FIELD = AthenaConfig.HermesTickFields.ex_time
+
+
+def infer_schema(record):
+    """
+    fixed schema of records of a channel that is not md or kl, inferred
+    from its first record: float64 for numbers (and None), so that a
+    signal first valued 0 keeps its fractions, datetime64[us] for
+    datetime, fixed width unicode for strings.
+    :param record: dict
+    :return: list of (field, dtype)
+    """
+    schema = []
+    for field, value in record.items():
+        if value is None or isinstance(value, (bool, int, float, np.number)):
+            schema.append((field, 'float64'))
+        elif isinstance(value, datetime):
+            schema.append((field, 'datetime64[us]'))
+        else:
+            schema.append((field, 'U{}'.format(STRING_WIDTH)))
+    return schema
+
+
+class PackedStore(object):
+    """
+    Append-only packed storage of the records of channels in Athena db, an
+    alternative to one hash set per record.
+
+    Records of a channel have a fixed schema (the archive schema of md and
+    kl records, otherwise inferred from the first record, see infer_schema),
+    they are packed into numpy structured arrays and appended as chunks
+    of chunk_size records to one list per channel:
+        packed:md:au1612 -> [chunk_0, chunk_1, ...]
+    Schemas are kept in the hash set packed:schemas, channel -> json list of
+    (field, dtype). Fields missing in a record are 0, fields not in the
+    schema are dropped, times of md and kl are int64 filetime as in the
+    archive. Values that would not be stored as they are (fractions in an
+    integer field, strings longer than their field) raise ValueError
+    instead of being truncated.
+
+    A chunk is pushed when it is full; the last, partial one on flush().
+    Readers unpack slices of chunks into numpy columns (read), without
+    scanning keys.
+
+    Chunks of channels whose records have a datetime exchange time are
+    indexed in the sorted set index:packed:<channel>, chunk number scored
+    by the time of its first record (as RedisWrapper.index_score), so that
+    records are read by time range (read_range) instead of from hash sets
+    by RedisWrapper.get_range.
+    """
+    def __init__(self, wrapper, chunk_size=None):
+        """
+        constructor.
+        :param wrapper: RedisWrapper of Athena db.
+        :param chunk_size: int, records per chunk, default is
+            AthenaConfig.packed_chunk_size.
+        """
+        self.wrapper = wrapper
+        self.chunk_size = chunk_size or AthenaConfig.packed_chunk_size
+
+        # channel -> numpy dtype, defaults of fields, rows being buffered
+        self.dtypes = dict()
+        self.defaults = dict()
+        self.rows = dict()
+
+        # channel -> number of chunks pushed, index score of buffered rows
+        self.counts = dict()
+        self.scores = dict()
+
+    @staticmethod
+    def chunks_key(channel):
+        """
+        :return: string, key of the list of chunks of channel.
+        """
+        return AthenaConfig.redis_packed_prefix + channel
+
+    @staticmethod
+    def schemas_key():
+        """
+        :return: string, key of the hash set of schemas.
+        """
+        return AthenaConfig.redis_packed_prefix + 'schemas'
+
+    @classmethod
+    def index_key(cls, channel):
+        """
+        :return: string, key of the time index of chunks of channel.
+        """
+        return AthenaConfig.redis_index_prefix + cls.chunks_key(channel)
+
+    def __register(self, channel, record, pipe):
+        """
+        fix the schema of channel by its first record.
+        """
+        if record.get('tag') in (AthenaConfig.AthenaMessageTypes.md,
+                                 AthenaConfig.AthenaMessageTypes.kl):
+            schema = schema_of(kind_of(record))
+        else:
+            schema = infer_schema(record)
+
+        dtype = np.dtype([(str(f), t) for f, t in schema])
+        self.dtypes[channel] = dtype
+        self.defaults[channel] = np.zeros(1, dtype)[0].tolist()
+        self.rows[channel] = []
+        self.counts[channel] = self.wrapper.connection.llen(
+            self.chunks_key(channel))
+        pipe.hset(self.schemas_key(), channel, json.dumps(schema))
+
+    def append(self, channel, record, pipe=None):
+        """
+        append a record of channel, values are copied.
+        :param channel: string
+        :param record: dict, with datetime times.
+        :param pipe: redis pipeline to stage the writes in. Default is to
+            send them right away.
+        :return:
+        """
+        p = self.wrapper.connection if pipe is None else pipe
+        if channel not in self.dtypes:
+            self.__register(channel, record, p)
+
+        dtype = self.dtypes[channel]
+        row = list(self.defaults[channel])
+        for i, field in enumerate(dtype.names):
+            value = record.get(field)
+            if value is None:
+                continue
+            if field in time_fields and dtype[i] == np.int64 \
+                    and isinstance(value, datetime):
+                value = dt_to_filetime(value)
+            self.__check(channel, field, dtype[i], value)
+            row[i] = value
+
+        rows = self.rows[channel]
+        if not rows:
+            # chunk is indexed by its first record
+            value = record.get(INDEX_FIELD)
+            self.scores[channel] = dt_to_epoch(value) \
+                if isinstance(value, datetime) else None
+        rows.append(tuple(row))
+        if len(rows) >= self.chunk_size:
+            self.__push(channel, p)
+
+    @staticmethod
+    def __check(channel, field, dtype, value):
+        """
+        raise ValueError if value would be cast with loss to dtype.
+        """
+        if dtype.kind == 'U':
+            if len(str(value)) > dtype.itemsize // 4:
+                raise ValueError('Value of {} of {} is longer than {}.'.format(
+                    field, channel, dtype))
+        elif dtype.kind in 'iu':
+            if isinstance(value, (float, np.floating)) and \
+                    not float(value).is_integer():
+                raise ValueError('Value {} of {} of {} is not {}.'.format(
+                    value, field, channel, dtype))
+
+    def __push(self, channel, pipe):
+        """
+        pack buffered rows of channel and append them as one chunk.
+        """
+        chunk = np.array(self.rows[channel], dtype=self.dtypes[channel])
+        pipe.rpush(self.chunks_key(channel), chunk.tobytes())
+        if self.scores[channel] is not None:
+            pipe.zadd(self.index_key(channel),
+                      {self.counts[channel]: self.scores[channel]})
+        self.counts[channel] += 1
+        self.rows[channel] = []
+
+    def flush(self, pipe=None):
+        """
+        append partial chunks of all channels.
+        :param pipe: redis pipeline to stage the writes in.
+        :return: int, number of records appended.
+        """
+        p = self.wrapper.connection if pipe is None else pipe
+        count = 0
+        for channel, rows in self.rows.items():
+            if rows:
+                count += len(rows)
+                self.__push(channel, p)
+        return count
+
+    # ---------------------------------------------------------------------
+    def length(self, channel):
+        """
+        :return: int, number of chunks of channel.
+        """
+        return self.wrapper.connection.llen(self.chunks_key(channel))
+
+    def read(self, channel, first=0, last=-1, fields=None):
+        """
+        read chunks [first, last] of channel (negative indices count from
+        the end), in one round trip.
+        :param channel: string
+        :param first: int, index of first chunk.
+        :param last: int, index of last chunk.
+        :param fields: list of fields, None for all.
+        :return: dict, field -> numpy array, empty if channel has no data.
+        """
+        pipe = self.wrapper.pipeline()
+        pipe.hget(self.schemas_key(), channel)
+        pipe.lrange(self.chunks_key(channel), first, last)
+        schema, chunks = pipe.execute()
+        if schema is None:
+            return dict()
+
+        dtype = np.dtype([(str(f), t) for f, t in json.loads(schema)])
+        records = np.frombuffer(b''.join(chunks), dtype=dtype)
+        return {field: records[field]
+                for field in (fields or dtype.names)}
+
+    def read_range(self, channel, begin=None, end=None, fields=None):
+        """
+        read records of channel with exchange time in [begin, end], from
+        the chunks found in its time index. Records still buffered (not
+        flushed) are not read.
+        :param channel: string
+        :param begin: datetime, None for the first record.
+        :param end: datetime, None for the last record.
+        :param fields: list of fields, None for all.
+        :return: dict, field -> numpy array, empty if no chunk is in range.
+        """
+        # first chunk is the last one starting by begin, as its records
+        # may reach into the range.
+        index = self.index_key(channel)
+        lower = '-inf' if begin is None else dt_to_epoch(begin)
+        upper = '+inf' if end is None else dt_to_epoch(end)
+        pipe = self.wrapper.pipeline()
+        pipe.zrevrangebyscore(index, lower, '-inf', start=0, num=1)
+        pipe.zrangebyscore(index, lower, '+inf', start=0, num=1)
+        pipe.zrevrangebyscore(index, upper, '-inf', start=0, num=1)
+        before, after, last = pipe.execute()
+        first = before or after
+        if not first or not last or int(first[0]) > int(last[0]):
+            return dict()
+
+        columns = self.read(channel, int(first[0]), int(last[0]))
+        times = columns[INDEX_FIELD]
+        if times.dtype.kind == 'M':
+            bound = lambda dt: np.datetime64(dt, 'us')
+        else:
+            bound = dt_to_filetime
+        mask = np.ones(len(times), dtype=bool)
+        if begin is not None:
+            mask &= times >= bound(begin)
+        if end is not None:
+            mask &= times <= bound(end)
+        return {field: columns[field][mask]
+                for field in (fields or columns.keys())}
@@ -0,0 +1,168 @@
+import unittest
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from Athena.settings import AthenaConfig
+from Athena.utils import dt_to_filetime
+from Athena.data_handler.packed_store import PackedStore
+HTf = AthenaConfig.HermesTickFields
+
+__author__ = 'zed'
+
+
+class ListConnection(object):
+    """
+    redis connection stand-in, with hash sets, lists and sorted sets in
+    memory.
+    """
+    def __init__(self):
+        self.hashes = dict()
+        self.lists = dict()
+        self.zsets = dict()
+        self.staged = []
+
+    def pipeline(self, transaction=False):
+        return self
+
+    def execute(self):
+        results, self.staged = self.staged, []
+        return results
+
+    def hset(self, key, field, value):
+        self.hashes.setdefault(key, dict())[field] = value.encode('utf8')
+
+    def hget(self, key, field):
+        self.staged.append(self.hashes.get(key, dict()).get(field))
+
+    def rpush(self, key, value):
+        self.lists.setdefault(key, []).append(value)
+
+    def lrange(self, key, first, last):
+        chunks = self.lists.get(key, [])
+        last = len(chunks) + last if last < 0 else last
+        self.staged.append(chunks[first:last + 1])
+
+    def llen(self, key):
+        return len(self.lists.get(key, []))
+
+    def zadd(self, key, mapping):
+        self.zsets.setdefault(key, dict()).update(mapping)
+
+    def zrangebyscore(self, key, low, high, start=None, num=None,
+                      reverse=False):
+        members = sorted(self.zsets.get(key, dict()).items(),
+                         key=lambda x: x[1], reverse=reverse)
+        members = [str(m).encode('utf8') for m, score in members
+                   if float(low) <= score <= float(high)]
+        self.staged.append(members[:num])
+
+    def zrevrangebyscore(self, key, high, low, start=None, num=None):
+        self.zrangebyscore(key, low, high, start, num, reverse=True)
+
+
+class Wrapper(object):
+    """
+    RedisWrapper stand-in.
+    """
+    def __init__(self):
+        self.connection = ListConnection()
+
+    def pipeline(self):
+        return self.connection
+
+
+class TestPackedStore(unittest.TestCase):
+    """
+    Test packed storage of records.
+    """
+    def test_append_read(self):
+        store = PackedStore(Wrapper(), chunk_size=4)
+        t0 = datetime(2016, 9, 29, 9, 30)
+
+        for i in range(10):
+            store.append('md:au1612', {
+                'tag': 'md',
+                HTf.ex_time: t0 + timedelta(seconds=i),
+                HTf.last_price: 300. + i,
+                HTf.volume: i,
+                'unknown': 'dropped'
+            })
+            store.append('signal:ma', {
+                'tag': 'ma', 'open_time': t0, '5': 1.5 * i, 'count': i})
+
+        # >>> only full chunks are pushed before flush
+        self.assertEqual(store.length('md:au1612'), 2)
+        self.assertEqual(store.flush(), 4)
+        self.assertEqual(store.length('md:au1612'), 3)
+
+        # >>> slices of chunks are unpacked to columns
+        columns = store.read('md:au1612', 1)
+        self.assertEqual(columns[HTf.last_price].tolist(),
+                         [304. + i for i in range(6)])
+        self.assertEqual(columns[HTf.ex_time][0],
+                         dt_to_filetime(t0 + timedelta(seconds=4)))
+        self.assertEqual(columns[HTf.bid_vol_1].tolist(), [0] * 6)
+
+        # >>> schemas of other channels are inferred
+        columns = store.read('signal:ma', -1, fields=['5', 'tag'])
+        self.assertEqual(columns['5'].tolist(), [12., 13.5])
+        self.assertEqual(columns['tag'].tolist(), ['ma', 'ma'])
+        self.assertEqual(store.read('signal:ma')['open_time'].dtype,
+                         np.dtype('datetime64[us]'))
+        self.assertEqual(store.read('signal:none'), dict())
+
+    def test_read_range(self):
+        wrapper = Wrapper()
+        store = PackedStore(wrapper, chunk_size=4)
+        t0 = datetime(2016, 9, 29, 9, 30)
+        for i in range(10):
+            store.append('md:au1612', {
+                'tag': 'md', HTf.ex_time: t0 + timedelta(seconds=i),
+                HTf.last_price: 300. + i})
+        store.flush()
+
+        # >>> chunks are indexed by their first exchange time
+        index = wrapper.connection.zsets[PackedStore.index_key('md:au1612')]
+        self.assertEqual(sorted(index), [0, 1, 2])
+
+        # >>> records in range are read from the chunks covering it
+        columns = store.read_range('md:au1612', t0 + timedelta(seconds=3),
+                                   t0 + timedelta(seconds=8),
+                                   fields=[HTf.last_price])
+        self.assertEqual(columns[HTf.last_price].tolist(),
+                         [303. + i for i in range(6)])
+        self.assertEqual(len(store.read_range('md:au1612')[HTf.ex_time]), 10)
+        self.assertEqual(store.read_range(
+            'md:au1612', end=t0 - timedelta(seconds=1)), dict())
+
+        # >>> numbering of chunks continues after restart
+        store = PackedStore(wrapper, chunk_size=4)
+        store.append('md:au1612', {
+            'tag': 'md', HTf.ex_time: t0 + timedelta(seconds=20)})
+        store.flush()
+        self.assertEqual(sorted(index), [0, 1, 2, 3])
+        columns = store.read_range('md:au1612', t0 + timedelta(seconds=9))
+        self.assertEqual(len(columns[HTf.ex_time]), 2)
+
+    def test_lossy_values(self):
+        store = PackedStore(Wrapper(), chunk_size=4)
+
+        # >>> numbers of inferred schemas are float, also if first is 0
+        store.append('signal:ma', {'tag': 'ma', '5': 0, 'x': None})
+        store.append('signal:ma', {'tag': 'ma', '5': 1.75, 'x': 0.5})
+        store.flush()
+        columns = store.read('signal:ma')
+        self.assertEqual(columns['5'].tolist(), [0., 1.75])
+        self.assertEqual(columns['x'].tolist(), [0., 0.5])
+
+        # >>> values that do not fit raise instead of being truncated
+        self.assertRaises(ValueError, store.append, 'signal:ma',
+                          {'tag': 'm' * 33})
+        self.assertRaises(ValueError, store.append, 'md:au1612', {
+            'tag': 'md', HTf.ex_time: datetime(2016, 9, 29, 9, 30),
+            HTf.volume: 1.5})
+
+
+if __name__ == '__main__':
+    unittest.main()
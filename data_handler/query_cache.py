@@ -0,0 +1,275 @@
+import os
+import json
+import shutil
+import hashlib
+from datetime import datetime
+
+import numpy as np
+
+from Athena.settings import AthenaConfig
+
+__author__ = 'zed'
+
+META_FILE = 'meta.json'
+COLUMN_SUFFIX = '.bin'
+
+
+def query_key(table, symbols, begin, end, columns, version=''):
+    """
+    content address of a historical query.
+    :param table: string
+    :param symbols: list of strings, in any order.
+    :param begin: datetime
+    :param end: datetime
+    :param columns: list of column names.
+    :param version: string, version of the content stored for the query,
+        like the conversion of rows (see make_dump.dump_version).
+    :return: string, sha1 hex digest.
+    """
+    query = json.dumps([
+        table,
+        sorted(symbols),
+        begin.strftime(AthenaConfig.sql_storage_dt_format),
+        end.strftime(AthenaConfig.sql_storage_dt_format),
+        list(columns),
+        version
+    ])
+    return hashlib.sha1(query.encode('utf8')).hexdigest()
+
+
+class CachedQuery(object):
+    """
+    Reader of one cached query result, columns are memory-mapped.
+    """
+    def __init__(self, path, meta):
+        """
+        constructor.
+        :param path: string, directory of the entry.
+        :param meta: dict, content of meta.json.
+        """
+        self.path = path
+        self.meta = meta
+        self.count = meta['count']
+
+    def column(self, name):
+        """
+        :param name: string
+        :return: numpy array, labels of string columns are restored.
+        """
+        dtype = dict(self.meta['fields'])[name]
+        if not self.count:
+            values = np.zeros(0, dtype)
+        else:
+            values = np.memmap(os.path.join(self.path, name + COLUMN_SUFFIX),
+                               dtype=dtype, mode='r')
+        labels = self.meta['labels'].get(name)
+        if labels is not None:
+            values = np.array(labels)[values]
+        return values
+
+    def iter_batches(self, batch_size=10000):
+        """
+        iterate through the result in batches.
+        :param batch_size: int, rows per batch.
+        :return: generator of dicts, column -> numpy array.
+        """
+        columns = {name: self.column(name)
+                   for name, dtype in self.meta['fields']}
+        for i in range(0, self.count, batch_size):
+            yield {name: values[i:i + batch_size]
+                   for name, values in columns.items()}
+
+
+class CacheWriter(object):
+    """
+    Writer of one query result, appended batch by batch and visible to
+    readers only after commit().
+    """
+    def __init__(self, cache, table, key):
+        """
+        constructor.
+        :param cache: QueryCache
+        :param table: string
+        :param key: string, query key.
+        """
+        self.cache = cache
+        self.path = cache.entry_dir(table, key)
+        self.temp_path = self.path + '.{}.tmp'.format(os.getpid())
+        os.makedirs(self.temp_path, exist_ok=True)
+
+        self.fields = None
+        self.labels = dict()
+        self.count = 0
+
+    def append(self, columns):
+        """
+        append a batch of columns. Columns of strings (or objects) are
+        stored as int32 codes of their labels.
+        :param columns: dict, column -> array-like, of the same length.
+        :return:
+        """
+        if self.fields is None:
+            self.fields = []
+            for name, values in columns.items():
+                values = np.asarray(values)
+                if values.dtype.kind in 'USO':
+                    self.labels[name] = dict()
+                    self.fields.append((name, 'int32'))
+                else:
+                    self.fields.append((name, values.dtype.str))
+
+        for name, dtype in self.fields:
+            values = np.asarray(columns[name])
+            if name in self.labels:
+                codes = self.labels[name]
+                values = [codes.setdefault(str(v), len(codes))
+                          for v in values.tolist()]
+            with open(os.path.join(self.temp_path, name + COLUMN_SUFFIX),
+                      'ab') as f:
+                np.asarray(values, dtype=dtype).tofile(f)
+        self.count += len(np.asarray(columns[self.fields[0][0]]))
+
+    def commit(self):
+        """
+        publish the entry, and evict least recently used entries.
+        :return: CachedQuery
+        """
+        meta = {
+            'fields': self.fields or [],
+            'labels': {name: sorted(codes, key=codes.get)
+                       for name, codes in self.labels.items()},
+            'count': self.count,
+            'created': datetime.now().strftime(AthenaConfig.dt_format)
+        }
+        with open(os.path.join(self.temp_path, META_FILE), 'w') as f:
+            json.dump(meta, f)
+
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.rename(self.temp_path, self.path)
+        self.cache.evict(keep=self.path)
+        return CachedQuery(self.path, meta)
+
+    def abort(self):
+        """
+        drop the entry being written.
+        :return:
+        """
+        shutil.rmtree(self.temp_path, ignore_errors=True)
+
+
+class QueryCache(object):
+    """
+    Local cache of results of historical SQL queries.
+
+    Entries are addressed by the content of the query (table, symbols,
+    time window, columns and the version of what is stored, see
+    query_key) and stored in columnar files,
+    one raw binary file per column:
+        root/<table>/<query key>/meta.json
+        root/<table>/<query key>/<column>.bin
+    The total size is bounded by max_bytes, least recently used entries are
+    evicted first (by modification time of meta.json, touched on every
+    hit). All entries of a table are dropped by invalidate(table), after
+    the table is rewritten.
+
+    Usage:
+    ----------------
+        cache = QueryCache()
+        cached = cache.get(table, symbols, begin, end, columns)
+        if cached is None:
+            writer = cache.writer(table, symbols, begin, end, columns)
+            for batch in ...:
+                writer.append(batch)
+            cached = writer.commit()
+        for batch in cached.iter_batches():
+            ...
+    """
+    def __init__(self, root=None, max_bytes=None):
+        """
+        constructor.
+        :param root: string, default is AthenaConfig.query_cache_root.
+        :param max_bytes: int, default is AthenaConfig.query_cache_max_bytes.
+        """
+        self.root = root or AthenaConfig.query_cache_root
+        self.max_bytes = max_bytes or AthenaConfig.query_cache_max_bytes
+
+    def entry_dir(self, table, key):
+        """
+        :return: string, directory of an entry.
+        """
+        return os.path.join(self.root, table, key)
+
+    def get(self, table, symbols, begin, end, columns, version=''):
+        """
+        :return: CachedQuery, None if not cached.
+        """
+        path = self.entry_dir(
+            table, query_key(table, symbols, begin, end, columns, version))
+        meta_path = os.path.join(path, META_FILE)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        # mark as recently used
+        os.utime(meta_path)
+        print('[Query Cache]: Hit {} rows of {}.'.format(meta['count'], table))
+        return CachedQuery(path, meta)
+
+    def writer(self, table, symbols, begin, end, columns, version=''):
+        """
+        :return: CacheWriter of the query.
+        """
+        return CacheWriter(self, table, query_key(
+            table, symbols, begin, end, columns, version))
+
+    def entries(self):
+        """
+        :return: list of (last used time, size, directory) of entries.
+        """
+        entries = []
+        if not os.path.isdir(self.root):
+            return entries
+        for table in os.listdir(self.root):
+            table_dir = os.path.join(self.root, table)
+            for key in os.listdir(table_dir):
+                path = os.path.join(table_dir, key)
+                meta_path = os.path.join(path, META_FILE)
+                if not os.path.exists(meta_path):
+                    continue
+                size = sum(os.path.getsize(os.path.join(path, name))
+                           for name in os.listdir(path))
+                entries.append((os.path.getmtime(meta_path), size, path))
+        return entries
+
+    def evict(self, keep=None):
+        """
+        drop least recently used entries until total size is within
+        max_bytes.
+        :param keep: string, directory of an entry never to drop.
+        :return: int, number of entries dropped.
+        """
+        entries = sorted(self.entries())
+        total = sum(size for t, size, path in entries)
+        count = 0
+        for t, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            count += 1
+        if count:
+            print('[Query Cache]: Evicted {} entries.'.format(count))
+        return count
+
+    def invalidate(self, table):
+        """
+        drop all entries of a table.
+        :param table: string
+        :return:
+        """
+        shutil.rmtree(os.path.join(self.root, table), ignore_errors=True)
+        print('[Query Cache]: Invalidated entries of {}.'.format(table))
@@ -0,0 +1,76 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+import numpy as np
+
+from Athena.data_handler.query_cache import QueryCache, query_key
+
+__author__ = 'zed'
+
+
+class TestQueryCache(unittest.TestCase):
+    """
+    Test local cache of query results.
+    """
+    def setUp(self):
+        """
+        :return:
+        """
+        self.root = tempfile.mkdtemp()
+        self.query = ('md_20160929', ['au1612', 'ag1612'],
+                      datetime(2016, 9, 29, 9), datetime(2016, 9, 29, 15),
+                      ['Symbol', 'LastPrice'])
+
+    def tearDown(self):
+        """
+        :return:
+        """
+        shutil.rmtree(self.root)
+
+    def write(self, cache, query, n):
+        writer = cache.writer(*query)
+        for i in range(0, n, 3):
+            writer.append({
+                'channel': np.array(['md.au1612', 'md.ag1612'] * 2)[:3],
+                'price': np.arange(i, i + 3, dtype=np.int64)
+            })
+        return writer.commit()
+
+    def test_cache(self):
+        cache = QueryCache(self.root)
+        self.assertIsNone(cache.get(*self.query))
+
+        # >>> results are addressed by content of query
+        self.write(cache, self.query, 6)
+        table, symbols, begin, end, columns = self.query
+        cached = cache.get(table, symbols[::-1], begin, end, columns)
+        self.assertEqual(cached.count, 6)
+        self.assertNotEqual(query_key(*self.query),
+                            query_key(table, symbols, begin, end, ['Symbol']))
+        self.assertIsNone(cache.get(*self.query, version='kl.2'))
+
+        # >>> read back in batches, strings are restored
+        batches = list(cached.iter_batches(4))
+        self.assertEqual(batches[0]['price'].tolist(), [0, 1, 2, 3])
+        self.assertEqual(batches[1]['channel'].tolist(),
+                         ['md.ag1612', 'md.au1612'])
+
+        # >>> least recently used entries are evicted
+        cache.max_bytes = os.path.getsize(
+            os.path.join(cached.path, 'price.bin')) * 3
+        other = (table, ['cu1612'], begin, end, columns)
+        os.utime(os.path.join(cached.path, 'meta.json'), (0, 0))
+        self.write(cache, other, 6)
+        self.assertIsNone(cache.get(*self.query))
+        self.assertIsNotNone(cache.get(*other))
+
+        # >>> entries of a table are invalidated
+        cache.invalidate(table)
+        self.assertIsNone(cache.get(*other))
+
+
+if __name__ == '__main__':
+    unittest.main()
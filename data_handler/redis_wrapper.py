@@ -1,18 +1,81 @@
+import os
+import time
+import heapq
+import numbers
+import threading
+from datetime import datetime
+from itertools import islice
+
 import redis
 
 from Athena.settings import AthenaConfig
+from Athena.utils import dt_to_epoch
 
 __author__ = 'zed'
 
+# (process id, host, port, db) -> redis client
+_clients = dict()
+_clients_lock = threading.Lock()
+
+# hosts of local server, reached by unix domain socket if configured
+LOCAL_HOSTS = ('localhost', '127.0.0.1')
+
+
+def connection_kwargs(host_name, port, db):
+    """
+    keyword arguments of redis clients (sync or asyncio) to a db, by
+    AthenaConfig: unix domain socket for local server if
+    redis_unix_socket is set, TCP with keep-alive otherwise.
+    :param host_name: string
+    :param port: int
+    :param db: int
+    :return: dict
+    """
+    kwargs = {
+        'db': db,
+        # blocking reads of pub/sub listeners never time out
+        'socket_timeout': None,
+        'health_check_interval': AthenaConfig.redis_health_check_interval,
+        'max_connections': AthenaConfig.redis_max_connections
+    }
+    if AthenaConfig.redis_unix_socket and host_name in LOCAL_HOSTS:
+        kwargs['unix_socket_path'] = AthenaConfig.redis_unix_socket
+    else:
+        kwargs['host'] = host_name
+        kwargs['port'] = port
+        kwargs['socket_keepalive'] = AthenaConfig.redis_socket_keepalive
+    return kwargs
+
+
+def get_client(host_name, port, db):
+    """
+    redis client of a db, shared by all wrappers of this process. Each
+    client draws connections from its own pool, commands of different
+    wrappers (and threads) reuse idle connections.
+    :param host_name: string
+    :param port: int
+    :param db: int
+    :return: redis.Redis
+    """
+    key = (os.getpid(), host_name, port, db)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = redis.Redis(**connection_kwargs(host_name, port, db))
+            _clients[key] = client
+    return client
+
 
 class RedisWrapper(object):
     """
-    The implementation of Redis api. Each instance will maintain a connection
-    to redis server.
+    The implementation of Redis api.
 
-    In current design. we expect to open a connection in each independent
-    module/instances that fetches data from the queue (which is now
-    represented by redis db), and push event in it.
+    Wrappers of one process share one client (and its connection pool) per
+    (host, port, db), see get_client: connections are opened on demand and
+    reused by all modules/instances of the process that fetch data from the
+    queue (which is now represented by redis db) and push events in it,
+    instead of one connection per instance. Pub/sub listeners hold one
+    connection each while subscribed.
 
     (* Note that the default limit of number of connection to redis server
     is about 10000
@@ -47,14 +110,10 @@ class RedisWrapper(object):
         :return:
         """
         try:
-            self.connection = redis.Redis(host=host_name, port=port, db=db)
+            self.connection = get_client(host_name, port, db)
         except redis.RedisError:
             print('<Error>[Redis]: Could not open connection to Redis.')
 
-    def __shut_down(self):
-        """shut down current connection"""
-        self.connection.shutdown()
-
     def assert_db_index(self, db):
         """
         assure the api connect to targeting database. If not, close connection
@@ -65,7 +124,7 @@ class RedisWrapper(object):
         try:
             assert self.db_name == db
         except AssertionError:
-            self.__shut_down()
+            self.db_name = db
             self.__login(self.host_name, self.port, db)
 
     def flush_all(self):
@@ -90,6 +149,30 @@ class RedisWrapper(object):
         self.connection.flushdb()
         print('[Redis]: Cleaned up keys in db_{}.'.format(self.db_name))
 
+    @staticmethod
+    def hash_values(data):
+        """
+        values of a record as stored in hash sets, regardless of the codec
+        of published messages: datetime formatted as AthenaConfig.dt_format,
+        None as empty string, bool as str and numpy numbers as int/float.
+        :param data: dict
+        :return: dict
+        """
+        values = dict()
+        for field, value in data.items():
+            if isinstance(value, datetime):
+                value = value.strftime(AthenaConfig.dt_format)
+            elif value is None:
+                value = ''
+            elif isinstance(value, bool):
+                value = str(value)
+            elif isinstance(value, numbers.Integral):
+                value = int(value)
+            elif isinstance(value, numbers.Real):
+                value = float(value)
+            values[field] = value
+        return values
+
     def set_dict(self, key, data):
         """
         Set one hash set by key & input python dictionary data.
@@ -97,7 +180,96 @@ class RedisWrapper(object):
         :param data: dict, the data to be set.
         :return:
         """
-        self.connection.hmset(key, data)
+        self.connection.hmset(key, self.hash_values(data))
+
+    @staticmethod
+    def index_key(channel):
+        """
+        :param channel: str, channel (directory) of keys.
+        :return: str, key of the time index of channel.
+        """
+        return AthenaConfig.redis_index_prefix + channel
+
+    @staticmethod
+    def index_score(value):
+        """
+        :param value: datetime, datetime string (AthenaConfig.dt_format) or
+            number (count).
+        :return: float, score in time indices.
+        """
+        if type(value) == str:
+            value = datetime.strptime(value, AthenaConfig.dt_format)
+        if isinstance(value, datetime):
+            return dt_to_epoch(value)
+        return float(value)
+
+    def set_indexed_dict(self, channel, key, data, score, pipe=None):
+        """
+        Set one hash set and add its key to the time index of channel, so
+        that records can be queried by range (get_range).
+        :param channel: str, channel (directory) of the key.
+        :param key: str, value of the key.
+        :param data: dict, the data to be set.
+        :param score: datetime/number, event time or count of the record.
+        :param pipe: redis pipeline to stage the writes in. Default is to
+            send them in one round trip right away.
+        :return:
+        """
+        p = self.pipeline() if pipe is None else pipe
+        p.hmset(key, self.hash_values(data))
+        p.zadd(self.index_key(channel), {key: self.index_score(score)})
+        if pipe is None:
+            p.execute()
+
+    def get_range(self, channel, begin='-inf', end='+inf', limit=None,
+                  reverse=False, remove=False):
+        """
+        Get hash sets of channel with scores (event time or count) in
+        [begin, end] from its time index, in order of score. Costs one
+        range lookup and one pipelined batch, regardless of number of keys
+        in db. Records of packed storage are not indexed here, see
+        PackedStore.read_range.
+        :param channel: str, channel (directory) of keys.
+        :param begin: datetime/number, or redis score bound like '(12'.
+        :param end: datetime/number, or redis score bound.
+        :param limit: int, max number of records, None for all.
+        :param reverse: bool, take records from the end (latest first).
+        :param remove: bool, delete returned records and their index.
+        :return: list of dict
+        """
+        index = self.index_key(channel)
+        if isinstance(begin, datetime):
+            begin = dt_to_epoch(begin)
+        if isinstance(end, datetime):
+            end = dt_to_epoch(end)
+
+        start = None if limit is None else 0
+        if reverse:
+            keys = self.connection.zrevrangebyscore(
+                index, end, begin, start=start, num=limit)
+        else:
+            keys = self.connection.zrangebyscore(
+                index, begin, end, start=start, num=limit)
+        if not keys:
+            return []
+
+        pipe = self.pipeline()
+        for k in keys:
+            pipe.hgetall(k)
+        if remove:
+            pipe.delete(*keys)
+            pipe.zrem(index, *keys)
+        return [self.__decode_dict(k, d_byte) for k, d_byte
+                in zip(keys, pipe.execute())]
+
+    def pipeline(self, transaction=False):
+        """
+        make a pipeline on current connection. Commands staged in the
+        pipeline are sent to server in one round trip on execute().
+        :param transaction: bool, whether to wrap commands in MULTI/EXEC.
+        :return: redis pipeline object.
+        """
+        return self.connection.pipeline(transaction=transaction)
 
     def get_dict(self, key):
         """
@@ -113,41 +285,199 @@ class RedisWrapper(object):
                      [v.decode('utf8') for v in d_byte.values()]))
         return d
 
-    def get_keys(self, pattern='*', sort=True):
+    def get_dicts(self, keys):
+        """
+        Get hash sets of a batch of keys in one round trip (pipelined).
+        Hash sets that could not be decoded are returned as None.
+        :param keys: list of keys.
+        :return: list of dict
+        """
+        pipe = self.connection.pipeline(transaction=False)
+        for k in keys:
+            pipe.hgetall(k)
+
+        return [self.__decode_dict(k, d_byte)
+                for k, d_byte in zip(keys, pipe.execute())]
+
+    @staticmethod
+    def __decode_dict(key, d_byte):
+        """
+        :param key: key of hash set.
+        :param d_byte: dict of bytes, from HGETALL.
+        :return: dict, None if could not be decoded.
+        """
+        try:
+            return dict(zip([f.decode('utf8') for f in d_byte.keys()],
+                            [v.decode('utf8') for v in d_byte.values()]))
+        except UnicodeError:
+            print('[Redis]: Unicode error at key {}.'.format(key))
+            return None
+
+    def get_keys(self, pattern='*', sort=True, count=None, key_type=None):
         """
-        make a list of keys in db that matches (regex) pattern.
+        make a list of keys in db that matches (regex) pattern. Keys are
+        scanned incrementally (see iter_keys), the server is never blocked
+        for the whole scan.
         :param pattern: string, regex pattern to match the keys.
         :param sort: boolean, whether to sort the returned keys list.
-        :return:
+        :param count: int, number of keys scanned per round trip.
+        :param key_type: string, only keys of this type, like 'hash'.
+        :return: list of keys.
         """
-        keys = self.connection.keys(pattern=pattern)
+        # SCAN may return a key more than once
+        keys = list(set(self.iter_keys(pattern, count, key_type)))
         if sort:
             keys.sort()
         return keys
 
-    def migrate_keys(self, keys_list, target_db):
+    def iter_keys(self, pattern='*', count=None, key_type=None):
         """
-        migrate list of keys to a different db.
-        :param keys_list:
-        :param target_db:
-        :return:
+        iterate through keys in db that matches (regex) pattern. Keys are
+        scanned incrementally (SCAN), in no particular order, and a key may
+        be returned more than once.
+        :param pattern: string, regex pattern to match the keys.
+        :param count: int, number of keys scanned per round trip, default
+            is AthenaConfig.redis_scan_count.
+        :param key_type: string, only keys of this type, like 'hash',
+            filtered by the server if AthenaConfig.redis_scan_type,
+            otherwise by pipelined TYPE commands of each batch.
+        :return: generator of keys.
+        """
+        count = count or AthenaConfig.redis_scan_count
+        if key_type is None or AthenaConfig.redis_scan_type:
+            return self.connection.scan_iter(
+                match=pattern, count=count, _type=key_type)
+        return self.__filter_type(
+            self.connection.scan_iter(match=pattern, count=count),
+            key_type, count)
+
+    def __filter_type(self, keys, key_type, batch_size):
+        """
+        filter keys by type on the client, batch by batch.
+        :param keys: iterable of keys.
+        :param key_type: string
+        :param batch_size: int, keys per round trip.
+        :return: generator of keys.
+        """
+        key_type = key_type.encode('utf8')
+        keys = iter(keys)
+        while True:
+            batch = list(islice(keys, batch_size))
+            if not batch:
+                return
+            pipe = self.connection.pipeline(transaction=False)
+            for k in batch:
+                pipe.type(k)
+            for k, t in zip(batch, pipe.execute()):
+                if t == key_type:
+                    yield k
+
+    def iter_sorted_keys(self, patterns, count=None, key_type=None):
+        """
+        iterate through keys matching any of patterns in ascending order,
+        without duplicates. Keys of each pattern are scanned and sorted
+        separately, then merged.
+        :param patterns: list of patterns, like ['md.*:*', 'kl.*:*'].
+        :param count: int, number of keys scanned per round trip.
+        :param key_type: string, only keys of this type.
+        :return: generator of keys.
+        """
+        last = None
+        for k in heapq.merge(*[self.get_keys(p, True, count, key_type)
+                               for p in patterns]):
+            if k != last:
+                yield k
+                last = k
+
+    def migrate_keys(self, keys_list, target_db, batch_size=10000,
+                     target=None, replace=False, background=False):
+        """
+        migrate keys to a different db, batch by batch. Each batch is one
+        pipelined round trip of MOVE commands, or, to a db of another
+        server (target), pipelined DUMP/PTTL, RESTORE and DEL. Keys that
+        already exist in target db are not moved (unless replace, with
+        target). Keys may be any iterable, like iter_keys(pattern), so
+        that keys are scanned while being migrated.
+        :param keys_list: iterable of keys.
+        :param target_db: int, index of target db.
+        :param batch_size: int, number of keys per round trip.
+        :param target: RedisWrapper, connected to target db of another
+            server. Default is target_db of this server.
+        :param replace: bool, replace existing keys in target (with target).
+        :param background: bool, run in a background thread.
+        :return: int, number of keys migrated, or the started thread if
+            background.
         """
         if target_db == AthenaConfig.hermes_db_index \
                 and self.hermes_db_protected:
             print('[Redis]: The attempt to migrate to Hermes db is rejected.')
-            return
+            return 0
+
+        if background:
+            thread = threading.Thread(
+                target=self.migrate_keys,
+                args=(keys_list, target_db, batch_size, target, replace),
+                daemon=True
+            )
+            thread.start()
+            return thread
 
-        N = len(keys_list)
+        start_time = time.time()
+        keys = iter(keys_list)
         counter = 0
+        while True:
+            batch = list(islice(keys, batch_size))
+            if not batch:
+                break
+
+            if target is None:
+                counter += self.__move_batch(batch, target_db)
+            else:
+                counter += self.__copy_batch(batch, target, replace)
+
+            print('[Redis]: Migrated {} keys, {} keys per second.'.format(
+                counter,
+                round(counter / max(time.time() - start_time, 1e-6))
+            ), flush=True)
+        return counter
+
+    def __move_batch(self, batch, target_db):
+        """
+        move a batch of keys to target_db of this server.
+        :return: int, number of keys moved.
+        """
+        pipe = self.pipeline()
+        for k in batch:
+            pipe.move(k, target_db)
+        return sum(1 for moved in pipe.execute() if moved)
+
+    def __copy_batch(self, batch, target, replace):
+        """
+        move a batch of keys to target (another server) by DUMP/RESTORE.
+        :return: int, number of keys moved.
+        """
+        pipe = self.pipeline()
+        for k in batch:
+            pipe.dump(k)
+            pipe.pttl(k)
+        results = pipe.execute()
 
-        for k in keys_list:
-            self.connection.move(k, target_db)
+        # restore serialized values, with their time to live
+        restored = []
+        target_pipe = target.pipeline()
+        for k, value, ttl in zip(batch, results[::2], results[1::2]):
+            if value is None:
+                continue
+            target_pipe.restore(k, max(ttl, 0), value, replace=replace)
+            restored.append(k)
+        results = target_pipe.execute(raise_on_error=False)
 
-            # increment to counter
-            counter += 1
-            if not counter % 10000:
-                print('[Redis]: Migrated {} %.'.format(
-                    round(100 * counter / N, 2)), flush=True)
+        # delete keys restored in target
+        moved = [k for k, result in zip(restored, results)
+                 if not isinstance(result, Exception)]
+        if moved:
+            self.connection.delete(*moved)
+        return len(moved)
 
     def reset_key(self, val_1, val_2):
         """
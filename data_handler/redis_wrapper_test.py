@@ -13,8 +13,19 @@ if __name__ == '__main__':
 
     keys = r.get_keys('GC1612:*')
     print(keys)
+    print(list(r.iter_sorted_keys(['GC1612:000000[12]', 'GC1612:*'],
+                                  key_type='hash')))
     for k in keys:
         print(r.get_dict(k))
 
+    # time index
+    for i in range(10):
+        r.set_indexed_dict('GC1612', 'GC1612:00000{}'.format(i + 10),
+                           {'bid': i, 'ask': 50}, i)
+    print(r.get_range('GC1612', 3, 5))
+    print(r.get_range('GC1612', '(7', limit=1))
+    print(r.get_range('GC1612', limit=2, reverse=True, remove=True))
+    print(r.connection.zcard(r.index_key('GC1612')))
+
 
 
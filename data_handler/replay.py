@@ -0,0 +1,294 @@
+import time
+import heapq
+import queue
+import threading
+from array import array
+from itertools import islice
+
+__author__ = 'zed'
+
+
+# -------------------------------------------------------------------------
+def scan_channel_times(wrapper, directory, count=1000):
+    """
+    scan the keys of one Hermes directory and return their time suffixes
+    in ascending order. Hermes keys are 'directory:filetime'.
+    :param wrapper: RedisWrapper
+    :param directory: string, like 'md.uftreal.au1612'
+    :param count: int, number of keys scanned per round trip.
+    :return: array of int64
+    """
+    prefix_length = len(directory) + 1
+    times = array('q')
+    for k in wrapper.iter_keys('{}:*'.format(directory), count=count):
+        try:
+            times.append(int(k[prefix_length:]))
+        except ValueError:
+            print('[Replay]: Illegal key {}.'.format(k))
+    return array('q', sorted(times))
+
+
+def scan_directories(wrapper, pattern='*', count=1000):
+    """
+    scan the keys matching pattern in one pass, and group their time
+    suffixes by directory. Keys are 'directory:filetime'. Every key is
+    scanned before returning, for consumers of whole directories (counts
+    and row ids of migrations); replaying reads directories lazily, see
+    merge_hermes_channels.
+    :param wrapper: RedisWrapper
+    :param pattern: string, pattern of keys, like 'md.*[:]*'.
+    :param count: int, number of keys scanned per round trip.
+    :return: dict, directory -> sorted array of int64 time suffixes.
+    """
+    directory_times = dict()
+    for k in wrapper.iter_keys(pattern, count=count):
+        directory, _, suffix = k.rpartition(b':')
+        try:
+            t = int(suffix)
+        except ValueError:
+            print('[Replay]: Illegal key {}.'.format(k))
+            continue
+        if directory not in directory_times:
+            directory_times[directory] = array('q')
+        directory_times[directory].append(t)
+
+    return {directory.decode('utf8'): array('q', sorted(times))
+            for directory, times in directory_times.items()}
+
+
+def iter_channel_keys(directory, times, order):
+    """
+    iterate through keys of one directory in time order.
+    :param directory: string
+    :param times: sorted array of time suffixes.
+    :param order: int, rank of the directory on ties of time.
+    :return: generator of (time, order, key) tuples.
+    """
+    prefix = directory + ':'
+    for t in times:
+        yield t, order, (prefix + str(t)).encode('utf8')
+
+
+def iter_indexed_keys(wrapper, directory, order, count=1000):
+    """
+    iterate through keys of one directory in time order, from its time
+    index (see RedisWrapper.set_indexed_dict, scored by time suffix).
+    Slices of count keys are read as the consumer drains them.
+    :param wrapper: RedisWrapper
+    :param directory: string
+    :param order: int, rank of the directory on ties of time.
+    :param count: int, number of keys read per round trip.
+    :return: generator of (time, order, key) tuples.
+    """
+    index = wrapper.index_key(directory)
+    start = 0
+    while True:
+        keys = wrapper.connection.zrange(index, start, start + count - 1)
+        for k in keys:
+            # scores are rounded, times are exact
+            try:
+                t = int(k.rpartition(b':')[2])
+            except ValueError:
+                print('[Replay]: Illegal key {}.'.format(k))
+                continue
+            yield t, order, k
+        if len(keys) < count:
+            return
+        start += count
+
+
+def merge_hermes_channels(wrapper, directories, count=1000):
+    """
+    merge the keys of several Hermes directories in time order.
+
+    Directories (one instrument's md, or one instrument's kline of one
+    duration) with a time index (index:<directory>, kept by HermesPipe)
+    are read from it lazily, count keys at a time as the merge drains
+    them, so that the first keys come after one round trip per
+    directory. Directories without index are scanned, when the first key
+    is asked for, into a compact sorted array of time suffixes. The
+    per-directory streams are merged with a heap, instead of sorting one
+    list of all keys. On ties of time, keys of the directory listed first
+    come first.
+    :param wrapper: RedisWrapper, connected to the Hermes db.
+    :param directories: list of strings.
+    :param count: int, number of keys read per round trip.
+    :return: generator of keys (bytes).
+    """
+    pipe = wrapper.pipeline()
+    for directory in directories:
+        pipe.exists(wrapper.index_key(directory))
+    indexed = pipe.execute()
+
+    streams = []
+    for order, directory in enumerate(directories):
+        if indexed[order]:
+            streams.append(
+                iter_indexed_keys(wrapper, directory, order, count))
+        else:
+            streams.append(iter_channel_keys(
+                directory, scan_channel_times(wrapper, directory, count),
+                order))
+
+    for t, order, key in heapq.merge(*streams):
+        yield key
+
+
+def merge_directory_times(directory_times):
+    """
+    merge the keys of scanned directories in time order, lazily with a
+    heap. On ties of time, keys of the directory listed first come first.
+    :param directory_times: list of (directory, sorted array of times).
+    :return: generator of keys (bytes).
+    """
+    streams = [iter_channel_keys(directory, times, order)
+               for order, (directory, times) in enumerate(directory_times)]
+
+    for t, order, key in heapq.merge(*streams):
+        yield key
+
+
+# -------------------------------------------------------------------------
+class PrefetchReader(object):
+    """
+    Reader of hash sets for historical replay.
+
+    Keys are consumed in order and their hash sets are fetched in
+    pipelined batches (one round trip per batch) by a background thread,
+    which keeps up to `prefetch` batches in flight while the current batch
+    is being cleaned and published.
+
+    Iterating the reader yields (key, row) tuples in the order of keys,
+    row is None if the hash set could not be decoded.
+    """
+    def __init__(self, wrapper, keys, batch_size=1000, prefetch=2):
+        """
+        constructor.
+        :param wrapper: RedisWrapper
+        :param keys: iterable of keys, consumed by the background thread.
+        :param batch_size: int, number of hash sets per round trip.
+        :param prefetch: int, number of batches fetched in advance.
+        """
+        self.wrapper = wrapper
+        self.keys = iter(keys)
+        self.batch_size = batch_size
+
+        self.__batches = queue.Queue(maxsize=prefetch)
+        self.__stopped = threading.Event()
+        self.__thread = threading.Thread(target=self.__fetch, daemon=True)
+        self.__thread.start()
+
+    def __put(self, item):
+        """
+        put item into queue unless reader is closed.
+        :return: bool, whether the item is put.
+        """
+        while not self.__stopped.is_set():
+            try:
+                self.__batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __fetch(self):
+        """
+        background thread, fetch batches until keys are exhausted.
+        """
+        try:
+            while True:
+                batch = list(islice(self.keys, self.batch_size))
+                if not batch:
+                    break
+                rows = self.wrapper.get_dicts(batch)
+                if not self.__put(list(zip(batch, rows))):
+                    return
+        except Exception as e:
+            # hand the error over to the consumer
+            self.__put(e)
+            return
+        self.__put(None)
+
+    def __iter__(self):
+        while True:
+            batch = self.__batches.get()
+            if batch is None:
+                return
+            if isinstance(batch, Exception):
+                raise batch
+            for key, row in batch:
+                yield key, row
+
+    def close(self):
+        """
+        stop prefetching.
+        """
+        self.__stopped.set()
+
+
+# -------------------------------------------------------------------------
+class ReplayClock(object):
+    """
+    Replay clock driven by the event time of replayed rows.
+
+    Modes:
+    ----------------
+    * as fast as possible: speed is None and step is 0.
+    * scaled real time: speed=N, the event time elapses N times faster than
+        real time, so the bursts and gaps of market data are preserved.
+    * stepped: step=s, a fixed wall time interval of s seconds per row.
+
+    In scaled real time, the due wall time of each row is computed from the
+    wall time of the first row and the event time elapsed since, rather
+    than by sleeping the gap between consecutive rows, so oversleeping and
+    processing time do not accumulate drift. When replaying falls behind,
+    rows are not delayed until it catches up.
+
+    Gaps of event time longer than max_gap seconds (between sessions,
+    over night...) are shortened to max_gap.
+
+    public attributes:
+    ----------------
+    * now: datetime, current simulated time (latest event time).
+    """
+    # sleeps shorter than this are skipped (seconds)
+    _min_delay = 0.001
+
+    def __init__(self, speed=None, step=0, max_gap=None):
+        """
+        constructor.
+        :param speed: float, multiple of real time.
+        :param step: float, seconds between rows in stepped mode.
+        :param max_gap: float, longest gap of event time, in seconds.
+        """
+        self.speed = speed
+        self.step = step
+        self.max_gap = max_gap
+
+        self.now = None
+        self.__wall_origin = None
+        self.__elapsed = 0.
+
+    def advance(self, event_time):
+        """
+        advance simulated time to event_time.
+        :param event_time: datetime
+        :return: float, seconds to wait before the row is due.
+        """
+        if self.now is None:
+            self.now = event_time
+            self.__wall_origin = time.time()
+        elif event_time > self.now:
+            gap = (event_time - self.now).total_seconds()
+            if self.max_gap is not None:
+                gap = min(gap, self.max_gap)
+            self.__elapsed += gap
+            self.now = event_time
+
+        if self.step:
+            return self.step
+        if not self.speed:
+            return 0
+
+        delay = self.__wall_origin + self.__elapsed / self.speed - time.time()
+        return delay if delay > self._min_delay else 0
@@ -0,0 +1,156 @@
+import unittest
+from datetime import datetime, timedelta
+
+from Athena.data_handler.replay import merge_hermes_channels, \
+    scan_directories, merge_directory_times, PrefetchReader, ReplayClock
+
+__author__ = 'zed'
+
+
+class KeysWrapper(object):
+    """
+    RedisWrapper stand-in serving a fixed set of keys and hash sets, and
+    time indices of some directories.
+    """
+    def __init__(self, keys, indices=None):
+        self.keys = keys
+        self.indices = indices or dict()
+        self.connection = self
+        self.staged = []
+        self.commands = []
+
+    @staticmethod
+    def index_key(channel):
+        return 'index:' + channel
+
+    def pipeline(self):
+        return self
+
+    def exists(self, key):
+        self.staged.append(int(key in self.indices))
+
+    def execute(self):
+        results, self.staged = self.staged, []
+        return results
+
+    def zrange(self, key, start, end):
+        self.commands.append(('zrange', key, start))
+        return self.indices[key][start:end + 1]
+
+    def iter_keys(self, pattern='*', count=1000):
+        self.commands.append(('scan', pattern))
+        prefix = pattern.rstrip('*').encode('utf8')
+        return (k for k in self.keys if k.startswith(prefix))
+
+    def get_dicts(self, keys):
+        return [{'key': k.decode('utf8')} for k in keys]
+
+
+class TestReplay(unittest.TestCase):
+    """
+    Test replaying utilities.
+    """
+    def setUp(self):
+        """
+        :return:
+        """
+        self.wrapper = KeysWrapper([
+            b'md.uftreal.au1612:131145893930000000',
+            b'md.uftreal.au1612:131145893910000000',
+            b'kl.uftreal.au1612.1m:131145893910000000',
+            b'kl.uftreal.au1612.1m:131145893900000000',
+            b'md.ksdreal.Au(T+D):131145893920000000',
+        ])
+        self.directories = [
+            'md.uftreal.au1612',
+            'md.ksdreal.Au(T+D)',
+            'kl.uftreal.au1612.1m'
+        ]
+
+    def test_merge_channels(self):
+        keys = list(merge_hermes_channels(self.wrapper, self.directories))
+
+        # >>> keys of all directories, in time order
+        self.assertEqual(keys, [
+            b'kl.uftreal.au1612.1m:131145893900000000',
+            b'md.uftreal.au1612:131145893910000000',
+            b'kl.uftreal.au1612.1m:131145893910000000',
+            b'md.ksdreal.Au(T+D):131145893920000000',
+            b'md.uftreal.au1612:131145893930000000',
+        ])
+
+    def test_merge_indexed_channels(self):
+        ag = [b'md.uftreal.ag1612:1311458939%d5000000' % i
+              for i in range(6)]
+        self.wrapper.indices['index:md.uftreal.ag1612'] = ag
+        directories = self.directories + ['md.uftreal.ag1612']
+        keys = merge_hermes_channels(self.wrapper, directories, count=2)
+
+        # >>> indexed directories are read a slice at a time, others are
+        # scanned
+        self.assertEqual(next(keys),
+                         b'kl.uftreal.au1612.1m:131145893900000000')
+        self.assertEqual(len([c for c in self.wrapper.commands
+                              if c[0] == 'zrange']), 1)
+        self.assertEqual(len([c for c in self.wrapper.commands
+                              if c[0] == 'scan']), 3)
+
+        # >>> and merged in time order, ties in order of directories
+        keys = [next(keys) for i in range(5)]
+        self.assertEqual(keys, [
+            ag[0],
+            b'md.uftreal.au1612:131145893910000000',
+            b'kl.uftreal.au1612.1m:131145893910000000',
+            ag[1],
+            b'md.ksdreal.Au(T+D):131145893920000000'])
+        self.assertEqual(self.wrapper.commands[-1],
+                         ('zrange', 'index:md.uftreal.ag1612', 2))
+
+    def test_scan_directories(self):
+        directory_times = scan_directories(self.wrapper, 'md.*')
+
+        # >>> one pass over keys, grouped by directory
+        self.assertEqual(sorted(directory_times),
+                         ['md.ksdreal.Au(T+D)', 'md.uftreal.au1612'])
+        self.assertEqual(
+            list(directory_times['md.uftreal.au1612']),
+            [131145893910000000, 131145893930000000])
+        self.assertEqual(
+            list(merge_directory_times(sorted(directory_times.items()))), [
+                b'md.uftreal.au1612:131145893910000000',
+                b'md.ksdreal.Au(T+D):131145893920000000',
+                b'md.uftreal.au1612:131145893930000000',
+            ])
+
+    def test_prefetch_reader(self):
+        keys = list(merge_hermes_channels(self.wrapper, self.directories))
+        reader = PrefetchReader(self.wrapper, iter(keys), batch_size=2)
+
+        # >>> rows are read in order of keys, across batches
+        rows = list(reader)
+        self.assertEqual([k for k, row in rows], keys)
+        self.assertEqual(rows[-1][1]['key'], keys[-1].decode('utf8'))
+
+    def test_replay_clock(self):
+        t0 = datetime(2016, 9, 1, 9)
+
+        # >>> as fast as possible and stepped
+        clock = ReplayClock()
+        self.assertEqual(clock.advance(t0), 0)
+        clock = ReplayClock(step=0.5)
+        self.assertEqual(clock.advance(t0), 0.5)
+
+        # >>> scaled real time, gaps are shortened to max_gap
+        clock = ReplayClock(speed=1000, max_gap=60)
+        clock.advance(t0)
+        delay = clock.advance(t0 + timedelta(hours=10))
+        self.assertTrue(0 < delay <= 0.06)
+        self.assertEqual(clock.now, t0 + timedelta(hours=10))
+
+        # >>> events earlier than simulated time do not move the clock
+        clock.advance(t0)
+        self.assertEqual(clock.now, t0 + timedelta(hours=10))
+
+
+if __name__ == '__main__':
+    unittest.main()
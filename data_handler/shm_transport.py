@@ -0,0 +1,330 @@
+import time
+import struct
+import hashlib
+import platform
+from multiprocessing import shared_memory, resource_tracker
+
+from Athena.settings import AthenaConfig
+
+__author__ = 'zed'
+
+RING_MAGIC = 0x41544852
+
+# header: magic, slot size, slot count, reserved | write cursor
+_header = struct.Struct('<IIII')
+_cursor = struct.Struct('<Q')
+CURSOR_OFFSET = 16
+HEADER_SIZE = 64
+
+# slot: sequence | fragment length | fragment index | fragment count |
+# fragment of payload
+_slot_seq = struct.Struct('<Q')
+_slot_info = struct.Struct('<IHH')
+SLOT_HEADER_SIZE = 16
+MAX_FRAGMENTS = 0xffff
+
+# architectures whose stores (and loads) are not reordered with each other
+TSO_MACHINES = ('x86_64', 'amd64', 'i386', 'i686', 'x86')
+
+
+def segment_name(channel):
+    """
+    name of the shared memory segment of channel. Channel names are hashed,
+    since they contain characters not allowed in segment names.
+    :param channel: string
+    :return: string
+    """
+    return 'athena_' + hashlib.sha1(channel.encode('utf-8')).hexdigest()[:20]
+
+
+class RingBuffer(object):
+    """
+    Ring of fixed-size slots in a shared memory segment, written by one
+    process and read by any number of processes.
+
+    The single writer fills slot (n % slot_count) with the n-th fragment,
+    then advances the write cursor in the header. Messages longer than
+    the capacity of a slot are split over consecutive slots, each
+    fragment holds its index and the fragment count, and the cursor is
+    advanced past all of them at once. The sequence word of a slot is odd
+    while the slot is being written, and 2n+2 once it holds fragment n
+    (seqlock), so a reader that is lapped by the writer detects it and
+    skips the message instead of reading torn data. Readers keep their
+    own positions, no lock is taken on either side.
+
+    The seqlock issues no memory barrier: it relies on the stores of the
+    writer (payload, then sequence word, then cursor) becoming visible to
+    readers in program order, and on loads not being reordered either.
+    This holds on x86/x86-64 (total store order), where CPython performs
+    the stores of one thread in order. On weakly ordered CPUs (ARM,
+    POWER) a reader may see a sequence word before the payload it
+    guards; use the stream or pubsub transport there. A warning is
+    printed on other architectures.
+
+    Segments are not removed when processes exit, call unlink() once all
+    processes are done with the channel.
+    """
+    def __init__(self, channel, slot_size=None, slot_count=None):
+        """
+        constructor, creates the segment of channel or attaches to it.
+        :param channel: string
+        :param slot_size: int, bytes per slot, including slot header.
+        :param slot_count: int
+        """
+        if slot_size is None:
+            slot_size = AthenaConfig.shm_slot_size
+        if slot_count is None:
+            slot_count = AthenaConfig.shm_slot_count
+
+        if platform.machine().lower() not in TSO_MACHINES:
+            print('[Shared Memory]: Ring buffers are not safe on {}, '
+                  'see RingBuffer.'.format(platform.machine()))
+
+        self.channel = channel
+        self.name = segment_name(channel)
+        try:
+            self.shm = shared_memory.SharedMemory(
+                name=self.name, create=True,
+                size=HEADER_SIZE + slot_size * slot_count)
+            _header.pack_into(
+                self.shm.buf, 0, RING_MAGIC, slot_size, slot_count, 0)
+        except FileExistsError:
+            self.shm = shared_memory.SharedMemory(name=self.name)
+
+        # lifetime of segments is managed by unlink(), not by the tracker
+        # of the process.
+        resource_tracker.unregister(self.shm._name, 'shared_memory')
+
+        self.buf = self.shm.buf
+        # header may be being written by the creating process
+        for i in range(100):
+            magic, self.slot_size, self.slot_count, reserved = \
+                _header.unpack_from(self.buf, 0)
+            if magic:
+                break
+            time.sleep(0.01)
+        if magic != RING_MAGIC:
+            raise ValueError(
+                'Shared memory {} is not a ring buffer.'.format(self.name))
+        self.capacity = self.slot_size - SLOT_HEADER_SIZE
+
+        # next message to read
+        self.position = self.cursor
+
+    @property
+    def cursor(self):
+        """
+        :return: int, number of fragments written.
+        """
+        return _cursor.unpack_from(self.buf, CURSOR_OFFSET)[0]
+
+    def __offset(self, n):
+        """
+        :return: int, offset of the slot of fragment n.
+        """
+        return HEADER_SIZE + (n % self.slot_count) * self.slot_size
+
+    def write(self, payload):
+        """
+        write a message, by the single writer of channel.
+        :param payload: bytes
+        :return:
+        """
+        capacity = self.capacity
+        length = len(payload)
+        count = max(1, -(-length // capacity))
+        if count > min(self.slot_count, MAX_FRAGMENTS):
+            raise ValueError(
+                'Message of {} bytes exceeds ring capacity {} of {}.'.format(
+                    length, capacity * self.slot_count, self.channel))
+
+        buf = self.buf
+        n = self.cursor
+        for i in range(count):
+            fragment = payload[i * capacity:(i + 1) * capacity]
+            offset = self.__offset(n + i)
+            start = offset + SLOT_HEADER_SIZE
+
+            _slot_seq.pack_into(buf, offset, 2 * (n + i) + 1)
+            _slot_info.pack_into(buf, offset + 8, len(fragment), i, count)
+            buf[start:start + len(fragment)] = fragment
+            _slot_seq.pack_into(buf, offset, 2 * (n + i) + 2)
+        _cursor.pack_into(buf, CURSOR_OFFSET, n + count)
+
+    def read(self, max_count=100):
+        """
+        read messages written since last read.
+        :param max_count: int
+        :return: list of bytes.
+        """
+        buf = self.buf
+        cursor = self.cursor
+        if cursor - self.position > self.slot_count:
+            lost = cursor - self.slot_count - self.position
+            print('[Shared Memory]: Reader of {} is overrun, {} fragments'
+                  ' lost.'.format(self.channel, lost))
+            self.position = cursor - self.slot_count
+
+        messages = []
+        while self.position < cursor and len(messages) < max_count:
+            n = self.position
+            offset = self.__offset(n)
+            if _slot_seq.unpack_from(buf, offset)[0] != 2 * n + 2:
+                self.position += 1
+                print('[Shared Memory]: Reader of {} is overrun, message {}'
+                      ' lost.'.format(self.channel, n))
+                continue
+
+            length, index, count = _slot_info.unpack_from(buf, offset + 8)
+            if index or n + count > cursor:
+                # rest of a message whose first fragments were overrun
+                self.position += 1
+                continue
+
+            fragments = []
+            for i in range(count):
+                start = self.__offset(n + i) + SLOT_HEADER_SIZE
+                length = _slot_info.unpack_from(buf, start - 8)[0]
+                fragments.append(bytes(buf[start:start + length]))
+            self.position = n + count
+
+            # not overwritten while copying
+            if all(_slot_seq.unpack_from(buf, self.__offset(n + i))[0] ==
+                   2 * (n + i) + 2 for i in range(count)):
+                messages.append(b''.join(fragments))
+            else:
+                print('[Shared Memory]: Reader of {} is overrun, message {}'
+                      ' lost.'.format(self.channel, n))
+        return messages
+
+    def close(self):
+        """
+        detach from segment.
+        """
+        self.buf = None
+        self.shm.close()
+
+    def unlink(self):
+        """
+        detach from and remove segment.
+        """
+        # unlink() unregisters the segment from the tracker
+        resource_tracker.register(self.shm._name, 'shared_memory')
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
+        self.close()
+
+
+class SharedMemoryTransport(object):
+    """
+    Same-host transport over shared memory ring buffers, one ring per
+    channel (see RingBuffer). Messages are passed between processes
+    without going through redis; hash sets of records are still written
+    to redis by publishers.
+
+    Each channel must have one publishing process. Subscribers receive
+    messages published after they subscribed, and wait for new messages by
+    polling write cursors, sleeping from AthenaConfig.shm_poll_interval[0]
+    up to [1] seconds (doubling) while all rings are idle.
+
+    Messages of broadcast channels (end flags) are delivered after all
+    messages of other channels published before them.
+    """
+    name = 'shm'
+
+    def __init__(self, wrapper=None, slot_size=None, slot_count=None):
+        """
+        constructor.
+        :param wrapper: RedisWrapper, unused, for the interface of
+            transports.
+        :param slot_size: int, default is AthenaConfig.shm_slot_size.
+        :param slot_count: int, default is AthenaConfig.shm_slot_count.
+        """
+        self.wrapper = wrapper
+        self.slot_size = slot_size
+        self.slot_count = slot_count
+
+        # channel -> RingBuffer, of publishing and subscribed channels
+        self.writers = dict()
+        self.readers = dict()
+
+    def __ring(self, channel):
+        return RingBuffer(channel, self.slot_size, self.slot_count)
+
+    def subscribe(self, channels):
+        """
+        :param channels: string or list of strings.
+        :return:
+        """
+        if type(channels) == str:
+            channels = [channels]
+        for channel in channels:
+            if channel not in self.readers:
+                self.readers[channel] = self.__ring(channel)
+
+    def publish(self, channel, message, pipe=None):
+        """
+        :param channel: string
+        :param message: string or bytes, encoded message.
+        :param pipe: unused, messages are written right away.
+        :return:
+        """
+        try:
+            ring = self.writers[channel]
+        except KeyError:
+            ring = self.writers[channel] = self.__ring(channel)
+        if type(message) == str:
+            message = message.encode('utf-8')
+        ring.write(message)
+
+    def listen(self):
+        """
+        :return: generator of (channel, message) tuples.
+        """
+        broadcast = [r for c, r in self.readers.items()
+                     if c in AthenaConfig.broadcast_channels]
+        others = [r for c, r in self.readers.items()
+                  if c not in AthenaConfig.broadcast_channels]
+        min_interval, max_interval = AthenaConfig.shm_poll_interval
+
+        interval = 0
+        while True:
+            # read broadcasts first, so that everything published before
+            # them is read in this round
+            flags = [(r.channel, m) for r in broadcast for m in r.read()]
+
+            received = bool(flags)
+            for ring in others:
+                while True:
+                    messages = ring.read()
+                    for message in messages:
+                        yield ring.channel, message
+                    received = received or bool(messages)
+                    # drain the ring before broadcasts
+                    if not messages or not flags:
+                        break
+            for channel, message in flags:
+                yield channel, message
+
+            if received:
+                interval = 0
+            else:
+                time.sleep(interval)
+                interval = min(max(interval * 2, min_interval), max_interval)
+
+    def close(self, unlink=False):
+        """
+        detach from all rings.
+        :param unlink: bool, also remove rings of publishing channels.
+        :return:
+        """
+        for ring in self.readers.values():
+            ring.close()
+        for ring in self.writers.values():
+            if unlink:
+                ring.unlink()
+            else:
+                ring.close()
+        self.readers, self.writers = dict(), dict()
@@ -0,0 +1,115 @@
+import os
+import unittest
+from datetime import datetime
+
+from Athena.settings import AthenaConfig
+from Athena.data_handler.codec import encode_message, decode_message
+from Athena.data_handler.shm_transport import RingBuffer, \
+    SharedMemoryTransport
+HTf = AthenaConfig.HermesTickFields
+
+__author__ = 'zed'
+
+
+class TestSharedMemoryTransport(unittest.TestCase):
+    """
+    Test shared memory ring buffers and transport.
+    """
+    def setUp(self):
+        """
+        :return:
+        """
+        self.channel = 'md:test.{}'.format(os.getpid())
+        self.writer = RingBuffer(self.channel, slot_size=64, slot_count=4)
+
+    def tearDown(self):
+        """
+        :return:
+        """
+        self.writer.unlink()
+
+    def test_ring(self):
+        reader = RingBuffer(self.channel)
+
+        # >>> readers attach with geometry of the ring
+        self.assertEqual(reader.slot_count, 4)
+        for i in range(3):
+            self.writer.write('message {}'.format(i).encode('utf-8'))
+        self.assertEqual(reader.read(max_count=2),
+                         [b'message 0', b'message 1'])
+        self.assertEqual(reader.read(), [b'message 2'])
+        self.assertEqual(reader.read(), [])
+
+        # >>> lapped reader skips overwritten messages
+        for i in range(3, 10):
+            self.writer.write('message {}'.format(i).encode('utf-8'))
+        self.assertEqual(reader.read(), [
+            b'message 6', b'message 7', b'message 8', b'message 9'])
+
+        reader.close()
+
+    def test_fragments(self):
+        reader = RingBuffer(self.channel)
+
+        # >>> messages longer than a slot span consecutive slots
+        self.writer.write(b'a' * 90)
+        self.writer.write(b'b')
+        self.assertEqual(self.writer.cursor, 3)
+        self.assertEqual(reader.read(), [b'a' * 90, b'b'])
+
+        # >>> a lapped reader skips the rest of overrun messages
+        self.writer.write(b'c' * 90)
+        self.writer.write(b'd' * 90)
+        self.writer.write(b'e')
+        self.assertEqual(reader.read(), [b'd' * 90, b'e'])
+
+        # >>> messages longer than the ring are rejected
+        self.assertRaises(ValueError, self.writer.write, b'x' * 4 * 48 + b'x')
+        reader.close()
+
+    def test_full_book(self):
+        # md record with every field of the order book, as published
+        record = dict((h, 1234567.5) for h in HTf.hermes_tick_headers)
+        record.update({'tag': 'md', HTf.contract: 'au1612'})
+        record[HTf.ex_time] = record[HTf.local_time] = \
+            datetime(2016, 9, 29, 10).strftime(AthenaConfig.dt_format)
+        message = encode_message('md:au1612', 'md:au1612:000000123', record)
+
+        subscriber = SharedMemoryTransport(slot_size=512, slot_count=64)
+        subscriber.subscribe(self.channel + '.book')
+        publisher = SharedMemoryTransport(slot_size=512, slot_count=64)
+        self.assertGreater(len(message), 512)
+
+        # >>> published and received whole
+        publisher.publish(self.channel + '.book', message)
+        channel, payload = next(subscriber.listen())
+        self.assertEqual(decode_message(payload)[1], record)
+
+        subscriber.close()
+        publisher.close(unlink=True)
+
+    def test_listen(self):
+        subscriber = SharedMemoryTransport()
+        subscriber.subscribe([self.channel, 'flags'])
+        publisher = SharedMemoryTransport()
+
+        # >>> broadcasts come after messages published before them
+        publisher.publish(self.channel, 'md_0')
+        publisher.publish('flags', 'end')
+        publisher.publish(self.channel, 'md_1')
+
+        messages = subscriber.listen()
+        received = [next(messages) for i in range(3)]
+        self.assertEqual(received, [
+            (self.channel, b'md_0'),
+            (self.channel, b'md_1'),
+            ('flags', b'end')
+        ])
+
+        messages.close()
+        subscriber.close()
+        publisher.close(unlink=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,25 @@
 import time
-import pymssql
+import heapq
+import multiprocessing
+import numpy as np
+from array import array
 from datetime import datetime
+from itertools import islice
+
+try:
+    import pymssql
+except ImportError:
+    # only needed to connect, rows can be prepared without sql server
+    pymssql = None
 
 from Athena.settings import AthenaConfig
+from Athena.utils import EPOCH_AS_FILETIME, filetime_to_dt64, dt64_to_str
 from Athena.data_handler.redis_wrapper import RedisWrapper
-from Athena.data_handler.clean_data import clean_hermes_md_data, \
-    clean_hermes_kl_data
+from Athena.data_handler.query_cache import QueryCache
+from Athena.data_handler.replay import scan_directories, \
+    merge_directory_times, iter_channel_keys, PrefetchReader
+from Athena.data_handler.hermes_decoder import HermesTickDecoder, \
+    HermesKLineDecoder
 
 HTf, HKf = AthenaConfig.HermesTickFields, AthenaConfig.HermesKLineFields
 
@@ -20,12 +34,46 @@ class SQLWrapper(object):
     The interaction between Athena and SQL server is mainly one-batch retrieve
     of historical (large) market data set.
     There is no (currently) design in which Athena continuously insert or
-    obtain records into SQL server.
+    obtain records into SQL server. Historical rows are streamed in batches
+    by iter_hist_data.
 
     Therefore, unlike redis server, we hope to open only one connection to
     SQL server. Every module that interacts with SQL server should preserve
     a reference to the (only) instance.
+
+    Cached rows are cleaned in batches of _batch_size records on migration,
+    and inserted in batches of _insert_batch_size rows by executemany, or by
+    bulk copy (pymssql bulk_copy) with _bulk_copy. Each table is loaded in
+    one transaction, or committed every _commit_interval rows if set.
+
+    Rows of a daily table are ordered by the time suffixes of their cached
+    keys, ties in order of directory name (see replay.merge_directory_times),
+    and RowId is the position of the key in this order (keys that could not
+    be cleaned leave gaps).
+
+    With _worker_count > 1 (default is 1, None for number of cores),
+    migrate_data is partitioned by instrument and data type (md, or kl of
+    all durations): a pool of worker processes, each with its own redis and
+    sql connections, loads the partitions into staging tables
+    <table>_<partition>, which are merged into the daily table at the end.
+    Row ids of partitions are assigned by the parent in the same order, so
+    that a day gets the same RowIds whatever the number of workers.
     """
+    # number of records cleaned at once in migration.
+    _batch_size = 10000
+
+    # rows inserted at once, rows between commits (None for one commit per
+    # table), whether to use bulk copy in place of INSERT statements.
+    _insert_batch_size = 5000
+    _commit_interval = None
+    _bulk_copy = False
+
+    # worker processes of migration, 1 to migrate in this process, None
+    # for number of cores.
+    _worker_count = 1
+
+    # rows fetched at once in historical queries.
+    _fetch_batch_size = 10000
 
     def __init__(self):
         """
@@ -47,12 +95,19 @@ class SQLWrapper(object):
             db=AthenaConfig.daily_migration_cache_db_index)
         self.hermes_wrapper = RedisWrapper(db=AthenaConfig.hermes_db_index)
 
+        # decoders of cached hermes data, time fields are kept as filetime
+        # and converted batch by batch.
+        self.md_decoder = HermesTickDecoder(raw_times=True)
+        self.kl_decoder = HermesKLineDecoder(raw_times=True)
+
         # table names
         self.md_table_name = None
         self.kl_table_name = None
 
     def __login(self):
         """ login to SQL server."""
+        if pymssql is None:
+            raise ImportError('pymssql is required to connect to SQL server.')
         try:
             self.connection = pymssql.connect(
                 server=self.host_name,
@@ -70,8 +125,8 @@ class SQLWrapper(object):
         migrate redis cache to another db to prepare for transportation.
         :return:
         """
-        # all keys to migrate
-        keys_to_migrate = self.hermes_wrapper.get_keys('*')
+        # all keys to migrate, scanned while being migrated
+        keys_to_migrate = self.hermes_wrapper.iter_keys('*')
 
         self.hermes_wrapper.migrate_keys(
             keys_list=keys_to_migrate,
@@ -104,6 +159,9 @@ class SQLWrapper(object):
         self.cursor.execute(qry_clean_up_md)
         self.connection.commit()
 
+        # cached query results of the old table are stale
+        QueryCache().invalidate(self.md_table_name)
+
         # make table query
         qry_make_md_table = """
         CREATE TABLE {table_name}
@@ -201,6 +259,9 @@ class SQLWrapper(object):
         self.cursor.execute(qry_clean_up_kl)
         self.connection.commit()
 
+        # cached query results of the old table are stale
+        QueryCache().invalidate(self.kl_table_name)
+
         # make table query
         qry_make_kl_table = """
         CREATE TABLE {table_name}
@@ -242,397 +303,445 @@ class SQLWrapper(object):
             self.kl_table_name
         ))
 
-    def __solidify_md_data(self):
+    def __iter_cleaned_rows(self, keys, decoder, time_fields):
         """
-        transport redis data to sql.
-        :return:
+        fetch and clean cached rows batch by batch. Hash sets are fetched
+        once, in pipelined batches prefetched in the background, and the
+        time fields of each batch are converted to sql datetime strings at
+        once.
+        :param keys: iterable of keys, in order of insertion.
+        :param decoder: HermesDecoder, with raw (filetime) time fields.
+        :param time_fields: tuple of strings, time fields to convert.
+        :return: generator of (position of key, key, cleaned_row,
+            {time_field: str}) tuples.
         """
-        start_time = time.time()
+        reader = PrefetchReader(
+            self.cache_wrapper, keys, batch_size=self._batch_size)
+        try:
+            rows = enumerate(reader)
+            while True:
+                fetched = list(islice(rows, self._batch_size))
+                if not fetched:
+                    return
+
+                batch = []
+                for i, (k, row) in fetched:
+                    if row is None:
+                        # unicode error, reported by wrapper
+                        continue
+
+                    try:
+                        # clean data
+                        cleaned_row = decoder.decode_hash(
+                            row, k.decode('utf-8')).materialize()
+                    except ValueError:
+                        print('[Redis]: Illegal value at key {}.'.format(k))
+                        continue
+                    batch.append((i, k, cleaned_row))
+
+                # convert time fields of the batch,
+                # illegal (before epoch) times are mapped to epoch.
+                time_strings = dict()
+                for field in time_fields:
+                    ft = np.maximum([row[field] for (i, k, row) in batch],
+                                    EPOCH_AS_FILETIME)
+                    time_strings[field] = dt64_to_str(filetime_to_dt64(ft))
+
+                for j in range(len(batch)):
+                    i, k, cleaned_row = batch[j]
+                    times = dict()
+                    for field in time_fields:
+                        times[field] = time_strings[field][j]
+                    yield i, k, cleaned_row, times
+        finally:
+            reader.close()
+
+    @staticmethod
+    def __md_values(row_id, k, cleaned_row, times):
+        """
+        values of one row of md table, in order of its columns.
+        :param row_id: int
+        :param k: bytes, key of cached row.
+        :param cleaned_row: dict
+        :param times: dict, time field -> sql datetime string.
+        :return: tuple
+        """
+        this_symbol = cleaned_row[HTf.contract]
+        local_update_time = str(times[HTf.local_time])
+        return (
+            (
+                row_id,
+                local_update_time,
+                str(times[HTf.ex_time]),
+                local_update_time,
+                AthenaConfig.hermes_exchange_mapping[this_symbol],
+                AthenaConfig.hermes_category_mapping[this_symbol],
+                this_symbol,
+                cleaned_row[HTf.last_price]
+            ) +
+            tuple(cleaned_row[field] for field in HTf.bids) +
+            tuple(cleaned_row[field] for field in HTf.bid_vols) +
+            tuple(cleaned_row[field] for field in HTf.asks) +
+            tuple(cleaned_row[field] for field in HTf.ask_vols) +
+            (
+                cleaned_row[HTf.average_price],
+                cleaned_row[HTf.high_price],
+                cleaned_row[HTf.low_price],
+                cleaned_row[HTf.pre_close_price],
+                cleaned_row[HTf.open_interest],
+                cleaned_row[HTf.volume],
+                cleaned_row[HTf.turnover],
+                0,                      # rank
+                k.decode('utf-8')       # unique index
+            )
+        )
 
-        # get md keys
-        md_keys = self.cache_wrapper.get_keys('md.*[:]*')
-        N = len(md_keys)
+    @staticmethod
+    def __kl_values(row_id, k, cleaned_row, times):
+        """
+        values of one row of kl table, in order of its columns.
+        :param row_id: int
+        :param k: bytes, key of cached row.
+        :param cleaned_row: dict
+        :param times: dict, time field -> sql datetime string.
+        :return: tuple
+        """
+        this_symbol = cleaned_row[HKf.contract]
+        local_update_time = str(times[HKf.local_time])
+        return (
+            row_id,
+            local_update_time,
+            str(times[HKf.ex_time]),
+            local_update_time,
+            AthenaConfig.hermes_exchange_mapping[this_symbol],
+            AthenaConfig.hermes_category_mapping[this_symbol],
+            this_symbol,
+            cleaned_row[HKf.duration],
+            cleaned_row[HKf.open_price],
+            cleaned_row[HKf.high_price],
+            cleaned_row[HKf.low_price],
+            cleaned_row[HKf.close_price],
+            cleaned_row[HKf.volume],
+            cleaned_row[HKf.turnover],
+            cleaned_row[HKf.open_interest],
+            cleaned_row[HKf.average_price],
+            cleaned_row[HKf.total_volume],
+            cleaned_row[HKf.total_turnover],
+            0,                          # day average price
+            str(times[HKf.open_time]),
+            str(times[HKf.high_time]),
+            str(times[HKf.low_time]),
+            str(times[HKf.close_time]),
+            0,                          # rank
+            k.decode('utf-8')           # unique index
+        )
 
-        # sort keys.
-        print('[Redis]: Sorting records according to temporal sequence.')
-        md_key_localtime_tuples = []
-        for k in md_keys:
-            try:
-                # get hash set
-                row = self.cache_wrapper.get_dict(k)
-            except UnicodeError:
-                print('[Redis]: Unicode error at key {}.'.format(k))
+    def __bulk_insert(self, table, rows, total=None):
+        """
+        insert rows into table in batches of _insert_batch_size rows, by
+        parameterized executemany (or bulk copy, with _bulk_copy).
+        The table is loaded in one transaction, unless _commit_interval
+        is set. Throughput is reported every batch.
+        :param table: string, name of table.
+        :param rows: iterable of tuples, values in order of columns.
+        :param total: int, expected number of rows, for progress report.
+        :return: int, number of rows inserted.
+        """
+        start_time = time.time()
+        counter = 0
+        uncommitted = 0
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) < self._insert_batch_size:
                 continue
 
-            # append (key, local_time)
-            md_key_localtime_tuples.append((k, int(row[HTf.local_time])))
+            self.__insert_batch(table, batch)
+            counter += len(batch)
+            uncommitted += len(batch)
+            batch = []
+
+            if self._commit_interval and \
+                    uncommitted >= self._commit_interval:
+                self.connection.commit()
+                uncommitted = 0
+
+            print('[SQL Server]: Inserted {}/{} rows into {}, '
+                  '{} rows per second.'.format(
+                    counter, total, table,
+                    round(counter / max(time.time() - start_time, 1e-6))
+                  ), flush=True)
+
+        if batch:
+            self.__insert_batch(table, batch)
+            counter += len(batch)
+        self.connection.commit()
 
-            if not len(md_key_localtime_tuples) % 10000:
-                print('[Redis]: Sorted {} %.'.format(
-                    round(100 * len(md_key_localtime_tuples) / N, 2)
-                ), flush=True)
+        print('[SQL Server]: Inserted {} rows into {} in {} seconds.'.format(
+            counter, table, time.time() - start_time))
+        return counter
 
-        md_sorted_keys = sorted(
-            md_key_localtime_tuples,
-            key=lambda tup: tup[1]
+    def __insert_batch(self, table, batch):
+        """
+        insert one batch of rows.
+        :param table: string
+        :param batch: list of tuples.
+        :return:
+        """
+        if self._bulk_copy:
+            self.connection.bulk_copy(table, batch,
+                                      batch_size=len(batch))
+            return
+        qry_insert_rows = 'INSERT INTO {table} VALUES ({values})'.format(
+            table=table,
+            values=', '.join(['%s'] * len(batch[0]))
         )
+        self.cursor.executemany(qry_insert_rows, batch)
 
-        print('[Redis]: Ready to transport {} records from redis'.format(
-            len(md_sorted_keys)
-        ))
-
-        # begin iterating through keys and insert data into table.
-        counter_md = 0
-        for (k, l) in md_sorted_keys:
-            try:
-                # get hash set
-                row = self.cache_wrapper.get_dict(k)
-            except UnicodeError:
-                print('[Redis]: Unicode error at key {}.'.format(k))
-                continue
-
-            # clean data
-            cleaned_row = clean_hermes_md_data(row, is_hash_set=True)
-
-            this_symbol = cleaned_row[HTf.contract]
-            local_update_time = \
-                cleaned_row[HTf.local_time].strftime(
-                    AthenaConfig.sql_storage_dt_format)
-
-            qry_insert_row = """
-            INSERT INTO {table} VALUES
-                (
-                    {row_id},
-                    '{day}',
-                    '{ex_update_time}',
-                    '{local_update_time}',
-                    '{exchange}',
-                    '{category}',
-                    '{symbol}',
-                    {last_price},
-                    {bid_1},
-                    {bid_2},
-                    {bid_3},
-                    {bid_4},
-                    {bid_5},
-                    {bid_6},
-                    {bid_7},
-                    {bid_8},
-                    {bid_9},
-                    {bid_10},
-                    {bid_vol_1},
-                    {bid_vol_2},
-                    {bid_vol_3},
-                    {bid_vol_4},
-                    {bid_vol_5},
-                    {bid_vol_6},
-                    {bid_vol_7},
-                    {bid_vol_8},
-                    {bid_vol_9},
-                    {bid_vol_10},
-                    {ask_1},
-                    {ask_2},
-                    {ask_3},
-                    {ask_4},
-                    {ask_5},
-                    {ask_6},
-                    {ask_7},
-                    {ask_8},
-                    {ask_9},
-                    {ask_10},
-                    {ask_vol_1},
-                    {ask_vol_2},
-                    {ask_vol_3},
-                    {ask_vol_4},
-                    {ask_vol_5},
-                    {ask_vol_6},
-                    {ask_vol_7},
-                    {ask_vol_8},
-                    {ask_vol_9},
-                    {ask_vol_10},
-                    {avg_price},
-                    {high_price},
-                    {low_price},
-                    {pre_close},
-                    {open_int},
-                    {volume},
-                    {turnover},
-                    {rank},
-                    '{index}'
-                )
-            """ .format(
-                table=self.md_table_name,
-                row_id=counter_md,
-                day=local_update_time,
-                ex_update_time=cleaned_row[
-                    HTf.ex_time].strftime(AthenaConfig.sql_storage_dt_format),
-                local_update_time=local_update_time,
-                exchange=AthenaConfig.hermes_exchange_mapping[
-                    this_symbol],
-                category=AthenaConfig.hermes_category_mapping[
-                    this_symbol],
-                symbol=this_symbol,
-                last_price=cleaned_row[HTf.last_price],
-                bid_1=cleaned_row[HTf.bid_1],
-                bid_2=cleaned_row[HTf.bid_2],
-                bid_3=cleaned_row[HTf.bid_3],
-                bid_4=cleaned_row[HTf.bid_4],
-                bid_5=cleaned_row[HTf.bid_5],
-                bid_6=cleaned_row[HTf.bid_6],
-                bid_7=cleaned_row[HTf.bid_7],
-                bid_8=cleaned_row[HTf.bid_8],
-                bid_9=cleaned_row[HTf.bid_9],
-                bid_10=cleaned_row[HTf.bid_10],
-                bid_vol_1=cleaned_row[HTf.bid_vol_1],
-                bid_vol_2=cleaned_row[HTf.bid_vol_2],
-                bid_vol_3=cleaned_row[HTf.bid_vol_3],
-                bid_vol_4=cleaned_row[HTf.bid_vol_4],
-                bid_vol_5=cleaned_row[HTf.bid_vol_5],
-                bid_vol_6=cleaned_row[HTf.bid_vol_6],
-                bid_vol_7=cleaned_row[HTf.bid_vol_7],
-                bid_vol_8=cleaned_row[HTf.bid_vol_8],
-                bid_vol_9=cleaned_row[HTf.bid_vol_9],
-                bid_vol_10=cleaned_row[HTf.bid_vol_10],
-                ask_1=cleaned_row[HTf.ask_1],
-                ask_2=cleaned_row[HTf.ask_2],
-                ask_3=cleaned_row[HTf.ask_3],
-                ask_4=cleaned_row[HTf.ask_4],
-                ask_5=cleaned_row[HTf.ask_5],
-                ask_6=cleaned_row[HTf.ask_6],
-                ask_7=cleaned_row[HTf.ask_7],
-                ask_8=cleaned_row[HTf.ask_8],
-                ask_9=cleaned_row[HTf.ask_9],
-                ask_10=cleaned_row[HTf.ask_10],
-                ask_vol_1=cleaned_row[HTf.ask_vol_1],
-                ask_vol_2=cleaned_row[HTf.ask_vol_2],
-                ask_vol_3=cleaned_row[HTf.ask_vol_3],
-                ask_vol_4=cleaned_row[HTf.ask_vol_4],
-                ask_vol_5=cleaned_row[HTf.ask_vol_5],
-                ask_vol_6=cleaned_row[HTf.ask_vol_6],
-                ask_vol_7=cleaned_row[HTf.ask_vol_7],
-                ask_vol_8=cleaned_row[HTf.ask_vol_8],
-                ask_vol_9=cleaned_row[HTf.ask_vol_9],
-                ask_vol_10=cleaned_row[HTf.ask_vol_10],
-                avg_price=cleaned_row[HTf.average_price],
-                high_price=cleaned_row[HTf.high_price],
-                low_price=cleaned_row[HTf.low_price],
-                pre_close=cleaned_row[HTf.pre_close_price],
-                open_int=cleaned_row[HTf.open_interest],
-                volume=cleaned_row[HTf.volume],
-                turnover=cleaned_row[HTf.turnover],
-                rank=0,
-                index=k.decode('utf-8')
-            )
+    def __scan(self, pattern):
+        """
+        scan cached keys matching pattern, grouped by directory.
+        :param pattern: string, pattern of cached keys.
+        :return: list of (directory, sorted array of time suffixes), in
+            order of directory.
+        """
+        print('[Redis]: Sorting records according to temporal sequence.')
+        return sorted(scan_directories(self.cache_wrapper, pattern).items())
 
-            # execute insert data queries
-            self.cursor.execute(qry_insert_row)
-            self.connection.commit()
+    def __solidify(self, directory_times, table, decoder, time_fields,
+                   values, row_ids=None):
+        """
+        transport cached rows of directories to sql table, in one pass:
+        keys are ordered by their time suffixes, hash sets are fetched once
+        in pipelined batches, cleaned batch by batch and fed to the bulk
+        writer.
+        :param directory_times: list of (directory, sorted array of times).
+        :param table: string, name of sql table.
+        :param decoder: HermesDecoder, with raw (filetime) time fields.
+        :param time_fields: tuple of strings, time fields to convert.
+        :param values: function (row_id, key, cleaned_row, times) -> tuple.
+        :param row_ids: array of row ids of keys in merged order, default
+            is the position of key.
+        :return: int, number of rows inserted.
+        """
+        start_time = time.time()
+        total = sum(len(times) for directory, times in directory_times)
 
-            # increment to counter
-            counter_md += 1
+        print('[Redis]: Ready to transport {} records from redis'.format(
+            total
+        ))
 
-            if not counter_md % 10000:
-                print('[SQL Server]: Finished {}/{}.'.format(
-                    counter_md, len(md_sorted_keys))
-                )
+        # insert rows in bulk, in one transaction.
+        rows = (values(i if row_ids is None else row_ids[i], k,
+                       cleaned_row, times)
+                for i, k, cleaned_row, times in self.__iter_cleaned_rows(
+                    merge_directory_times(directory_times),
+                    decoder, time_fields))
+        counter = self.__bulk_insert(table, rows, total)
 
         end_time = time.time()
         print('[SQL Server]: Transportation finished. '
               'Spent {} seconds.'.format(
                 end_time-start_time
               ))
+        return counter
 
-    def __solidify_kl_data(self):
+    def __solidify_md_data(self, directory_times=None, row_ids=None):
         """
-        transport redis kline data to sql.
+        transport redis data to sql.
+        :param directory_times: list of (directory, times) to transport,
+            default is all cached md.
+        :param row_ids: array of row ids, see __solidify.
         :return:
         """
-        start_time = time.time()
+        if directory_times is None:
+            directory_times = self.__scan('md.*[:]*')
+        return self.__solidify(
+            directory_times, self.md_table_name, self.md_decoder,
+            (HTf.ex_time, HTf.local_time), self.__md_values, row_ids)
 
-        # get md keys
-        kl_keys = self.cache_wrapper.get_keys('kl.*[:]*')
+    def __solidify_kl_data(self, directory_times=None, row_ids=None):
+        """
+        transport redis kline data to sql.
+        :param directory_times: list of (directory, times) to transport,
+            default is all cached k-lines.
+        :param row_ids: array of row ids, see __solidify.
+        :return:
+        """
+        if directory_times is None:
+            directory_times = self.__scan('kl.*[:]*')
+        return self.__solidify(
+            directory_times, self.kl_table_name, self.kl_decoder,
+            (HKf.ex_time, HKf.local_time) + HKf.ohlc_time, self.__kl_values,
+            row_ids)
+
+    def __partitions(self, data_type):
+        """
+        partition cached directories of data type by instrument. Keys keep
+        the row ids they have in the merged order of all directories (as
+        migrated by __solidify in one process), so that RowId does not
+        depend on partitioning.
+        :param data_type: string, 'md' or 'kl'.
+        :return: list of (list of (directory, times), array of row ids of
+            keys in merged order of the partition), in order of instrument.
+        """
+        directory_times = self.__scan(data_type + '.*[:]*')
+
+        partitions = dict()
+        partition_of = []
+        for directory, times in directory_times:
+            # kl.uftreal.au1612.1m -> kl.uftreal.au1612
+            instrument = directory if data_type == 'md' \
+                else directory.rsplit('.', 1)[0]
+            partitions.setdefault(instrument, ([], array('q')))[0].append(
+                (directory, times))
+            partition_of.append(instrument)
+
+        # directories of a partition keep their relative order, so the
+        # merged order of a partition is a subsequence of the whole.
+        streams = [iter_channel_keys(directory, times, order)
+                   for order, (directory, times) in enumerate(directory_times)]
+        for row_id, (t, order, key) in enumerate(heapq.merge(*streams)):
+            partitions[partition_of[order]][1].append(row_id)
+
+        return [partitions[instrument] for instrument in sorted(partitions)]
+
+    def migrate_partition(self, data_type, table_name, directory_times,
+                          row_ids=None):
+        """
+        load one partition into a (staging) table, called by workers of
+        parallel migration.
+        :param data_type: string, 'md' or 'kl'.
+        :param table_name: string, table to create and load.
+        :param directory_times: list of (directory, times).
+        :param row_ids: array of row ids of keys, see __partitions.
+        :return: int, number of rows inserted.
+        """
+        if data_type == 'md':
+            self.__make_daily_storage_md_table(table_name)
+            return self.__solidify_md_data(directory_times, row_ids)
+        self.__make_daily_storage_kl_table(table_name)
+        return self.__solidify_kl_data(directory_times, row_ids)
 
-        # sort keys.
-        print('[Redis]: Sorting records according to temporal sequence.')
-        kl_key_localtime_tuples = []
-        for k in kl_keys:
-            try:
-                # get hash set
-                row = self.cache_wrapper.get_dict(k)
-            except UnicodeError:
-                print('[Redis]: Unicode error at key {}.'.format(k))
-                continue
+    def __merge_staging_tables(self, table_name, staging_tables):
+        """
+        merge staging tables into table in one statement, rows keep their
+        RowId. Staging tables are dropped.
+        :param table_name: string
+        :param staging_tables: list of strings, in order of partition.
+        :return:
+        """
+        if not staging_tables:
+            return
 
-            # append (key, local_time)
-            kl_key_localtime_tuples.append((k, int(row[HKf.open_time])))
+        staged = ' UNION ALL '.join(
+            'SELECT * FROM {}'.format(staging_table)
+            for staging_table in staging_tables)
 
-            if not len(kl_key_localtime_tuples) % 10000:
-                print('[Redis]: Sorted {} %.'.format(
-                    round(100 * len(kl_key_localtime_tuples) / len(kl_keys), 2)
-                ), flush=True)
+        self.cursor.execute("""
+            INSERT INTO {table}
+            SELECT * FROM ({staged}) AS staged
+            ORDER BY [RowId]
+            """.format(table=table_name, staged=staged))
 
-        kl_sorted_keys = sorted(
-            kl_key_localtime_tuples,
-            key=lambda tup: tup[1]
-        )
+        for staging_table in staging_tables:
+            self.cursor.execute('DROP TABLE {}'.format(staging_table))
+        self.connection.commit()
 
-        print('[Redis]: Ready to transport {} records from redis'.format(
-            len(kl_sorted_keys)
-        ))
+        print('[SQL Server]: Merged {} staging tables into {}.'.format(
+            len(staging_tables), table_name))
 
-        # begin iterating through keys and insert data into table.
-        counter_kl = 0
-        for (k, l) in kl_sorted_keys:
-            try:
-                # get hash set
-                row = self.cache_wrapper.get_dict(k)
-            except UnicodeError:
-                print('[Redis]: Unicode error at key {}.'.format(k))
-                continue
+    def __migrate_parallel(self, worker_count):
+        """
+        migrate cached md and k-lines, partitioned by instrument, in a
+        pool of worker_count processes.
+        :param worker_count: int
+        :return:
+        """
+        start_time = time.time()
 
-            try:
-                # clean data
-                cleaned_row = clean_hermes_kl_data(row, is_hash_set=True)
-            except ValueError:
-                print('[Redis]: Illegal value at key {}.'.format(k))
-                continue
-            except OSError:
-                print('[Redis]: Illegal value at key {}.'.format(k))
-                continue
+        tasks = []
+        tables = [('md', self.md_table_name), ('kl', self.kl_table_name)]
+        for data_type, table_name in tables:
+            for i, (directory_times, row_ids) in enumerate(
+                    self.__partitions(data_type)):
+                tasks.append((data_type, '{}_{}'.format(table_name, i),
+                              directory_times, row_ids))
 
-            this_symbol = cleaned_row[HKf.contract]
-            local_update_time = \
-                cleaned_row[HKf.local_time].strftime(
-                    AthenaConfig.sql_storage_dt_format)
-
-            qry_insert_row = """
-            INSERT INTO {table} VALUES
-                (
-                    {row_id},
-                    '{day}',
-                    '{ex_update_time}',
-                    '{local_update_time}',
-                    '{exchange}',
-                    '{category}',
-                    '{symbol}',
-                    {duration},
-                    {open_price},
-                    {high_price},
-                    {low_price},
-                    {close_price},
-                    {volume},
-                    {turnover},
-                    {open_int},
-                    {average_price},
-                    {tot_volume},
-                    {tot_turnover},
-                    {day_average_price},
-                    '{open_time}',
-                    '{high_time}',
-                    '{low_time}',
-                    '{close_time}',
-                    {rank},
-                    '{index}'
-                )
-            """ .format(
-                table=self.kl_table_name,
-                row_id=counter_kl,
-                day=local_update_time,
-                ex_update_time=cleaned_row[
-                    HKf.ex_time].strftime(AthenaConfig.sql_storage_dt_format),
-                local_update_time=local_update_time,
-                exchange=AthenaConfig.hermes_exchange_mapping[
-                    this_symbol],
-                category=AthenaConfig.hermes_category_mapping[
-                    this_symbol],
-                symbol=this_symbol,
-                duration=cleaned_row[HKf.duration],
-                open_price=cleaned_row[HKf.open_price],
-                high_price=cleaned_row[HKf.high_price],
-                low_price=cleaned_row[HKf.low_price],
-                close_price=cleaned_row[HKf.close_price],
-                volume=cleaned_row[HKf.volume],
-                turnover=cleaned_row[HKf.turnover],
-                open_int=cleaned_row[HKf.open_interest],
-                average_price=cleaned_row[HKf.average_price],
-                tot_volume=cleaned_row[HKf.total_volume],
-                tot_turnover=cleaned_row[HKf.total_turnover],
-                day_average_price=0,
-                open_time=cleaned_row[
-                    HKf.open_time].strftime(
-                    AthenaConfig.sql_storage_dt_format),
-                high_time=cleaned_row[
-                    HKf.high_time].strftime(
-                    AthenaConfig.sql_storage_dt_format),
-                low_time=cleaned_row[
-                    HKf.low_time].strftime(
-                    AthenaConfig.sql_storage_dt_format),
-                close_time=cleaned_row[
-                    HKf.close_time].strftime(
-                    AthenaConfig.sql_storage_dt_format),
-                rank=0,
-                index=k.decode('utf-8')
-            )
+        print('[SQL Server]: Migrating {} partitions with {} workers.'.format(
+            len(tasks), worker_count))
+        with multiprocessing.Pool(worker_count) as pool:
+            counts = pool.map(_migrate_partition, tasks, chunksize=1)
 
-            # execute insert data queries
-            self.cursor.execute(qry_insert_row)
-            self.connection.commit()
+        for data_type, table_name in tables:
+            self.__merge_staging_tables(table_name, [
+                task[1] for task in tasks if task[0] == data_type])
 
-            # increment to counter
-            counter_kl += 1
+        print('[SQL Server]: Migrated {} rows in {} seconds.'.format(
+            sum(counts), time.time() - start_time))
 
-            if not counter_kl % 10000:
-                print('[SQL Server]: Finished {}/{}.'.format(
-                    counter_kl, len(kl_sorted_keys))
-                )
+    def iter_hist_data(self, symbols_list, begin_time, end_time, table,
+                       columns=None, batch_size=None, as_arrays=False):
+        """
+        stream historical rows of symbols in [begin_time, end_time] in order
+        of LocalUpdateTime. Rows are fetched in batches (fetchmany), filters
+        are query parameters.
+        :param symbols_list: list of strings.
+        :param begin_time: datetime
+        :param end_time: datetime
+        :param table: string, name of table.
+        :param columns: list of column names, None for all columns.
+        :param batch_size: int, rows per fetch, default is
+            _fetch_batch_size.
+        :param as_arrays: bool, yield batches as dict of numpy arrays
+            (column -> array) instead of rows.
+        :return: generator of tuples, or of dicts of numpy arrays.
+        """
+        batch_size = batch_size or self._fetch_batch_size
+        if columns:
+            columns_string = ', '.join('[{}]'.format(c) for c in columns)
+        else:
+            columns_string = '*'
 
-        end_time = time.time()
-        print('[SQL Server]: Transportation finished. '
-              'Spent {} seconds.'.format(
-                end_time-start_time)
-        )
+        # execute SQL command.
+        self.cursor.execute("""
+                SELECT {columns} FROM {table}
+                WHERE [Symbol]
+                IN ({symbols})
+                AND [LocalUpdateTime] >= %s
+                AND [LocalUpdateTime] <= %s
+                ORDER BY [LocalUpdateTime]""".format(
+            columns=columns_string,
+            table=table,
+            symbols=', '.join(['%s'] * len(symbols_list))
+        ), tuple(symbols_list) + (begin_time, end_time))
+        names = [c[0] for c in self.cursor.description]
+
+        while True:
+            rows = self.cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            if as_arrays:
+                yield dict(zip(names, (np.array(column)
+                                       for column in zip(*rows))))
+            else:
+                for row in rows:
+                    yield row
 
     def select_hist_data(self, symbols_list, begin_time, end_time, table,
-                         split_instruments=False):
+                         split_instruments=False, columns=None):
         """
-
+        select historical rows at once, see iter_hist_data.
         :param symbols_list:
         :param begin_time:
         :param end_time:
         :param split_instruments:
         :param table:
-        :return:
+        :param columns: list of column names, None for all columns.
+        :return: list of tuples, in order of LocalUpdateTime.
         """
-        # convert parameters to SQL command string.
-        symbols_string = "('" + "','".join(symbols_list) + "')"
-        # pay attention to quotation marks!
-        #
-        begin_time_str = "'" + begin_time.strftime(
-            AthenaConfig.dt_format) + "'"
-        end_time_str = "'" + end_time.strftime(
-            AthenaConfig.dt_format) + "'"
-
-        # execute SQL command.
-        self.cursor.execute("""
-                SELECT * FROM {table}
-                WHERE [Symbol]
-                IN {symbols_list}
-                AND [LocalUpdateTime] >= {begin_time}
-                AND [LocalUpdateTime] <= {end_time}
-                ORDER BY [LocalUpdateTime]""".format(
-            table=table,
-            symbol=HKf.contract,
-            symbols_list=symbols_string,
-            local_update_time=HKf.local_time,
-            begin_time=begin_time_str,
-            end_time=end_time_str
-        ))
-        rows = [row for row in self.cursor]
-        rows = sorted(
-            rows,
-            key=lambda tup: tup[0]
-        )
-        return rows
+        return list(self.iter_hist_data(
+            symbols_list, begin_time, end_time, table, columns=columns))
 
     def migrate_data(self):
         """
@@ -642,13 +751,20 @@ class SQLWrapper(object):
         # migrate keys
         self.__migrate_daily_cached_keys()
 
-        #  solidify md
-        self.__make_daily_storage_md_table()
-        self.__solidify_md_data()
+        worker_count = self._worker_count or multiprocessing.cpu_count()
+        if worker_count > 1:
+            # solidify md and k lines, in parallel partitions
+            self.__make_daily_storage_md_table()
+            self.__make_daily_storage_kl_table()
+            self.__migrate_parallel(worker_count)
+        else:
+            #  solidify md
+            self.__make_daily_storage_md_table()
+            self.__solidify_md_data()
 
-        # solidify k lines
-        self.__make_daily_storage_kl_table()
-        self.__solidify_kl_data()
+            # solidify k lines
+            self.__make_daily_storage_kl_table()
+            self.__solidify_kl_data()
 
         # flush cached db
         self.cache_wrapper.flush_db()
@@ -658,3 +774,16 @@ class SQLWrapper(object):
         if self.connection:
             self.connection.close()
 
+
+def _migrate_partition(task):
+    """
+    worker of parallel migration, with its own connections.
+    :param task: tuple, (data type, staging table, directory times, row
+        ids).
+    :return: int, number of rows inserted.
+    """
+    wrapper = SQLWrapper()
+    try:
+        return wrapper.migrate_partition(*task)
+    finally:
+        wrapper.logout()
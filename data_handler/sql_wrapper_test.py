@@ -1,9 +1,300 @@
+import shutil
+import tempfile
 import unittest
 from datetime import datetime
+from fnmatch import fnmatchcase
+from unittest import mock
 
+from Athena.settings import AthenaConfig
+from Athena.data_handler import sql_wrapper
 from Athena.data_handler.sql_wrapper import SQLWrapper
+from Athena.data_handler.hermes_decoder import HermesTickDecoder, \
+    HermesKLineDecoder
+HTf = AthenaConfig.HermesTickFields
+
+__author__ = 'zed'
+
+# filetime of 2016-09-29 09:00:00
+FT_0 = 131195844000000000
+
+
+class Cursor(object):
+    """
+    pymssql cursor stand-in, records statements into its connection.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.description = None
+
+    def execute(self, query, params=None):
+        self.connection.log.append(('execute', query, params))
+        self.description = self.connection.description
+
+    def executemany(self, query, rows):
+        self.connection.log.append(('executemany', query, list(rows)))
+
+    def fetchmany(self, size):
+        self.connection.log.append(('fetchmany', size))
+        rows = self.connection.results[:size]
+        self.connection.results = self.connection.results[size:]
+        return rows
+
+
+class Connection(object):
+    """
+    pymssql connection stand-in, serves canned results of queries.
+    """
+    def __init__(self, description=None, results=()):
+        self.description = description
+        self.results = list(results)
+        self.log = []
+
+    def cursor(self):
+        return Cursor(self)
+
+    def commit(self):
+        self.log.append(('commit',))
+
+    def bulk_copy(self, table, rows, batch_size=None):
+        self.log.append(('bulk_copy', table, list(rows)))
+
+    def statements(self, name):
+        return [entry for entry in self.log if entry[0] == name]
+
+
+class CacheWrapper(object):
+    """
+    RedisWrapper stand-in of the migration cache db.
+    """
+    def __init__(self, hashes):
+        self.hashes = hashes
+
+    def iter_keys(self, pattern='*', count=1000):
+        return (k for k in self.hashes
+                if fnmatchcase(k.decode('utf-8'), pattern))
+
+    def get_dicts(self, keys):
+        return [self.hashes.get(k) for k in keys]
+
+
+def make_tick(directory, ft, price):
+    """
+    :return: (key, hash set) of a cached tick.
+    """
+    row = dict((h, '0') for h in HTf.hermes_tick_headers)
+    row[HTf.ex_time] = row[HTf.local_time] = str(ft)
+    row[HTf.last_price] = str(price * 10000)
+    row[HTf.key] = '{}:{}'.format(directory, ft)
+    return row[HTf.key].encode('utf-8'), row
+
+
+def make_wrapper(connection, cache=None):
+    """
+    SQLWrapper on stand-in connections, without logging in.
+    """
+    s = SQLWrapper.__new__(SQLWrapper)
+    s.connection = connection
+    s.cursor = connection.cursor()
+    s.cache_wrapper = s.hermes_wrapper = cache
+    s.md_decoder = HermesTickDecoder(raw_times=True)
+    s.kl_decoder = HermesKLineDecoder(raw_times=True)
+    s.md_table_name = s.kl_table_name = None
+    return s
+
+
+class Pool(object):
+    """
+    multiprocessing.Pool stand-in, runs tasks in this process.
+    """
+    def __init__(self, processes):
+        self.processes = processes
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def map(self, func, tasks, chunksize=1):
+        return [func(task) for task in tasks]
+
+
+class TestSQLWrapper(unittest.TestCase):
+    """
+    Test migration and queries of SQLWrapper on stand-in connections.
+    """
+    def setUp(self):
+        """
+        :return:
+        """
+        self.cache_root = AthenaConfig.query_cache_root
+        AthenaConfig.query_cache_root = tempfile.mkdtemp()
+
+        # ticks of two instruments, the last ones at the same time
+        au = AthenaConfig.hermes_md_mapping['au1612']
+        ag = AthenaConfig.hermes_md_mapping['ag1612']
+        self.hashes = dict([
+            make_tick(au, FT_0 + 30, 300.),
+            make_tick(ag, FT_0 + 10, 4000.),
+            make_tick(au, FT_0 + 20, 301.),
+            make_tick(ag, FT_0 + 40, 4001.),
+            make_tick(au, FT_0 + 40, 302.),
+        ])
+
+    def tearDown(self):
+        """
+        :return:
+        """
+        shutil.rmtree(AthenaConfig.query_cache_root)
+        AthenaConfig.query_cache_root = self.cache_root
+
+    @staticmethod
+    def inserted(connection):
+        """
+        :return: list of (table, RowId, UniqueIndex) of inserted rows.
+        """
+        rows = []
+        for name, query, batch in connection.statements('executemany'):
+            table = query.split()[2]
+            rows += [(table, row[0], row[-1]) for row in batch]
+        return rows
+
+    def test_bulk_insert(self):
+        connection = Connection()
+        s = make_wrapper(connection)
+        s._insert_batch_size = 2
+        s._commit_interval = 4
+        rows = [(i, 'md.uftreal.au1612:{}'.format(i)) for i in range(5)]
+
+        # >>> rows are inserted by parameterized executemany in batches,
+        # committed every _commit_interval rows and at the end
+        self.assertEqual(s._SQLWrapper__bulk_insert('md_test', iter(rows)), 5)
+        log = [entry[0] for entry in connection.log]
+        self.assertEqual(log, ['executemany', 'executemany', 'commit',
+                               'executemany', 'commit'])
+        name, query, batch = connection.log[0]
+        self.assertEqual(query, 'INSERT INTO md_test VALUES (%s, %s)')
+        self.assertEqual(batch, rows[:2])
+
+        # >>> bulk copy, one transaction per table by default
+        connection = Connection()
+        s = make_wrapper(connection)
+        s._insert_batch_size = 2
+        s._bulk_copy = True
+        s._SQLWrapper__bulk_insert('md_test', iter(rows))
+        self.assertEqual([len(entry[2]) for entry
+                          in connection.statements('bulk_copy')], [2, 2, 1])
+        self.assertEqual(len(connection.statements('commit')), 1)
+        self.assertFalse(connection.statements('executemany'))
+
+    def test_solidify(self):
+        # local time of a row differs from the time suffix of its key, and
+        # a hash set could not be decoded.
+        au = AthenaConfig.hermes_md_mapping['au1612']
+        key, row = make_tick(au, FT_0 + 5, 299.)
+        row[HTf.local_time] = str(FT_0 + 50 * 10 ** 7)
+        self.hashes[key] = row
+        self.hashes[make_tick(au, FT_0 + 15, 0.)[0]] = None
+
+        fetched = []
+        cache = CacheWrapper(self.hashes)
+        get_dicts = cache.get_dicts
+        cache.get_dicts = lambda keys: fetched.extend(keys) or get_dicts(keys)
+
+        connection = Connection()
+        s = make_wrapper(connection, cache)
+        s._batch_size = 2
+        s._SQLWrapper__make_daily_storage_md_table('md_test')
+        self.assertEqual(s._SQLWrapper__solidify_md_data(), 6)
+
+        # >>> hash sets are fetched once, in order of key suffixes
+        self.assertEqual(sorted(fetched), sorted(self.hashes))
+        self.assertEqual(len(fetched), len(set(fetched)))
+        rows = [row for n, q, batch in connection.statements('executemany')
+                for row in batch]
+        self.assertEqual([r[-1][-2:] for r in rows],
+                         ['05', '10', '20', '30', '40', '40'])
+
+        # >>> rows keep the ids of their keys, times are sql strings
+        self.assertEqual([r[0] for r in rows], [0, 1, 3, 4, 5, 6])
+        self.assertEqual(rows[0][3], '2016-09-29 09:00:50.000000')
+        self.assertEqual(rows[0][7], 299.)
+
+    def test_iter_hist_data(self):
+        description = [('Symbol',), ('LocalUpdateTime',), ('LastPrice',)]
+        results = [('au1612', datetime(2016, 9, 29, 9, 0, i), 300. + i)
+                   for i in range(5)]
+        begin, end = datetime(2016, 9, 29, 9), datetime(2016, 9, 29, 15)
+
+        # >>> symbols and time range are query parameters
+        connection = Connection(description, results)
+        s = make_wrapper(connection)
+        rows = list(s.iter_hist_data(
+            ['au1612', 'ag1612'], begin, end, 'md_20160929',
+            columns=['Symbol', 'LocalUpdateTime', 'LastPrice'],
+            batch_size=2))
+        self.assertEqual(rows, results)
+        name, query, params = connection.log[0]
+        self.assertIn('SELECT [Symbol], [LocalUpdateTime], [LastPrice] '
+                      'FROM md_20160929', query)
+        self.assertIn('IN (%s, %s)', query)
+        self.assertEqual(params, ('au1612', 'ag1612', begin, end))
+        self.assertEqual(connection.statements('fetchmany'),
+                         [('fetchmany', 2)] * 4)
+
+        # >>> batches as numpy columns
+        connection = Connection(description, results)
+        s = make_wrapper(connection)
+        s._fetch_batch_size = 3
+        batches = list(s.iter_hist_data(
+            ['au1612'], begin, end, 'md_20160929', as_arrays=True))
+        self.assertEqual([len(b['LastPrice']) for b in batches], [3, 2])
+        self.assertEqual(batches[1]['LastPrice'].tolist(), [303., 304.])
+        self.assertEqual(batches[0]['Symbol'].dtype.kind, 'U')
+        self.assertIn('SELECT * FROM', connection.log[0][1])
+
+    def test_migrate_parallel(self):
+        # >>> serial migration orders rows by time suffixes of keys
+        serial = Connection()
+        s = make_wrapper(serial, CacheWrapper(self.hashes))
+        s._SQLWrapper__make_daily_storage_md_table('md_test')
+        s._SQLWrapper__solidify_md_data()
+        rows = self.inserted(serial)
+        self.assertEqual([row_id for table, row_id, key in rows],
+                         list(range(5)))
+        self.assertEqual([key[-2:] for table, row_id, key in rows],
+                         ['10', '20', '30', '40', '40'])
+        self.assertIn('ag1612', rows[3][2])
+
+        # >>> partitions keep the row ids of serial migration
+        parallel = Connection()
+        s = make_wrapper(parallel, CacheWrapper(self.hashes))
+        s.md_table_name, s.kl_table_name = 'md_test', 'kl_test'
+
+        def migrate_partition(task):
+            worker = make_wrapper(parallel, CacheWrapper(self.hashes))
+            return worker.migrate_partition(*task)
+
+        with mock.patch.object(sql_wrapper, '_migrate_partition',
+                               migrate_partition), \
+                mock.patch.object(sql_wrapper.multiprocessing, 'Pool', Pool):
+            s._SQLWrapper__migrate_parallel(2)
+
+        staged = self.inserted(parallel)
+        self.assertEqual(set(t for t, row_id, key in staged),
+                         {'md_test_0', 'md_test_1'})
+        self.assertEqual(sorted((row_id, key) for t, row_id, key in staged),
+                         [(row_id, key) for t, row_id, key in rows])
+
+        # >>> staging tables are merged by RowId and dropped
+        queries = [q for n, q, p in parallel.statements('execute')]
+        merge = [q for q in queries if 'INSERT INTO md_test' in q]
+        self.assertEqual(len(merge), 1)
+        self.assertIn('md_test_1', merge[0])
+        self.assertIn('ORDER BY [RowId]', merge[0])
+        self.assertIn('DROP TABLE md_test_0', queries)
+        self.assertIn('DROP TABLE md_test_1', queries)
+
 
 if __name__ == '__main__':
-    s = SQLWrapper()
-    s.make_daily_storage_kl_table('blp_kl')
-    s.make_daily_storage_md_table('blp_md')
\ No newline at end of file
+    unittest.main()
@@ -0,0 +1,398 @@
+import os
+import socket
+import inspect
+
+import redis
+
+from Athena.settings import AthenaConfig
+from Athena.data_handler.shm_transport import SharedMemoryTransport
+from Athena.data_handler.codec import decode_message
+
+__author__ = 'zed'
+
+
+class PubSubTransport(object):
+    """
+    Redis pub/sub transport, fire and forget. Subscribers that are not
+    listening (or too slow) when a message is published lose it.
+    """
+    name = 'pubsub'
+
+    def __init__(self, wrapper):
+        """
+        constructor.
+        :param wrapper: RedisWrapper
+        """
+        self.wrapper = wrapper
+        self.sub = None
+
+    def subscribe(self, channels):
+        """
+        :param channels: string or list of strings.
+        :return:
+        """
+        if self.sub is None:
+            self.sub = self.wrapper.connection.pubsub()
+        self.sub.subscribe(channels)
+
+    def publish(self, channel, message, pipe=None):
+        """
+        :param channel: string
+        :param message: string or bytes, encoded message.
+        :param pipe: redis pipeline to stage the write in, None to send it
+            right away.
+        :return:
+        """
+        conn = self.wrapper.connection if pipe is None else pipe
+        conn.publish(channel=channel, message=message)
+
+    def listen(self):
+        """
+        :return: generator of (channel, message) tuples.
+        """
+        for message in self.sub.listen():
+            if message['type'] == 'message':
+                yield message['channel'].decode('utf-8'), message['data']
+
+
+class StreamTransport(object):
+    """
+    Redis streams transport. Every channel is a stream (key
+    AthenaConfig.redis_stream_prefix + channel) trimmed to about
+    AthenaConfig.stream_max_length entries, messages are read in blocking
+    batches of AthenaConfig.stream_read_count.
+
+    Without a consumer group, the transport keeps its own offset of each
+    stream and reads every message from start_id on ('$' for messages
+    published after subscribing, '0' for all retained messages, or the id
+    last processed to resume).
+
+    With a consumer group, messages of a channel are spread over all
+    consumers of the group (e.g. several processes of one heavy signal).
+    A message is acknowledged once processed, that is when the consumer
+    asks for the next one (one XACK round trip per message, not per
+    batch, so that a consumer killed in the middle of a batch gets only
+    the message it was processing again). The message being processed
+    when a consumer stops (or raises) stays pending, and a consumer
+    restarted under the same name first receives the messages it read but
+    did not acknowledge (at-least-once delivery). Channels of AthenaConfig.broadcast_channels
+    (end flags) are delivered to every consumer. Note that consumers of
+    one group should publish to different channels, their counters are
+    not shared.
+
+    Messages of one batch are delivered in order of stream ids, so that
+    messages of several channels are merged by publishing time. Broadcast
+    messages are held back until every data stream has been read up to
+    their ids, so that an end flag never overtakes data published before
+    it, also when the consumer lags behind by more than one batch.
+    """
+    name = 'stream'
+
+    def __init__(self, wrapper, group=None, consumer=None, start_id='$'):
+        """
+        constructor.
+        :param wrapper: RedisWrapper
+        :param group: string, name of consumer group, None to read all
+            messages.
+        :param consumer: string, name of consumer in group, default is
+            'hostname.pid'.
+        :param start_id: string, stream id to start reading from.
+        """
+        self.wrapper = wrapper
+        self.group = group
+        self.consumer = consumer or '{}.{}'.format(
+            socket.gethostname(), os.getpid())
+        self.start_id = start_id
+
+        self.max_length = AthenaConfig.stream_max_length
+        self.count = AthenaConfig.stream_read_count
+        self.block = AthenaConfig.stream_block_ms
+
+        # streams read by consumer group
+        self.group_streams = []
+        # stream -> last id read, of streams read by offsets
+        self.offsets = dict()
+        # streams of broadcast channels, read by offsets
+        self.broadcast_streams = set()
+
+    @staticmethod
+    def stream_key(channel):
+        """
+        :param channel: string
+        :return: string, redis key of the stream.
+        """
+        return AthenaConfig.redis_stream_prefix + channel
+
+    def __last_id(self, stream):
+        """
+        resolve '$' to the id of the latest message, so that messages
+        published between two reads are not skipped.
+        """
+        if self.start_id != '$':
+            return self.start_id
+        latest = self.wrapper.connection.xrevrange(stream, count=1)
+        return latest[0][0] if latest else '0-0'
+
+    def subscribe(self, channels):
+        """
+        :param channels: string or list of strings.
+        :return:
+        """
+        if type(channels) == str:
+            channels = [channels]
+
+        for channel in channels:
+            stream = self.stream_key(channel)
+            if self.group and channel not in AthenaConfig.broadcast_channels:
+                try:
+                    self.wrapper.connection.xgroup_create(
+                        stream, self.group, id=self.start_id, mkstream=True)
+                except redis.ResponseError as e:
+                    # group exists, continue from its offset
+                    if 'BUSYGROUP' not in str(e):
+                        raise
+                self.group_streams.append(stream)
+            else:
+                self.offsets[stream] = self.__last_id(stream)
+                if channel in AthenaConfig.broadcast_channels:
+                    self.broadcast_streams.add(stream)
+
+    def publish(self, channel, message, pipe=None):
+        """
+        :param channel: string
+        :param message: string or bytes, encoded message.
+        :param pipe: redis pipeline to stage the write in, None to send it
+            right away.
+        :return:
+        """
+        conn = self.wrapper.connection if pipe is None else pipe
+        conn.xadd(self.stream_key(channel), {'d': message},
+                  maxlen=self.max_length, approximate=True)
+
+    @staticmethod
+    def __channel(stream):
+        """
+        :param stream: string, stream key.
+        :return: string
+        """
+        return stream[len(AthenaConfig.redis_stream_prefix):]
+
+    @staticmethod
+    def __order(entry_id):
+        """
+        :param entry_id: bytes, like b'1475200000000-0'
+        :return: tuple of ints.
+        """
+        ms, seq = entry_id.split(b'-')
+        return int(ms), int(seq)
+
+    def listen(self):
+        """
+        :return: generator of (channel, message) tuples.
+        """
+        conn = self.wrapper.connection
+
+        # first deliver messages read by this consumer but not acknowledged
+        pending = bool(self.group_streams)
+        # data stream -> order of last id read, None once the last read
+        # returned all its messages
+        read_up_to = dict((s, (0, 0)) for s in self.group_streams + [
+            s for s in self.offsets if s not in self.broadcast_streams])
+        # broadcast entries read but not delivered yet
+        held = []
+
+        while True:
+            block = None if pending or held else self.block
+            # broadcasts are read before (or with) the data streams, so that
+            # data streams read to the end cover every broadcast read
+            pipe = conn.pipeline(transaction=False)
+            if self.offsets:
+                pipe.xread(
+                    self.offsets,
+                    count=self.count,
+                    block=None if self.group_streams else block
+                )
+            if self.group_streams:
+                ids = '0' if pending else '>'
+                pipe.xreadgroup(
+                    self.group, self.consumer,
+                    dict((s, ids) for s in self.group_streams),
+                    count=self.count,
+                    block=block
+                )
+            results = pipe.execute()
+
+            read = (results.pop(0) if self.offsets else None) or []
+            grouped = (results.pop(0) if self.group_streams else None) or []
+
+            # merge batch by stream ids
+            batch = []
+            last_read = dict()
+            for stream, entries in list(read) + list(grouped):
+                stream = stream.decode('utf-8')
+                if not entries:
+                    continue
+                if stream in self.offsets:
+                    self.offsets[stream] = entries[-1][0]
+                target = held if stream in self.broadcast_streams else batch
+                for entry_id, fields in entries:
+                    target.append((self.__order(entry_id), stream, entry_id,
+                                   fields))
+                if len(entries) >= self.count:
+                    last_read[stream] = self.__order(entries[-1][0])
+
+            if not pending:
+                for stream in self.group_streams + [
+                        s for s in self.offsets
+                        if s not in self.broadcast_streams]:
+                    read_up_to[stream] = last_read.get(stream)
+            elif not any(entries for s, entries in grouped):
+                pending = False
+
+            # release broadcasts every data stream has been read up to
+            bounds = [o for o in read_up_to.values() if o is not None]
+            bound = min(bounds) if bounds else None
+            batch.extend(e for e in held if bound is None or e[0] <= bound)
+            held = [e for e in held if bound is not None and e[0] > bound]
+            batch.sort(key=lambda x: x[0])
+
+            for order, stream, entry_id, fields in batch:
+                # trimmed before it is read
+                if fields:
+                    yield self.__channel(stream), fields[b'd']
+
+                # acknowledge message of group once processed
+                if stream not in self.offsets:
+                    conn.xack(stream, self.group, entry_id)
+
+
+class LocalBus(object):
+    """
+    In-process registry of LocalTransport subscribers by channel.
+    """
+    def __init__(self):
+        """
+        constructor.
+        """
+        # channel -> list of LocalTransport
+        self.subscribers = dict()
+
+    def subscribe(self, channel, transport):
+        """
+        :param channel: string
+        :param transport: LocalTransport
+        :return:
+        """
+        self.subscribers.setdefault(channel, []).append(transport)
+
+    def dispatch(self, channel, data):
+        """
+        hand data over to the handlers of channel subscribers, each gets a
+        copy.
+        :param channel: string
+        :param data: dict
+        :return: int, number of handlers called.
+        """
+        count = 0
+        for transport in self.subscribers.get(channel, ()):
+            if transport.handler is not None:
+                transport.handler(dict(data))
+                count += 1
+        return count
+
+    def clear(self):
+        """
+        remove all subscribers.
+        """
+        self.subscribers = dict()
+
+
+# bus of local transports in this process
+local_bus = LocalBus()
+
+
+class LocalTransport(object):
+    """
+    In-process transport for offline replay (see offline_replay.py), no
+    redis involved. Messages published on a channel are decoded and
+    handed over to the handler (on_message) of each subscriber right
+    away, in the publishing call.
+
+    listen() yields nothing: subscribers are driven by the replay engine,
+    which sets their handlers.
+    """
+    name = 'local'
+
+    def __init__(self, wrapper=None, bus=None):
+        """
+        constructor.
+        :param wrapper: RedisWrapper, unused, for the interface of
+            transports.
+        :param bus: LocalBus, default is local_bus.
+        """
+        self.wrapper = wrapper
+        self.bus = bus or local_bus
+        self.handler = None
+
+    def subscribe(self, channels):
+        """
+        :param channels: string or list of strings.
+        :return:
+        """
+        if type(channels) == str:
+            channels = [channels]
+        for channel in channels:
+            self.bus.subscribe(channel, self)
+
+    def publish(self, channel, message, pipe=None):
+        """
+        :param channel: string
+        :param message: string or bytes, encoded message.
+        :param pipe: unused.
+        :return:
+        """
+        if channel in self.bus.subscribers:
+            key, data = decode_message(message)
+            self.bus.dispatch(channel, data)
+
+    def listen(self):
+        """
+        :return: empty generator.
+        """
+        return iter(())
+
+
+transports = {
+    PubSubTransport.name: PubSubTransport,
+    StreamTransport.name: StreamTransport,
+    SharedMemoryTransport.name: SharedMemoryTransport,
+    LocalTransport.name: LocalTransport
+}
+
+
+def make_transport(wrapper, name=None, **kwargs):
+    """
+    create the transport of publishers and subscribers.
+    :param wrapper: RedisWrapper
+    :param name: string, default is AthenaConfig.transport.
+    :param kwargs: options of the transport, like group of StreamTransport.
+        Options set (not None) that the transport does not take raise
+        ValueError, e.g. a consumer group of pub/sub.
+    :return: transport object, implementing subscribe(channels),
+        publish(channel, message, pipe=None) and listen().
+    """
+    if name is None:
+        name = AthenaConfig.transport
+    try:
+        transport_type = transports[name]
+    except KeyError:
+        raise ValueError('Unknown transport {}.'.format(name))
+
+    # options that are not set are left to defaults of the transport
+    options = dict((k, v) for k, v in kwargs.items() if v is not None)
+    parameters = inspect.signature(transport_type).parameters
+    unknown = sorted(k for k in options if k not in parameters)
+    if unknown:
+        raise ValueError('Transport {} does not support {}.'.format(
+            name, ', '.join(unknown)))
+    return transport_type(wrapper, **options)
@@ -0,0 +1,144 @@
+import unittest
+
+from Athena.settings import AthenaConfig
+from Athena.data_handler.transport import make_transport, PubSubTransport, \
+    StreamTransport
+
+__author__ = 'zed'
+
+
+class StreamConnection(object):
+    """
+    redis connection stand-in, records commands and answers reads with
+    canned results.
+    """
+    def __init__(self, results):
+        self.results = list(results)
+        self.commands = []
+
+    def pipeline(self, transaction=False):
+        return self
+
+    def execute(self):
+        answers = [self.results.pop(0) for name, args, kwargs
+                   in self.commands if name.startswith('xread')]
+        self.commands = [c for c in self.commands if c[0] == 'xack']
+        return answers
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return []
+        return command
+
+
+class Wrapper(object):
+    def __init__(self, connection):
+        self.connection = connection
+
+
+class TestTransport(unittest.TestCase):
+    """
+    Test transports of messages.
+    """
+    def test_make_transport(self):
+        wrapper = Wrapper(StreamConnection([]))
+        self.assertEqual(type(make_transport(wrapper)), PubSubTransport)
+
+        # >>> options that are not set are left to defaults
+        transport = make_transport(wrapper, 'stream', group=None)
+        self.assertEqual(type(transport), StreamTransport)
+        self.assertIsNone(transport.group)
+        self.assertRaises(ValueError, make_transport, wrapper, 'carrier')
+
+        # >>> consumer groups are only supported by streams
+        for name in ('pubsub', 'shm', 'local'):
+            self.assertRaises(ValueError, make_transport, wrapper, name,
+                              group='ma')
+        self.assertEqual(make_transport(wrapper, 'stream', group='ma').group,
+                         'ma')
+
+    def test_stream_publish(self):
+        connection = StreamConnection([])
+        transport = StreamTransport(Wrapper(connection))
+        transport.publish('md:au1612', b'message', connection)
+
+        # >>> messages are appended to trimmed streams
+        name, args, kwargs = connection.commands[0]
+        self.assertEqual(name, 'xadd')
+        self.assertEqual(args, ('stream:md:au1612', {'d': b'message'}))
+        self.assertEqual(kwargs['maxlen'], AthenaConfig.stream_max_length)
+
+    def test_stream_group_listen(self):
+        pending = [[b'stream:md:au1612', []], [b'stream:kl:au1612.1m', []]]
+        batch = [
+            [b'stream:md:au1612', [
+                (b'1475200000000-0', {b'd': b'md_0'}),
+                (b'1475200000002-0', {b'd': b'md_1'})]],
+            [b'stream:kl:au1612.1m', [
+                (b'1475200000001-0', {b'd': b'kl_0'})]]
+        ]
+        flags = [[b'stream:flags', [(b'1475200000003-0', {b'd': b'end'})]]]
+        connection = StreamConnection([[], pending, flags, batch])
+
+        transport = StreamTransport(Wrapper(connection), group='ma')
+        transport.subscribe(['md:au1612', 'kl:au1612.1m', 'flags'])
+        self.assertEqual(len(transport.group_streams), 2)
+        self.assertIn('stream:flags', transport.offsets)
+
+        # >>> messages of a batch are merged by ids, broadcasts come last
+        messages = transport.listen()
+        received = [next(messages) for i in range(4)]
+        self.assertEqual([m for c, m in received],
+                         [b'md_0', b'kl_0', b'md_1', b'end'])
+        self.assertEqual(received[1][0], 'kl:au1612.1m')
+        self.assertEqual(transport.offsets['stream:flags'],
+                         b'1475200000003-0')
+
+        # >>> each message is acknowledged when the next one is asked for,
+        # before the end of the batch
+        acks = [args for name, args, kwargs in connection.commands
+                if name == 'xack']
+        self.assertEqual(acks, [
+            ('stream:md:au1612', 'ma', b'1475200000000-0'),
+            ('stream:kl:au1612.1m', 'ma', b'1475200000001-0'),
+            ('stream:md:au1612', 'ma', b'1475200000002-0')])
+        messages.close()
+
+        # >>> message being processed when consumer stops is not
+        # acknowledged
+        connection = StreamConnection([[], pending, [], batch])
+        transport = StreamTransport(Wrapper(connection), group='ma')
+        transport.subscribe(['md:au1612', 'kl:au1612.1m'])
+        messages = transport.listen()
+        next(messages)
+        messages.close()
+        self.assertFalse([c for c in connection.commands if c[0] == 'xack'])
+
+    def test_stream_listen_lagging(self):
+        au = b'stream:md:au1612'
+        ag = b'stream:md:ag1612'
+        first = [
+            [au, [(b'1-0', {b'd': b'au_0'}), (b'3-0', {b'd': b'au_1'})]],
+            [ag, [(b'2-0', {b'd': b'ag_0'})]],
+            [b'stream:flags', [(b'4-0', {b'd': b'end'})]]
+        ]
+        second = [[au, [(b'5-0', {b'd': b'au_2'})]]]
+        connection = StreamConnection([first, second])
+
+        transport = StreamTransport(Wrapper(connection))
+        transport.count = 2
+        transport.subscribe(['md:au1612', 'md:ag1612', 'flags'])
+
+        # >>> channels are merged by ids, flag waits for a full batch of
+        # au to be read to the end
+        messages = transport.listen()
+        received = [next(messages) for i in range(5)]
+        self.assertEqual([m for c, m in received],
+                         [b'au_0', b'ag_0', b'au_1', b'end', b'au_2'])
+        self.assertEqual(received[3][0], 'flags')
+        self.assertEqual(transport.offsets['stream:md:au1612'], b'5-0')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -180,12 +180,11 @@ class CandlestickGraphItem(pg.GraphicsObject):
         update plot.
         :return:
         """
-        # candles
-        keys_to_update_bars = self.sub_wrapper.get_keys(
-            '{}:*'.format(self.sub_channel))
+        # candles, new records in time index, removed once read
+        dicts_to_update_bars = self.sub_wrapper.get_range(
+            self.sub_channel, remove=True)
 
-        for dict_key in keys_to_update_bars:
-            dict_data = self.sub_wrapper.get_dict(dict_key)
+        for dict_data in dicts_to_update_bars:
 
             # append row to ohlc data.
             row = [
@@ -199,16 +198,12 @@ class CandlestickGraphItem(pg.GraphicsObject):
             ]
             self.ohlc_data.append(row)
 
-            # delete key
-            self.sub_wrapper.connection.delete(dict_key)
-
         # buy/sell signals
         if self.added_strategy:
-            keys_to_update_orders = self.sub_wrapper.get_keys(
-                '{}:*'.format(self.strategy_channel))
+            dicts_to_update_orders = self.sub_wrapper.get_range(
+                self.strategy_channel, remove=True)
 
-            for dict_key in keys_to_update_orders:
-                dict_data = self.sub_wrapper.get_dict(dict_key)
+            for dict_data in dicts_to_update_orders:
 
                 # append row
                 row = [
@@ -219,8 +214,6 @@ class CandlestickGraphItem(pg.GraphicsObject):
                 ]
                 if row[1] in ['long', 'short']:
                     self.buy_sell_data.append(row)
-                # delete key
-                self.sub_wrapper.connection.delete(dict_key)
 
         self.setPos(-len(self.ohlc_data), 0)
         self.drawPicture()
@@ -212,10 +212,10 @@ class CurveGraphItem(pg.GraphicsObject):
         """
         # update donchian channel
         if self.added_donchian:
-            keys_to_update_don = self.sub_wrapper.get_keys(
-                    '{}:*'.format(self.donchian_sub_channel))
-            for dict_key in keys_to_update_don:
-                dict_data = self.sub_wrapper.get_dict(dict_key)
+            # new records in time index, removed once read
+            dicts_to_update_don = self.sub_wrapper.get_range(
+                self.donchian_sub_channel, remove=True)
+            for dict_data in dicts_to_update_don:
                 # append row
                 row = [
                     dict_data['open_time'],
@@ -228,26 +228,21 @@ class CurveGraphItem(pg.GraphicsObject):
                     int(dict_data['count']),
                 ]
                 self.curve_data['donchian'].append(row)
-                # delete key
-                self.sub_wrapper.connection.delete(dict_key)
             # relative positioning
             self.setPos(-len(self.curve_data['donchian']), 0)
 
         # update ma batch
         if self.added_ma:
-            keys_to_update_ma = self.sub_wrapper.get_keys(
-                '{}:*'.format(self.ma_sub_channel))
+            dicts_to_update_ma = self.sub_wrapper.get_range(
+                self.ma_sub_channel, remove=True)
 
-            for dict_key in keys_to_update_ma:
-                dict_data = self.sub_wrapper.get_dict(dict_key)
+            for dict_data in dicts_to_update_ma:
                 # append row
                 row = [dict_data['open_time']]
                 for width in self.ma_window_widths:
                     row.append(float(dict_data[str(width)]))
                 row.append(int(dict_data['count']))
                 self.curve_data['ma'].append(row)
-                # delete key
-                self.sub_wrapper.connection.delete(dict_key)
             # relative positioning
             self.setPos(-len(self.curve_data['ma']), 0)
 
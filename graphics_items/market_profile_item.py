@@ -108,12 +108,11 @@ class MarketProfileItem(pg.GraphicsObject):
         update plot.
         :return:
         """
-        # keys
-        keys_to_update_bars = self.sub_wrapper.get_keys(
-            '{}:*'.format(self.sub_channel))
+        # new records in time index, removed once read
+        dicts_to_update_bars = self.sub_wrapper.get_range(
+            self.sub_channel, remove=True)
 
-        for dict_key in keys_to_update_bars:
-            dict_data = self.sub_wrapper.get_dict(dict_key)
+        for dict_data in dicts_to_update_bars:
 
             # parse market profile lists
             str_data = json.dumps(dict_data)
@@ -160,9 +159,6 @@ class MarketProfileItem(pg.GraphicsObject):
                     int(dict_data['vah_index'])
                 )
 
-            # delete key
-            self.sub_wrapper.connection.delete(dict_key)
-
         self.setPos(-self.tot_bar_count-1, 0)
         self.drawPicture()
 
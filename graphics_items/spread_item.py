@@ -201,10 +201,10 @@ class SpreadGraphItem(pg.GraphicsObject):
         """
         # update spread
         if self.pair:
-            keys_to_update = self.sub_wrapper.get_keys(
-                    '{}:*'.format(self.sub_channels[self.pair]))
-            for dict_key in keys_to_update:
-                dict_data = self.sub_wrapper.get_dict(dict_key)
+            # new records in time index, removed once read
+            dicts_to_update = self.sub_wrapper.get_range(
+                self.sub_channels[self.pair], remove=True)
+            for dict_data in dicts_to_update:
                 # append row
                 row = [
                     dict_data[Kf.close_time],
@@ -218,15 +218,12 @@ class SpreadGraphItem(pg.GraphicsObject):
                 ]
 
                 self.curve_data.append(row)
-                # delete key
-                self.sub_wrapper.connection.delete(dict_key)
 
         if self.added_strategy:
-            keys_to_update_orders = self.sub_wrapper.get_keys(
-                '{}:*'.format(self.strategy_channel))
+            dicts_to_update_orders = self.sub_wrapper.get_range(
+                self.strategy_channel, remove=True)
 
-            for dict_key in keys_to_update_orders:
-                dict_data = self.sub_wrapper.get_dict(dict_key)
+            for dict_data in dicts_to_update_orders:
 
                 # append row
                 row = [
@@ -239,9 +236,6 @@ class SpreadGraphItem(pg.GraphicsObject):
                 if row[1] in ['long', 'short']:
                     self.buy_sell_data.append(row)
 
-                # delete key
-                self.sub_wrapper.connection.delete(dict_key)
-
         # draw picture
         self.setPos(-len(self.curve_data), 0)
         self.drawPicture()
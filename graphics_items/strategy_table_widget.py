@@ -138,17 +138,10 @@ class StrategyTableWidget(QtGui.QTableWidget):
         """
         for k,v in self.sub_channels.items():
 
-            # keys to update
-            keys_to_update = self.sub_wrapper.get_keys('{}:*'.format(v))
+            # we only use the last one, earlier records are dropped
+            dicts_to_update = self.sub_wrapper.get_range(v, remove=True)
+            dict_data = dicts_to_update[-1] if dicts_to_update else dict()
 
-            dict_data = dict()
-
-            for dict_key in keys_to_update:
-                dict_data = self.sub_wrapper.get_dict(dict_key)
-                # delete key
-                self.sub_wrapper.connection.delete(dict_key)
-
-            # we only use the last one
             if dict_data:
                 row = [
                     dict_data['tag'],        # name
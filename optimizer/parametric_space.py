@@ -1,8 +1,9 @@
-import json
 import numpy as np
 
 from Athena.settings import AthenaConfig
 from Athena.data_handler.redis_wrapper import RedisWrapper
+from Athena.data_handler.codec import decode_message
+from Athena.data_handler.transport import make_transport
 from Athena.portfolio.portfolio import Portfolio, PositionDirection
 Tf, Kf, Of = AthenaConfig.HermesTickFields, AthenaConfig.HermesKLineFields, \
              AthenaConfig.OrderFields
@@ -39,32 +40,29 @@ class ParametricNode(object):
 
         # open connection
         self.redis_wrapper = RedisWrapper(db=AthenaConfig.athena_db_index)
-        self.sub = self.redis_wrapper.connection.pubsub()
+        self.transport = make_transport(self.redis_wrapper)
 
         # subscribe
         self.sub_channel \
             = strategy_name_prefix + '.' + str(param_list)
         self.strategy_full_name = self.sub_channel
-        self.sub.subscribe(self.sub_channel)
-        self.sub.subscribe('flags')
+        self.transport.subscribe(self.sub_channel)
+        self.transport.subscribe('flags')
 
     def start(self):
         """
 
         """
-        for message in self.sub.listen():
-            if message['type'] == 'message':
-                str_data = message['data'].decode('utf-8')
-                dict_data = json.loads(str_data)
-                d = list(dict_data.values())[0]
-
-                # operations on flags
-                if d['tag'] == 'flag':
-                    if d['type'] == 'flag_0':
-                        self.__publish_result()
-                        return
-                else:
-                    self.on_message(d)
+        for channel, payload in self.transport.listen():
+            key, d = decode_message(payload)
+
+            # operations on flags
+            if d['tag'] == 'flag':
+                if d['type'] == 'flag_0':
+                    self.__publish_result()
+                    return
+            else:
+                self.on_message(d)
 
     def __publish_result(self):
         """
@@ -184,6 +184,22 @@ class AthenaConfig(object):
     redis_host_remote_1 = '10.88.26.26'
     redis_port = 6379
 
+    # clients of one process are shared by all wrappers of the same
+    # (host, port, db), see data_handler.redis_wrapper.get_client. Local
+    # server is reached by unix domain socket if redis_unix_socket is set
+    # (path, like '/var/run/redis/redis.sock').
+    redis_unix_socket = None
+    redis_socket_keepalive = True
+    redis_health_check_interval = 30
+    redis_max_connections = None
+
+    # number of keys scanned per round trip of SCAN, see
+    # RedisWrapper.iter_keys. KEYS is never used, it blocks the server.
+    redis_scan_count = 1000
+    # whether the server filters SCAN by type (SCAN ... TYPE, Redis 6.0 on,
+    # not the bundled 2.8 server). Otherwise types are checked by the client.
+    redis_scan_type = False
+
     hist_stream_db_index = 3
     athena_db_index = 1
     daily_migration_cache_db_index = 10
@@ -194,6 +210,39 @@ class AthenaConfig(object):
     redis_md_max_records = 1e9
     redis_key_max_digits = 9
     redis_md_end_flag = 'md_end'
+    redis_replay_clock_key = 'clock:replay'
+    # sorted set of keys of each channel, scored by event time or count
+    # (see RedisWrapper.get_range)
+    redis_index_prefix = 'index:'
+
+    # storage of published records, 'hash' (one hash set per record) or
+    # 'packed' (chunks of packed records, see data_handler.packed_store)
+    storage = 'hash'
+    redis_packed_prefix = 'packed:'
+    packed_chunk_size = 256
+
+    # codec of published messages, 'json' or 'binary' (see data_handler.codec)
+    # channel_codecs maps channel patterns (fnmatch style) to codecs, like
+    # {'md:*': 'binary', 'kl:*': 'binary'}, others use default_codec.
+    # subscribers detect the codec of each message by itself.
+    default_codec = 'json'
+    channel_codecs = {}
+
+    # transport of published messages, 'pubsub', 'stream', 'shm' or 'local'
+    # (see data_handler.transport)
+    transport = 'pubsub'
+    redis_stream_prefix = 'stream:'
+    stream_max_length = 100000
+    stream_read_count = 100
+    stream_block_ms = 1000
+    # channels delivered to every consumer of a consumer group
+    broadcast_channels = ('flags',)
+    # shared memory rings of same-host transport, bytes per slot and slots
+    # per channel (longer messages are split over consecutive slots);
+    # polling interval (min, max) of idle subscribers, seconds
+    shm_slot_size = 2048
+    shm_slot_count = 4096
+    shm_poll_interval = (0.00005, 0.001)
 
     # The following section is to configure Hermes raw data stream
     # ---------------------------------------------------------------------
@@ -627,6 +676,41 @@ class AthenaConfig(object):
     hermes_db_index = 0
     hermes_md_sep_char = '|'
 
+    # trading sessions of each exchange, ('HH:MM', 'HH:MM') of a day.
+    # Both ends of a session are inclusive.
+    trade_sessions = {
+        'SHFE': (
+            ('00:00', '02:30'),
+            ('09:00', '10:15'),
+            ('10:30', '11:30'),
+            ('13:29', '15:00'),
+            ('21:00', '24:00')
+        ),
+        'SGE': (
+            ('00:00', '02:30'),
+            ('09:00', '11:30'),
+            ('13:29', '15:30'),
+            ('20:00', '24:00')
+        ),
+        'CME': (
+            ('00:00', '05:00'),
+            ('05:30', '24:00')
+        )
+    }
+
+    # json file of holidays and special sessions, see trade_time.py
+    # None for no overrides.
+    trade_calendar_file = None
+
+    # root directory of the columnar archive of ticks and bars,
+    # see data_handler/archive.py
+    archive_root = 'archive'
+
+    # root directory and size bound (bytes) of the local cache of
+    # historical query results, see data_handler/query_cache.py
+    query_cache_root = 'query_cache'
+    query_cache_max_bytes = 4 * 1024 ** 3
+
     # The following section is to configure Athena dictionary data structure.
     # ---------------------------------------------------------------------
     class AthenaMessageTypes(object):
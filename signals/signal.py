@@ -1,8 +1,10 @@
-import json
 from abc import ABCMeta, abstractmethod
 
 from Athena.settings import AthenaConfig
 from Athena.data_handler.redis_wrapper import RedisWrapper
+from Athena.data_handler.codec import encode_message, decode_message
+from Athena.data_handler.transport import make_transport
+from Athena.data_handler.packed_store import PackedStore
 from Athena.utils import append_digits_suffix_for_redis_key
 
 __author__ = 'zed'
@@ -63,10 +65,25 @@ class SignalTemplate(Signal):
 
     The signal object is only running on athena db, hence it suffices to
     open one connection.
+
+    Messages are sent and received by the transport _transport (None for
+    AthenaConfig.transport). With 'stream' transport, signals of the same
+    _consumer_group share the messages of subscribed channels.
+
+    With _storage (or AthenaConfig.storage) 'packed', published records are
+    appended to a PackedStore in place of hash sets; plotting records are
+    still hash sets.
     """
     signal_name_prefix = 'signal:template'
     param_names = ['abstract']
 
+    # transport and consumer group of streams
+    _transport = None
+    _consumer_group = None
+
+    # storage of published records, None for AthenaConfig.storage
+    _storage = None
+
     def __init__(self, subscribe_list, duplicate=1):
         """
         constructor.
@@ -78,10 +95,16 @@ class SignalTemplate(Signal):
         # open connection to redis server.
         self.redis_wrapper = RedisWrapper(db=AthenaConfig.athena_db_index)
         # create a listener
-        self.sub = self.redis_wrapper.connection.pubsub()
+        self.transport = make_transport(
+            self.redis_wrapper, self._transport, group=self._consumer_group)
         # subscribe channels in the list
-        self.sub.subscribe(self.subscribe_list)
-        self.sub.subscribe('flags')
+        self.transport.subscribe(self.subscribe_list)
+        self.transport.subscribe('flags')
+
+        # packed storage of published records, None for hash sets
+        self.packed_store = None
+        if (self._storage or AthenaConfig.storage) == 'packed':
+            self.packed_store = PackedStore(self.redis_wrapper)
 
         self.tag = 'abstract'
 
@@ -116,18 +139,17 @@ class SignalTemplate(Signal):
         """
         let signal start running.
         """
-        for message in self.sub.listen():
-            if message['type'] == 'message':
-                str_data = message['data'].decode('utf-8')
-                dict_data = json.loads(str_data)
-                d = list(dict_data.values())[0]
-
-                # operations on flags
-                if d['tag'] == 'flag':
-                    if d['type'] == 'flag_0':
-                        return
-                else:
-                    self.on_message(d)
+        for channel, payload in self.transport.listen():
+            key, d = decode_message(payload)
+
+            # operations on flags
+            if d['tag'] == 'flag':
+                if d['type'] == 'flag_0':
+                    if self.packed_store is not None:
+                        self.packed_store.flush()
+                    return
+            else:
+                self.on_message(d)
 
     def publish(self, data, plot=True):
         """
@@ -146,16 +168,17 @@ class SignalTemplate(Signal):
         if self.tag:
             data['tag'] = self.tag
 
-        # publish dict data
-        self.redis_wrapper.set_dict(athena_unique_key, data)
+        # publish dict data, indexed by count
+        if self.packed_store is not None:
+            self.packed_store.append(self.pub_channel, data)
+        else:
+            self.redis_wrapper.set_indexed_dict(
+                self.pub_channel, athena_unique_key, data, self.counter)
 
         # publish str message
-        # first serialize json dict to string.
-        message = json.dumps({athena_unique_key: data})
-        self.redis_wrapper.connection.publish(
-            channel=self.pub_channel,
-            message=message
-        )
+        # first serialize dict to string (by codec of channel).
+        message = encode_message(self.pub_channel, athena_unique_key, data)
+        self.transport.publish(self.pub_channel, message)
 
         # publish plotting data
         if plot:
@@ -168,14 +191,16 @@ class SignalTemplate(Signal):
                     )
 
                 # publish plotting (dict) data.
-                self.redis_wrapper.set_dict(athena_unique_key_plotting, data)
+                self.redis_wrapper.set_indexed_dict(
+                    self.plot_data_channel, athena_unique_key_plotting, data,
+                    self.counter
+                )
 
                 # publish plotting str message
-                plot_message = json.dumps({athena_unique_key_plotting: data})
-                self.redis_wrapper.connection.publish(
-                    channel=self.plot_data_channel,
-                    message=plot_message
+                plot_message = encode_message(
+                    self.plot_data_channel, athena_unique_key_plotting, data
                 )
+                self.transport.publish(self.plot_data_channel, plot_message)
 
             elif type(self.plot_data_channel) == list:
                 for i in range(len(self.plot_data_channel)):
@@ -188,18 +213,19 @@ class SignalTemplate(Signal):
                         )
 
                     # publish plotting (dict) data.
-                    self.redis_wrapper.set_dict(
-                        athena_unique_key_plotting, data
+                    self.redis_wrapper.set_indexed_dict(
+                        this_plot_data_channel, athena_unique_key_plotting,
+                        data, self.counter
                     )
 
                     # publish plotting str message
-                    plot_message = json.dumps(
-                        {athena_unique_key_plotting: data}
-                    )
-                    self.redis_wrapper.connection.publish(
-                        channel=this_plot_data_channel,
-                        message=plot_message
+                    plot_message = encode_message(
+                        this_plot_data_channel,
+                        athena_unique_key_plotting,
+                        data
                     )
+                    self.transport.publish(
+                        this_plot_data_channel, plot_message)
 
         # update the one record for storing last signal
         # note that this 'current' can only be retrieved subjectively
@@ -77,7 +77,9 @@ class CTAStrategy2(StrategyTemplate):
         if debug:   # if we don't care about time
             return True
 
-        dt = datetime.strptime(dt, AthenaConfig.dt_format)
+        if type(dt) == str:
+            # formatted by json codec
+            dt = datetime.strptime(dt, AthenaConfig.dt_format)
         day_start = datetime(dt.year, dt.month, dt.day)
         if day_start + timedelta(hours=9, minutes=30) < dt \
                 <= day_start + timedelta(hours=14):
@@ -1,10 +1,11 @@
-import json
 from abc import ABCMeta, abstractmethod, abstractproperty
 
 from Athena.settings import AthenaConfig
 from Athena.containers import OrderEvent
 from Athena.utils import append_digits_suffix_for_redis_key
 from Athena.data_handler.redis_wrapper import RedisWrapper
+from Athena.data_handler.codec import get_codec, decode_message
+from Athena.data_handler.transport import make_transport
 
 __author__ = 'zed'
 
@@ -55,10 +56,17 @@ class StrategyTemplate(Strategy):
     """
     A template strategy class from which other implementations of strategies
     inherits.
+
+    Messages are sent and received by the transport _transport (None for
+    AthenaConfig.transport), see SignalTemplate.
     """
     strategy_name_prefix = 'strategy:template'
     param_names = ['abstract']
 
+    # transport and consumer group of streams
+    _transport = None
+    _consumer_group = None
+
     def __init__(self, subscribe_list, duplicate=1):
         """
         constructor
@@ -72,10 +80,11 @@ class StrategyTemplate(Strategy):
         # open connection
         self.redis_wrapper = RedisWrapper(db=AthenaConfig.athena_db_index)
         # create a sub.
-        self.sub = self.redis_wrapper.connection.pubsub()
+        self.transport = make_transport(
+            self.redis_wrapper, self._transport, group=self._consumer_group)
         # subscribe channels in the subscribe_list
-        self.sub.subscribe(self.subscribe_list)
-        self.sub.subscribe('flags')
+        self.transport.subscribe(self.subscribe_list)
+        self.transport.subscribe('flags')
 
     def _map_to_channels(self, param_list, suffix=None, full_name=False):
         """
@@ -103,18 +112,15 @@ class StrategyTemplate(Strategy):
         begin the loop of strategies.
         :return:
         """
-        for message in self.sub.listen():
-            if message['type'] == 'message':
-                str_data = message['data'].decode('utf-8')
-                dict_data = json.loads(str_data)
-                d = list(dict_data.values())[0]
+        for channel, payload in self.transport.listen():
+            key, d = decode_message(payload)
 
-                # operations on flags
-                if d['tag'] == 'flag':
-                    if d['type'] == 'flag_0':
-                        return
-                else:
-                    self.on_message(d)
+            # operations on flags
+            if d['tag'] == 'flag':
+                if d['type'] == 'flag_0':
+                    return
+            else:
+                self.on_message(d)
 
     def publish(self, order_event, plot=False):
         """
@@ -133,16 +139,16 @@ class StrategyTemplate(Strategy):
         order_dict = dict(order_event._asdict())
         order_dict['tag'] = self.strategy_name
 
-        self.redis_wrapper.set_dict(published_key, order_dict)
+        self.redis_wrapper.set_indexed_dict(
+            self.strategy_name, published_key, order_dict, self.counter)
 
-        # serialize json dict to string.
-        published_message = json.dumps({published_key: order_dict})
+        # serialize dict to string (by codec of channel).
+        message_key = published_key
+        published_message = get_codec(self.pub_channel).encode(
+            message_key, order_dict)
 
         # publish the message to support other subscriber.
-        self.redis_wrapper.connection.publish(
-            channel=self.pub_channel,
-            message=published_message
-        )
+        self.transport.publish(self.pub_channel, published_message)
 
         if plot:
             # create hash set object in redis.
@@ -151,12 +157,16 @@ class StrategyTemplate(Strategy):
                 counter=self.counter
             )
 
-            self.redis_wrapper.set_dict(published_key, order_dict)
+            self.redis_wrapper.set_indexed_dict(
+                self.plot_data_channel, published_key, order_dict,
+                self.counter
+            )
 
             # publish the message to support other subscriber.
-            self.redis_wrapper.connection.publish(
-                channel=self.plot_data_channel,
-                message=published_message
+            self.transport.publish(
+                self.plot_data_channel,
+                get_codec(self.plot_data_channel).encode(
+                    message_key, order_dict)
             )
 
             # table updating
@@ -165,12 +175,16 @@ class StrategyTemplate(Strategy):
                 counter=self.counter
             )
 
-            self.redis_wrapper.set_dict(published_key, order_dict)
+            self.redis_wrapper.set_indexed_dict(
+                self.table_data_channel, published_key, order_dict,
+                self.counter
+            )
 
             # publish the message to support other subscriber.
-            self.redis_wrapper.connection.publish(
-                channel=self.table_data_channel,
-                message=published_message
+            self.transport.publish(
+                self.table_data_channel,
+                get_codec(self.table_data_channel).encode(
+                    message_key, order_dict)
             )
 
         # increment to counter
@@ -1,74 +1,232 @@
+import json
+from bisect import bisect_right
 from datetime import datetime, timedelta
 
+import numpy as np
+
 from Athena.settings import AthenaConfig
 from Athena.utils import filetime_to_dt
 
+__author__ = 'zed'
 
-def is_in_trade_time(dt, instrument):
+MICROSECONDS_PER_MINUTE = 60 * 1000000
+
+
+class SessionCalendar(object):
     """
+    Trading session calendar of exchanges.
+
+    The session table of each exchange is compiled once into sorted
+    begin/end boundaries (minute of day, stored in microseconds), so that
+    a lookup is one bisection. Both ends of a session are inclusive.
 
-    :param dt:
-    :param instrument:
-    :return:
+    Holidays and special sessions are overrides by date, loaded from a
+    json file like:
+    {
+        "holidays": {
+            "SHFE": ["2016-10-03", "2016-10-04"],
+            ...
+        },
+        "special_sessions": {
+            "SGE": {
+                "2016-09-30": [["09:00", "11:30"], ["13:30", "15:30"]]
+            },
+            ...
+        }
+    }
+    An exchange is closed all day on its holidays, and only trades in the
+    given sessions on special session days.
     """
-    exchange = AthenaConfig.hermes_exchange_mapping[instrument]
-    day_start = datetime(dt.year, dt.month, dt.day)
-
-    if exchange == 'SHFE':
-        # uft
-        if day_start <= dt \
-                <= day_start + timedelta(hours=2, minutes=30):
-            # 00:00 - 02:30
-            return True
-        elif day_start + timedelta(hours=9) <= dt \
-                <= day_start + timedelta(hours=10, minutes=15):
-            # 09:00 - 10:15
-            return True
-        elif day_start + timedelta(hours=10, minutes=30) <= dt \
-                <= day_start + timedelta(hours=11, minutes=30):
-            # 10:30 - 11:30
-            return True
-        elif day_start + timedelta(hours=13, minutes=29) <= dt \
-                <= day_start + timedelta(hours=15):
-            # 13:30 - 15:00
-            return True
-        elif day_start + timedelta(hours=21) <= dt \
-                <= day_start + timedelta(hours=24):
-            # 21:00 - 24:00
-            return True
-        else:
-            return False
-
-    elif exchange == 'SGE':
-        # ksd
-        if day_start <= dt \
-                <= day_start + timedelta(hours=2, minutes=30):
-            # 00:00 - 02:30
-            return True
-        elif day_start + timedelta(hours=9) <= dt \
-                <= day_start + timedelta(hours=11, minutes=30):
-            # 09:00 - 11:30
-            return True
-        elif day_start + timedelta(hours=13, minutes=29) <= dt \
-                <= day_start + timedelta(hours=15, minutes=30):
-            # 13:30 - 15:30
-            return True
-        elif day_start + timedelta(hours=20) <= dt \
-                <= day_start + timedelta(hours=24):
-            # 20:00 - 24:00
-            return True
-        else:
-            return False
-
-    elif exchange == 'CME':
-        if day_start + timedelta(hours=5) < dt \
-                < day_start + timedelta(hours=5, minutes=30):
-            return False
-        else: return True
-    else:
-        raise ValueError
+    def __init__(self, sessions=None, overrides_file=None):
+        """
+        constructor.
+        :param sessions: dict, exchange -> tuple of ('HH:MM', 'HH:MM').
+            Default is AthenaConfig.trade_sessions.
+        :param overrides_file: string, path to json file of holidays and
+            special sessions.
+        """
+        if sessions is None:
+            sessions = AthenaConfig.trade_sessions
+
+        # exchange -> (begins, ends)
+        self.tables = dict()
+        for exchange in sessions:
+            self.tables[exchange] = self.compile_sessions(sessions[exchange])
+
+        # exchange -> {date: (begins, ends)}, holidays are empty tables.
+        self.overrides = dict()
+
+        if overrides_file:
+            self.load_overrides(overrides_file)
+
+    @staticmethod
+    def compile_sessions(sessions):
+        """
+        compile sessions to sorted boundaries.
+        :param sessions: iterable of ('HH:MM', 'HH:MM') tuples.
+        :return: (begins, ends) tuple of lists, microseconds of day.
+        """
+        boundaries = []
+        for begin, end in sessions:
+            boundaries.append((
+                SessionCalendar.minute_of_day(begin) * MICROSECONDS_PER_MINUTE,
+                SessionCalendar.minute_of_day(end) * MICROSECONDS_PER_MINUTE
+            ))
+        boundaries.sort()
+        return [b for b, e in boundaries], [e for b, e in boundaries]
+
+    @staticmethod
+    def minute_of_day(hh_mm):
+        """
+        :param hh_mm: string, 'HH:MM'
+        :return: int
+        """
+        hours, minutes = hh_mm.split(':')
+        return int(hours) * 60 + int(minutes)
+
+    def load_overrides(self, file_path):
+        """
+        load holidays and special sessions from json file.
+        :param file_path: string
+        :return:
+        """
+        with open(file_path) as f:
+            overrides = json.load(f)
+
+        empty = ([], [])
+
+        for exchange, days in overrides.get('holidays', dict()).items():
+            for day in days:
+                self.overrides.setdefault(exchange, dict())[
+                    np.datetime64(day, 'D')] = empty
+
+        special_sessions = overrides.get('special_sessions', dict())
+        for exchange, days in special_sessions.items():
+            for day, sessions in days.items():
+                self.overrides.setdefault(exchange, dict())[
+                    np.datetime64(day, 'D')] = self.compile_sessions(sessions)
+
+        print('[Trade Time]: Loaded calendar overrides from {}.'.format(
+            file_path))
+
+    def __table(self, exchange, day=None):
+        """
+        session table of exchange on day.
+        :param exchange: string
+        :param day: numpy datetime64[D]
+        :return: (begins, ends)
+        """
+        try:
+            table = self.tables[exchange]
+        except KeyError:
+            raise ValueError('Unknown exchange {}.'.format(exchange))
+
+        if exchange in self.overrides and day is not None:
+            return self.overrides[exchange].get(day, table)
+        return table
+
+    def __locate(self, dt, instrument):
+        """
+        :return: (index of session, ends of the day), index is -1 if not
+            in trade time.
+        """
+        exchange = AthenaConfig.hermes_exchange_mapping[instrument]
+        day = np.datetime64(dt.date(), 'D') \
+            if exchange in self.overrides else None
+        begins, ends = self.__table(exchange, day)
+
+        t = ((dt.hour * 60 + dt.minute) * 60 + dt.second) * 1000000 \
+            + dt.microsecond
+        i = bisect_right(begins, t) - 1
+        if i >= 0 and t <= ends[i]:
+            return i, ends
+        return -1, ends
+
+    def session_index(self, dt, instrument):
+        """
+        find the session that dt belongs to.
+        :param dt: datetime.datetime
+        :param instrument: string
+        :return: int, index of the session in the day, -1 if not in trade
+            time.
+        """
+        return self.__locate(dt, instrument)[0]
+
+    def session_end(self, dt, instrument):
+        """
+        end of the session that dt belongs to (inclusive).
+        :param dt: datetime.datetime
+        :param instrument: string
+        :return: datetime.datetime, None if not in trade time.
+        """
+        i, ends = self.__locate(dt, instrument)
+        if i < 0:
+            return None
+        return datetime(dt.year, dt.month, dt.day) + \
+            timedelta(microseconds=ends[i])
+
+    def is_open(self, dt, instrument):
+        """
+        whether dt is in trade time of instrument.
+        :param dt: datetime.datetime
+        :param instrument: string
+        :return: bool
+        """
+        return self.session_index(dt, instrument) >= 0
+
+    def mask(self, timestamps, instrument):
+        """
+        vectorized is_open.
+        :param timestamps: array-like of datetime64 (or datetime).
+        :param instrument: string
+        :return: numpy bool array, True if in trade time.
+        """
+        exchange = AthenaConfig.hermes_exchange_mapping[instrument]
+        ts = np.asarray(timestamps, dtype='datetime64[us]')
+        days = ts.astype('datetime64[D]')
+        t = (ts - days).astype(np.int64)
+
+        mask = self.__mask_of_day(t, self.__table(exchange))
+
+        # apply overrides, day by day
+        for day, table in self.overrides.get(exchange, dict()).items():
+            selected = days == day
+            if selected.any():
+                mask[selected] = self.__mask_of_day(t[selected], table)
+
+        return mask
+
+    @staticmethod
+    def __mask_of_day(t, table):
+        """
+        :param t: numpy int64 array, microseconds of day.
+        :param table: (begins, ends)
+        :return: numpy bool array
+        """
+        if not table[0]:
+            return np.zeros(t.shape, dtype=bool)
+        begins = np.array(table[0], dtype=np.int64)
+        ends = np.array(table[1], dtype=np.int64)
+        i = np.searchsorted(begins, t, side='right') - 1
+        return (i >= 0) & (t <= ends[np.maximum(i, 0)])
+
+
+# calendar used by Athena modules.
+trade_calendar = SessionCalendar(
+    AthenaConfig.trade_sessions, AthenaConfig.trade_calendar_file)
+
+
+def is_in_trade_time(dt, instrument):
+    """
+    whether dt is in trade time of instrument, see SessionCalendar.
+    :param dt: datetime.datetime
+    :param instrument: string
+    :return: bool
+    """
+    return trade_calendar.is_open(dt, instrument)
+
 
 if __name__ == '__main__':
     d = filetime_to_dt(131145893910000000)
     print(d)
-    print(is_in_trade_time(d, 'Au(T+D)'))
\ No newline at end of file
+    print(is_in_trade_time(d, 'Au(T+D)'))
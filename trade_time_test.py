@@ -0,0 +1,98 @@
+import os
+import json
+import tempfile
+import unittest
+from datetime import datetime
+
+import numpy as np
+
+from Athena.trade_time import SessionCalendar, is_in_trade_time
+
+__author__ = 'zed'
+
+
+class TestSessionCalendar(unittest.TestCase):
+    """
+    Test trading session calendar.
+    """
+    def setUp(self):
+        """
+        :return:
+        """
+        self.day = datetime(2016, 9, 30)
+        self.times = [
+            datetime(2016, 9, 30, 2, 30),
+            datetime(2016, 9, 30, 2, 30, 0, 1),
+            datetime(2016, 9, 30, 10, 20),
+            datetime(2016, 9, 30, 13, 29),
+            datetime(2016, 9, 30, 20, 30),
+            datetime(2016, 9, 30, 23, 59, 59),
+            datetime(2016, 10, 3, 9, 30)
+        ]
+
+    def test_scalar_lookup(self):
+        # >>> both ends of a session are inclusive
+        self.assertTrue(is_in_trade_time(self.times[0], 'au1612'))
+        self.assertFalse(is_in_trade_time(self.times[1], 'au1612'))
+
+        # >>> 10:15 - 10:30 break of SHFE, SGE trades through
+        self.assertFalse(is_in_trade_time(self.times[2], 'au1612'))
+        self.assertTrue(is_in_trade_time(self.times[2], 'Au(T+D)'))
+
+        # >>> night session of SGE opens at 20:00, SHFE at 21:00
+        self.assertFalse(is_in_trade_time(self.times[4], 'au1612'))
+        self.assertTrue(is_in_trade_time(self.times[4], 'Au(T+D)'))
+
+        # >>> CME closes between 05:00 and 05:30 only
+        self.assertTrue(is_in_trade_time(self.times[2], 'GC1612'))
+        self.assertFalse(
+            is_in_trade_time(datetime(2016, 9, 30, 5, 10), 'GC1612'))
+
+    def test_session_end(self):
+        calendar = SessionCalendar()
+        self.assertEqual(calendar.session_end(self.times[3], 'au1612'),
+                         datetime(2016, 9, 30, 15))
+        self.assertIsNone(calendar.session_end(self.times[2], 'au1612'))
+
+    def test_mask(self):
+        calendar = SessionCalendar()
+        timestamps = np.array(self.times, dtype='datetime64[us]')
+
+        # >>> vectorized mask agrees with scalar lookups
+        for instrument in ['au1612', 'Au(T+D)', 'GC1612']:
+            expected = [calendar.is_open(t, instrument) for t in self.times]
+            self.assertEqual(
+                calendar.mask(timestamps, instrument).tolist(), expected)
+
+    def test_overrides(self):
+        overrides = {
+            'holidays': {'SHFE': ['2016-10-03']},
+            'special_sessions': {'SGE': {'2016-09-30': [['09:00', '10:00']]}}
+        }
+        handle, file_path = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(handle, 'w') as f:
+            json.dump(overrides, f)
+
+        try:
+            calendar = SessionCalendar(overrides_file=file_path)
+        finally:
+            os.remove(file_path)
+
+        # >>> SHFE is closed on holiday
+        self.assertTrue(is_in_trade_time(self.times[-1], 'au1612'))
+        self.assertFalse(calendar.is_open(self.times[-1], 'au1612'))
+
+        # >>> SGE trades in special session only
+        self.assertFalse(calendar.is_open(self.times[2], 'Au(T+D)'))
+        self.assertTrue(
+            calendar.is_open(datetime(2016, 9, 30, 9, 30), 'Au(T+D)'))
+
+        timestamps = np.array(self.times, dtype='datetime64[us]')
+        for instrument in ['au1612', 'Au(T+D)']:
+            expected = [calendar.is_open(t, instrument) for t in self.times]
+            self.assertEqual(
+                calendar.mask(timestamps, instrument).tolist(), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
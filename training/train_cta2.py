@@ -111,8 +111,6 @@ if __name__ == '__main__':
         counter += 1
         processes[-1].join()
 
-        kk = r.get_keys('parametric_space:*')
-        print(kk)
-        r.migrate_keys(kk, target_db=2)
+        r.migrate_keys(r.iter_keys('parametric_space:*'), target_db=2)
         print(r)
         print('Finished chunk {}.'.format(counter))
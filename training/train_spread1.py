@@ -112,6 +112,5 @@ if __name__ == '__main__':
 
         processes[-1].join()
 
-        kk = r.get_keys('parametric_space:*')
-        r.migrate_keys(kk, target_db=2)
+        r.migrate_keys(r.iter_keys('parametric_space:*'), target_db=2)
         print('Finished chunk {}.'.format(counter))
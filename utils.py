@@ -1,6 +1,8 @@
 from datetime import datetime, timedelta, tzinfo
 from calendar import timegm
 
+import numpy as np
+
 __author__ = 'zed'
 
 MAX_DIGITS = 9
@@ -99,6 +101,16 @@ def dt_to_filetime(dt, tz_adjustment=8):
     return ft + (dt.microsecond * 10)
 
 
+def dt_to_epoch(dt):
+    """
+    Converts a (time zone-naive) datetime to seconds since 1970-01-01 of
+    the same time zone, as scores of time indices in redis.
+    :param dt: datetime
+    :return: float
+    """
+    return timegm(dt.timetuple()) + dt.microsecond / 1e6
+
+
 def filetime_to_dt(ft, tz_adjustment=8):
     """
     Converts a Microsoft filetime number to a Python datetime. The new
@@ -117,4 +129,40 @@ def filetime_to_dt(ft, tz_adjustment=8):
     return dt + timedelta(hours=tz_adjustment)
 
 
+def filetime_to_dt64(ft, tz_adjustment=8):
+    """
+    Vectorized filetime_to_dt. Converts an array of Microsoft filetime
+    numbers to numpy datetime64[us] array in one operation.
+    :param ft: array-like of int, filetime representation
+    :param tz_adjustment: int, timezone adjustment.
+    :return: numpy array of datetime64[us]
+    """
+    ft = np.asarray(ft, dtype=np.int64)
+    us = (ft - EPOCH_AS_FILETIME) // 10 + \
+        tz_adjustment * 3600 * 1000000
+    return us.astype('datetime64[us]')
+
+
+def dt64_to_filetime(dt, tz_adjustment=8):
+    """
+    Vectorized dt_to_filetime. Converts an array of datetime64 (or
+    datetime objects, or ISO format strings) to Microsoft filetime numbers.
+    :param dt: array-like of datetime64/datetime/str.
+    :param tz_adjustment: int, timezone adjustment.
+    :return: numpy array of int64
+    """
+    us = np.asarray(dt, dtype='datetime64[us]').astype(np.int64)
+    us = us - tz_adjustment * 3600 * 1000000
+    return us * 10 + EPOCH_AS_FILETIME
+
 
+def dt64_to_str(dt):
+    """
+    Format an array of datetime64 as AthenaConfig.sql_storage_dt_format
+    strings ('%Y-%m-%d %H:%M:%S.%f').
+    :param dt: array-like of datetime64.
+    :return: numpy array of str
+    """
+    return np.char.replace(
+        np.datetime_as_string(np.asarray(dt, dtype='datetime64[us]'),
+                              unit='us'), 'T', ' ')